@@ -1,6 +1,21 @@
+# The GUI (PyQt5, pyqtgraph) is only imported when used, so the Qt-free modules (batch, util) can run on
+# machines without Qt.
+import importlib
+import importlib.util
 
-from .gsaimage import *
-from .gsaimage import main
-from .image import ImageEditor
+def main():
+    from .gsaimage import main
+    main()
 
-__version__ = "1.3.0"
\ No newline at end of file
+def __getattr__(name):
+    # Python >= 3.7: the GUI names the package used to export are resolved on first access. Submodules are
+    # left to the import system (from gsaimage import batch asks for the attribute first).
+    if name.startswith('__') or importlib.util.find_spec('.'+name,__name__) is not None:
+        raise AttributeError("module '%s' has no attribute '%s'"%(__name__,name))
+    module = importlib.import_module('.image' if name == 'ImageEditor' else '.gsaimage',__name__)
+    try:
+        return getattr(module,name)
+    except AttributeError:
+        raise AttributeError("module '%s' has no attribute '%s'"%(__name__,name))
+
+__version__ = "1.3.0"
@@ -1,4 +1,9 @@
 #!/usr/bin/env python
-from gsaimage import main
+import sys
 
-main()
+if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+    from gsaimage.batch import main
+    main(sys.argv[2:])
+else:
+    from gsaimage import main
+    main()
@@ -0,0 +1,160 @@
+"""
+Applies a saved layer stack (File > Export Pipeline in the GUI) to every image in a directory without
+launching the GUI:
+
+    python -m gsaimage batch --pipeline stack.json --input dir/ --output out/ --workers N
+
+For every input image, the processed image (<name>.png) and its mask (<name>_mask.png, white where pixels
+were kept) are written to the output directory. Pipelines with a DomainCenterDetection layer also write the
+detected centers (<name>_centers.json, [row, col] pixel coordinates). Images whose outputs already exist are
+skipped, so an interrupted run can be resumed by running the same command again.
+"""
+import argparse
+import collections
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .util import cache
+from .util.pipeline import DomainCenterDetection, Pipeline
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = ('.tif','.tiff','.png','.jpg','.jpeg','.bmp')
+
+_pipeline = None
+
+def find_images(directory):
+    """
+    Returns the sorted paths of the images in directory.
+    """
+    return sorted(
+        os.path.join(directory,name) for name in os.listdir(directory)
+        if os.path.splitext(name)[1].lower() in EXTENSIONS)
+
+def output_paths(path,output):
+    """
+    Returns the (image, mask) output paths for the input image at path.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output,name+'.png'), os.path.join(output,name+'_mask.png')
+
+def centers_path(path,output):
+    """
+    Returns the domain centers output path for the input image at path.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output,name+'_centers.json')
+
+def _write(path,img):
+    # Written to a temporary file first so an interrupted run never leaves a partial output behind.
+    directory, name = os.path.split(path)
+    tmp = os.path.join(directory,'.'+name)
+    if not cv2.imwrite(tmp,img):
+        raise IOError("Cannot write file %s"%path)
+    os.replace(tmp,path)
+
+def _write_json(path,data):
+    directory, name = os.path.split(path)
+    tmp = os.path.join(directory,'.'+name)
+    with open(tmp,'w') as f:
+        json.dump(data,f)
+    os.replace(tmp,path)
+
+def _cache_counters():
+    result_cache = cache.get_cache()
+    if result_cache is None:
+        return collections.Counter()
+    return collections.Counter(
+        hits=result_cache.hits,misses=result_cache.misses,skipped=result_cache.skipped)
+
+def _init(pipeline_path):
+    global _pipeline
+    # One OpenCV thread per process, the pool already uses every core.
+    cv2.setNumThreads(1)
+    _pipeline = Pipeline.load(pipeline_path)
+
+def process(path,output):
+    """
+    Runs the worker's pipeline on the image at path and writes the image and mask, and the domain centers
+    found by the last DomainCenterDetection layer on its input. Returns (path, error, counters), counters being
+    the result cache hits, misses and skipped stores of this image (the cache counts them per process).
+    """
+    before = _cache_counters()
+    try:
+        img = np.array(Image.open(path).convert('L'))
+        inputs = [img]+_pipeline.run(img,stages=True)
+        out = inputs[-1]
+        detectors = [i for i, op in enumerate(_pipeline) if isinstance(op,DomainCenterDetection)]
+        if detectors:
+            centers = _pipeline[detectors[-1]].centers(inputs[detectors[-1]])
+            _write_json(centers_path(path,output),{'Domain Center Coordinates': centers.tolist()})
+        img_path, mask_path = output_paths(path,output)
+        _write(mask_path,np.where(out<255,255,0).astype(np.uint8))
+        _write(img_path,out)
+    except Exception as e:
+        return path, "%s: %s"%(type(e).__name__,e), _cache_counters()-before
+    return path, None, _cache_counters()-before
+
+def run(pipeline_path,input_dir,output_dir,workers=None,overwrite=False):
+    """
+    Processes every image in input_dir with the pipeline saved at pipeline_path. Returns the list of
+    (path, error) for the images that failed.
+    """
+    stack = Pipeline.load(pipeline_path) # fail early on a bad pipeline file
+    os.makedirs(output_dir,exist_ok=True)
+
+    # An image is done once all its outputs exist, the centers included if the pipeline detects them.
+    detects = any(isinstance(op,DomainCenterDetection) for op in stack)
+    def outputs(path):
+        paths = output_paths(path,output_dir)
+        return paths+(centers_path(path,output_dir),) if detects else paths
+
+    paths = find_images(input_dir)
+    todo = [p for p in paths if overwrite or not all(os.path.isfile(o) for o in outputs(p))]
+    print("%d images found, %d already processed."%(len(paths),len(paths)-len(todo)))
+    if len(todo) == 0:
+        return []
+
+    failed = []
+    counters = collections.Counter()
+    tic = time.time()
+    with multiprocessing.Pool(processes=workers,initializer=_init,initargs=(pipeline_path,)) as pool:
+        results = pool.imap_unordered(functools.partial(process,output=output_dir),todo)
+        for count, (path, error, image_counters) in enumerate(results,1):
+            counters.update(image_counters)
+            if error is not None:
+                failed.append((path,error))
+                logger.error("Failed to process %s (%s)"%(path,error))
+            rate = count/(time.time()-tic)
+            print("[%d/%d] %s (%.2f images/s)"%(count,len(todo),os.path.basename(path),rate))
+
+    print("Done: %d processed, %d failed in %.1f s."%(len(todo)-len(failed),len(failed),time.time()-tic))
+    result_cache = cache.get_cache()
+    if result_cache is not None:
+        stats = result_cache.stats()
+        stats.update(counters)
+        print("Result cache: "+result_cache.summary(stats))
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='gsaimage batch',
+        description='Apply a saved GSAImage pipeline to a directory of images.')
+    parser.add_argument('--pipeline',required=True,help='Pipeline JSON file (File > Export Pipeline).')
+    parser.add_argument('--input',required=True,help='Directory of input images.')
+    parser.add_argument('--output',required=True,help='Directory for output images and masks.')
+    parser.add_argument('--workers',type=int,default=None,help='Number of processes (default: all cores).')
+    parser.add_argument('--overwrite',action='store_true',help='Reprocess images that already have outputs.')
+    args = parser.parse_args(argv)
+
+    failed = run(args.pipeline,args.input,args.output,workers=args.workers,overwrite=args.overwrite)
+    sys.exit(1 if failed else 0)
@@ -15,6 +15,7 @@ import scipy as sc
 import subprocess
 import sys
 import time
+import zipfile
 from PIL import Image
 from PIL.ImageQt import ImageQt
 from PyQt5 import QtGui, QtCore, QtWidgets
@@ -23,25 +24,16 @@ from skimage import transform
 from skimage import util
 from skimage.draw import circle as skcircle
 from sklearn.cluster import MiniBatchKMeans
-from sklearn.mixture import GaussianMixture
+
+try:
+    from .util import cache, pipeline, session
+except ImportError:
+    from util import cache, pipeline, session
 
 logger = logging.getLogger(__name__)
 pg.setConfigOption('background', 'w')
 pg.setConfigOption('imageAxisOrder', 'row-major')
 
-tic = time.time()
-
-def slow_update(func, pause=0.3):
-    def wrapper(self):
-        global tic
-        toc = time.time()
-        if toc - tic > pause:
-            tic = toc
-            return func(self)
-        else:
-            pass
-    return wrapper
-
 def mask_color_img(img, mask, color=[0, 0, 255], alpha=0.3):
     out = img.copy()
     img_layer = img.copy()
@@ -168,8 +160,7 @@ class GSAImage(QtWidgets.QWidget):
     @classmethod
     def viewOnlyWidget(cls,d):
         obj = cls()
-        cla = globals()[d['@class']]
-        obj.modifications = cla.from_dict(d,obj.wImgItem).tolist()
+        obj.modifications = LazyModification.from_dict(d,obj.wImgItem).tolist()
         obj.layout.removeWidget(obj.wMain)
         obj.wMain.hide()
         obj.layout.removeWidget(obj.wDetail)
@@ -205,15 +196,16 @@ class GSAImage(QtWidgets.QWidget):
         if len(self.modifications) > 0:
             if self.mode == 'local':
                 d = self.modifications[-1].to_dict()
-                name = QtWidgets.QFileDialog.getSaveFileName(None, "Export Image", '', "All Files (*);;JSON File (*.json)")[0]
-                if name != '' and check_extension(name, [".json"]):
+                name = QtWidgets.QFileDialog.getSaveFileName(None, "Export Image", '', "All Files (*);;GSAImage Session (*%s);;JSON File (*.json)"%session.EXTENSION)[0]
+                if name != '' and check_extension(name, [session.EXTENSION]):
+                    session.save(name,d)
+                elif name != '' and check_extension(name, [".json"]):
                     with open(name,'w') as f:
-                        json.dump(d,f)
+                        json.dump(d,f,default=lambda a: a.tolist())
             elif self.mode == 'nanohub':
                 d = self.modifications[-1].to_dict()
-                name = 'temp_%s.json'%int(time.time())
-                with open(name,'w') as f:
-                    json.dump(d,f)
+                name = 'temp_%s%s'%(int(time.time()),session.EXTENSION)
+                session.save(name,d)
                 subprocess.check_output('exportfile %s'%name,shell=True)
                 # os.remove(name)
             else:
@@ -228,16 +220,14 @@ class GSAImage(QtWidgets.QWidget):
                 else:
                     return
                 self.clear()
-                with open(file_path,'r') as f:
-                    state = json.load(f)
+                state = self.loadState(file_path)
             except Exception as e:
                 print(e)
                 return
         elif self.mode == 'nanohub':
             try:
                 file_path = subprocess.check_output('importfile',shell=True).strip().decode("utf-8")
-                with open(file_path,'r') as f:
-                    state = json.load(f)
+                state = self.loadState(file_path)
                 os.remove(file_path)
             except Exception as e:
                 print(e)
@@ -245,10 +235,20 @@ class GSAImage(QtWidgets.QWidget):
         else:
             return
 
-        cla = globals()[state['@class']]
-        self.modifications = cla.from_dict(state,self.wImgItem).tolist()
+        # Layers are only built once they are selected (see selectMod).
+        self.modifications = LazyModification.from_dict(state,self.wImgItem).tolist()
         self.updateAll()
 
+    @staticmethod
+    def loadState(file_path):
+        """
+        Reads a state saved by exportState, either a session file (arrays are memory-mapped) or JSON.
+        """
+        if zipfile.is_zipfile(file_path):
+            return session.load(file_path)
+        with open(file_path,'r') as f:
+            return json.load(f)
+
     def manualImport(self,fpath):
         try:
             self.clear()
@@ -322,6 +322,8 @@ class GSAImage(QtWidgets.QWidget):
     def selectMod(self,index):
         print(index)
         if index >= 0:
+            if isinstance(self.modifications[index],LazyModification):
+                self.materializeMod(index)
             # try:
             self.modifications[index].update_view()
             # except:
@@ -331,6 +333,18 @@ class GSAImage(QtWidgets.QWidget):
         elif self.wModList.count() > 0:
             self.wModList.setCurrentRow(self.wModList.count()-1)
 
+    def materializeMod(self,index):
+        """
+        Builds the Modification (and its widget) for the LazyModification at index.
+        """
+        lazy = self.modifications[index]
+        placeholder = lazy.widget()
+        mod = lazy.materialize()
+        self.modifications[index] = mod
+        self.wDetail.insertWidget(index,mod.widget())
+        self.wDetail.removeWidget(placeholder)
+        return mod
+
     def clear(self):
         self.wImgItem.clear()
         self.wModList.clear()
@@ -411,7 +425,7 @@ class Modification(QtWidgets.QScrollArea):
         """
         Sets the output image manually. Only necessary for initializing.
         """
-        self.img_out = img.astype(np.uint8)
+        self.img_out = np.asarray(img,dtype=np.uint8)
     def update_image(self):
         """
         Abstract function for defining and applying modifications to the input image.
@@ -481,7 +495,8 @@ class Modification(QtWidgets.QScrollArea):
             return d
     def to_dict(self):
         """
-        Generic recursive function for converting object to json compatible storage object. Used for saving the state.
+        Generic recursive function for converting object to a storage object. Used for saving the state. Arrays
+        are kept as np.ndarray; they are written as binary blobs by util.session (or as lists for JSON).
         """
         d = {}
         d['@module'] = self.__class__.__module__
@@ -492,6 +507,8 @@ class Modification(QtWidgets.QScrollArea):
         else:
             d['mod_in'] = None
         d['properties'] = self.properties
+        if self.img_out is not None:
+            d['img_out'] = self.image()
         return d
 
     @classmethod
@@ -501,15 +518,91 @@ class Modification(QtWidgets.QScrollArea):
 
         d:              dictionary from which to load.
         img_item:       GSAImage's ImageItem.
+
+        d['mod_in'] may also be an already loaded (or lazy) Modification.
         """
-        if d['mod_in'] != None:
+        if isinstance(d['mod_in'],dict):
             mod_in_dict = d['mod_in']
             mod_in_cls = globals()[mod_in_dict['@class']]
             mod_in = mod_in_cls.from_dict(mod_in_dict,img_item)
         else:
-            mod_in = None
+            mod_in = d['mod_in']
         return cls(mod_in,img_item,d['properties'])
 
+class LazyModification(object):
+    """
+    Lightweight stand-in for a Modification loaded from a saved state. Holds the saved dictionary and output
+    so that the layer can be listed and read by the following layers without building its widgets or
+    rerunning it. The actual Modification is built by materialize(), e.g. when the layer is selected.
+
+    d:              dictionary generated by to_dict().
+    img_item:       GSAImage's ImageItem.
+    mod_in:         the (lazy) Modification that the current object inherits.
+    """
+    def __init__(self,d,img_item,mod_in=None):
+        self.d = d
+        self.img_item = img_item
+        self.mod_in = mod_in
+        self.properties = d['properties']
+        self._mod = None
+        self._placeholder = None
+
+    @classmethod
+    def from_dict(cls,d,img_item):
+        if d['mod_in'] != None:
+            mod_in = cls.from_dict(d['mod_in'],img_item)
+        else:
+            mod_in = None
+        return cls(d,img_item,mod_in)
+
+    tolist = Modification.tolist
+    back_traverse = Modification.back_traverse
+    root = Modification.root
+    length = Modification.length
+    back_properties = Modification.back_properties
+
+    def modClass(self):
+        return globals()[self.d['@class']]
+
+    def name(self):
+        return self.modClass().name(self)
+
+    def materialize(self):
+        """
+        Builds (once) and returns the Modification. Its input stays lazy.
+        """
+        if self._mod is None:
+            d = dict(self.d)
+            d['mod_in'] = self.mod_in
+            self._mod = self.modClass().from_dict(d,self.img_item)
+        return self._mod
+
+    def image(self):
+        """
+        Returns the saved output (read from the session file), or the output of the built Modification.
+        The saved output is returned without copying, as a read-only array mapped from the session file.
+        """
+        if self._mod is None and self.d.get('img_out') is not None:
+            return np.asarray(self.d['img_out'],dtype=np.uint8)
+        return self.materialize().image()
+
+    def widget(self):
+        if self._mod is not None:
+            return self._mod.widget()
+        if self._placeholder is None:
+            self._placeholder = QtWidgets.QWidget()
+        return self._placeholder
+
+    def update_view(self):
+        return self.materialize().update_view()
+
+    def to_dict(self):
+        if self._mod is not None:
+            return self._mod.to_dict()
+        d = dict(self.d)
+        d['mod_in'] = self.mod_in.to_dict() if self.mod_in != None else None
+        return d
+
 
 
 class InitialImage(Modification):
@@ -517,7 +610,7 @@ class InitialImage(Modification):
         return 'Initial Image'
     def to_dict(self):
         d = super(InitialImage,self).to_dict()
-        d['img_out'] = self.img_out.tolist()
+        d['img_out'] = self.img_out
         return d
 
     @classmethod
@@ -533,6 +626,7 @@ class RemoveScale(Modification):
     def to_dict(self):
         d = super(RemoveScale,self).to_dict()
         d['scale_location'] = self.scale_location.currentText()
+        return d
 
     def name(self):
         return 'Remove Scale'
@@ -547,68 +641,26 @@ class RemoveScale(Modification):
         obj.widget().hide()
         return obj
 
-    def crop_image(self,img,box):
-        pil_img = Image.fromarray(img)
-        return np.array(pil_img.crop(box))
-
     def update_image(self,scale_location='Auto',tol=0.95):
         img_array = self.mod_in.image()
-        img = Image.fromarray(img_array)
-        width,height = img.size
-        crop_img = None
-        self.box = (0,0,width,height)
-        if scale_location == 'Bottom' or scale_location == 'Auto':
-            for row in range(height):
-                if np.mean(img_array[row,:]==0)>tol:
-                    self.box = (0,0,width,row)
-                    crop_img = img.crop(self.box)
-                    break
-        elif scale_location == 'Top' or scale_location == 'Auto':
-            for row in reversed(range(height)):
-                if np.mean(img_array[row,:]==0)>tol:
-                    self.box = (0,row,width,height)
-                    if scale_location == 'Top':
-                        crop_img = img.crop(self.box)
-                    elif scale_location == 'Auto' and np.multiply(*self.box.size)>np.multiply(*crop_img.size):
-                        crop_img = img.crop(self.box)
-                    break
-        elif scale_location == 'Right' or scale_location == 'Auto':
-            for col in range(width):
-                if np.mean(img_array[:,col]==0)>tol:
-                    self.box = (0,0,col,height)
-                    if scale_location == 'Right':
-                        crop_img = img.crop(self.box)
-                    elif scale_location == 'Auto' and np.multiply(*self.box.size)>np.multiply(*crop_img.size):
-                        crop_img = img.crop(self.box)
-                    break
-        elif scale_location == 'Left' or scale_location == 'Auto':
-            for col in reversed(range(width)):
-                if np.mean(img_array[:,col]==0)>tol:
-                    self.box = (col,0,width,height)
-                    if scale_location == 'Left':
-                        crop_img = img.crop(self.box)
-                    elif scale_location == 'Auto' and np.multiply(*self.box.size)>np.multiply(*crop_img.size):
-                        crop_img = img.crop(self.box)
-                    break
-
+        operator = pipeline.RemoveScale(scale_location=scale_location,tol=tol)
+        self.box = operator.box(img_array)
         self.properties['scale_crop_box'] = self.box
-        if crop_img:
-            self.img_out = np.array(crop_img)
-        else:
-            self.img_out = self.mod_in.image()
+        self.img_out = pipeline.crop_view(img_array,self.box)
 
 
 class ColorMask(Modification):
     def __init__(self,mod_in,img_item,properties={}):
         super(ColorMask,self).__init__(mod_in,img_item,properties)
         self.img_mask = None
-        self.img_hist = self.img_item.getHistogram()
+        self.operator = pipeline.ColorMask()
+        self.img_hist = pipeline.histogram(self.mod_in.image())
 
         self.wHistPlot = None
         self.lrItem = None
 
         self.wHistPlot = pg.PlotWidget()
-        self.wHistPlot.plot(*self.img_hist)
+        self.wHistPlot.plot(np.arange(256),self.img_hist)
         self.wHistPlot.setXRange(0,255)
         self.wHistPlot.hideAxis('left')
 
@@ -622,7 +674,7 @@ class ColorMask(Modification):
 
     def to_dict(self):
         d = super(ColorMask,self).to_dict()
-        d['img_mask'] = self.img_mask.tolist()
+        d['img_mask'] = self.img_mask
         d['LinearRegionItem'] = {'region':self.lrItem.getRegion()}
         return d
 
@@ -640,10 +692,10 @@ class ColorMask(Modification):
 
     def update_image(self):
         minVal, maxVal = self.lrItem.getRegion()
+        self.operator.set(min_val=minVal,max_val=maxVal)
         img = self.mod_in.image()
-        self.img_mask = np.zeros_like(img)
-        self.img_mask[np.logical_and(img>minVal,img<maxVal)] = 1
-        self.img_out = img*self.img_mask+(1-self.img_mask)*255
+        self.img_mask = self.operator.mask(img).view(np.uint8)
+        self.img_out = self.operator(img)
 
     def name(self):
         return 'Color Mask'
@@ -652,8 +704,10 @@ class CannyEdgeDetection(Modification):
     def __init__(self,mod_in,img_item,properties={}):
         super(CannyEdgeDetection,self).__init__(mod_in,img_item,properties)
 
-        self.low_thresh = int(max(self.mod_in.image().flatten())*.1)
-        self.high_thresh = int(max(self.mod_in.image().flatten())*.4)
+        # Frozen so the operator can reuse its blurred gradients while the thresholds change.
+        self.img_in = pipeline.freeze(self.mod_in.image())
+        self.operator = pipeline.CannyEdgeDetection()
+        self.low_thresh, self.high_thresh = self.operator.thresholds(self.img_in)
         self.gauss_size = 5
         self.wToolBox = pg.LayoutWidget()
         self.wToolBox.layout.setAlignment(QtCore.Qt.AlignTop)
@@ -748,8 +802,8 @@ class CannyEdgeDetection(Modification):
         self.update_view()
 
     def update_image(self):
-        self.img_out = cv2.GaussianBlur(self.mod_in.image(),(self.gauss_size,self.gauss_size),0)
-        self.img_out = 255-cv2.Canny(self.img_out,self.low_thresh,self.high_thresh,L2gradient=True)
+        self.operator.set(gauss_size=self.gauss_size,low_thresh=self.low_thresh,high_thresh=self.high_thresh)
+        self.img_out = self.operator(self.img_in)
 
     def widget(self):
         return self.wToolBox
@@ -757,6 +811,9 @@ class CannyEdgeDetection(Modification):
 class Dilation(Modification):
     def __init__(self,mod_in,img_item,properties={}):
         super(Dilation,self).__init__(mod_in,img_item,properties)
+        # Frozen so the operator can reuse its distance transform while the size changes.
+        self.img_in = pipeline.freeze(self.mod_in.image())
+        self.operator = pipeline.Dilation()
         self.size = 1
         self.wToolBox = pg.LayoutWidget()
         self.wToolBox.layout.setAlignment(QtCore.Qt.AlignTop)
@@ -804,7 +861,8 @@ class Dilation(Modification):
         self.update_view()
 
     def update_image(self):
-        self.img_out = cv2.erode(self.mod_in.image(),np.ones((self.size,self.size),np.uint8),iterations=1)
+        self.operator.set(size=self.size)
+        self.img_out = self.operator(self.img_in)
 
     def widget(self):
         return self.wToolBox
@@ -812,6 +870,9 @@ class Dilation(Modification):
 class Erosion(Modification):
     def __init__(self,mod_in,img_item,properties={}):
         super(Erosion,self).__init__(mod_in,img_item,properties)
+        # Frozen so the operator can reuse its distance transform while the size changes.
+        self.img_in = pipeline.freeze(self.mod_in.image())
+        self.operator = pipeline.Erosion()
         self.size = 1
         self.wToolBox = pg.LayoutWidget()
         self.wToolBox.layout.setAlignment(QtCore.Qt.AlignTop)
@@ -859,7 +920,8 @@ class Erosion(Modification):
         self.update_view()
 
     def update_image(self):
-        self.img_out = cv2.dilate(self.mod_in.image(),np.ones((self.size,self.size),np.uint8),iterations=1)
+        self.operator.set(size=self.size)
+        self.img_out = self.operator(self.img_in)
 
     def widget(self):
         return self.wToolBox
@@ -1079,6 +1141,8 @@ class TemplateMatchingWidget(Modification):
             self.img_in = self.mod_in.image()
         self.img_in3d = np.dstack((self.img_in, self.img_in, self.img_in))
         self.roi_img = self.img_in3d.copy()
+        self._response = None
+        self._responseKey = None
 
         self.threshSlider = QtGui.QSlider(QtCore.Qt.Horizontal)
         self.threshSlider.setMinimum(0)
@@ -1115,16 +1179,26 @@ class TemplateMatchingWidget(Modification):
         self.setWidget(main_widget)
 
 
+    def response(self):
+        """
+        Returns the matchTemplate response map of the ROI. Cached until the ROI is moved or resized, so
+        threshold changes only redo the comparison.
+        """
+        key = (tuple(self.roi.pos()),tuple(self.roi.size()))
+        if self._responseKey != key:
+            region = self.roi.getArrayRegion(self.img_in,self.img_item).astype(np.uint8)
+            x,y = region.shape
+            padded_image = cv2.copyMakeBorder(self.img_in,int(y/2-1),int(y/2),int(x/2-1),int(x/2),cv2.BORDER_REFLECT_101)
+            self._response = cache.cached('TemplateMatchingWidget.matchTemplate',cv2.matchTemplate,padded_image,region,cv2.TM_SQDIFF_NORMED)
+            self._responseKey = key
+        return self._response
+
     def update_image(self,threshold=100):
-        region = self.roi.getArrayRegion(self.img_in,self.img_item).astype(np.uint8)
-        x,y = region.shape
-        padded_image = cv2.copyMakeBorder(self.img_in,int(y/2-1),int(y/2),int(x/2-1),int(x/2),cv2.BORDER_REFLECT_101)
-        res = cv2.matchTemplate(padded_image,region,cv2.TM_SQDIFF_NORMED)
+        res = self.response()
 
-        threshold = np.logspace(-3,0,1000)[threshold-1]
-        
-        self._mask[...] = False
-        self._mask[res < threshold] = True
+        threshold = pipeline.MATCH_THRESHOLDS[threshold-1]
+
+        self._mask = res < threshold
         if isinstance(self._mask_in,np.ndarray):
             self._mask = np.logical_or(self._mask,self._mask_in)
 
@@ -1292,10 +1366,11 @@ class ClusterFilter(Modification):
         return util.pad(img,pad_width=(px,py),mode='symmetric')
 
     def update_image(self):
-        selected_items = self.cluster_list.selectedItems()
-        self._mask = np.zeros_like(self.img_in,dtype=bool)
-        for item in selected_items:
-            self._mask[self._clusters==item.data(QtCore.Qt.UserRole)] = True
+        selected = [item.data(QtCore.Qt.UserRole) for item in self.cluster_list.selectedItems()]
+        if self._clusters is None:
+            self._mask = np.zeros_like(self.img_in,dtype=bool)
+        else:
+            self._mask = pipeline.select_labels(self._clusters,selected)
         if self._mask_in is not None:
             self._mask = np.logical_or(self._mask,self._mask_in)
 
@@ -1317,8 +1392,8 @@ class ClusterFilter(Modification):
     def update_list(self):
         self.cluster_list.clear()
         if self._clusters is not None:
-            labels, counts = np.unique(self._clusters,return_counts=True)
-            fractions = np.round(counts/counts.sum(),3)
+            labels, fractions = pipeline.label_fractions(self._clusters)
+            fractions = np.round(fractions,3)
             order = np.argsort(fractions)[::-1]
 
             for label, fraction in zip(labels[order],fractions[order]):
@@ -1369,23 +1444,34 @@ class KMeansFilter(ClusterFilter):
         n_clusters = int('0'+self.n_clusters_edit.text())
 
         if n_clusters >= 2 and wsize >= 1 and stride >= 1:
-            kmeans = MiniBatchKMeans(n_clusters=n_clusters)
-            X=util.view_as_windows(
-                self.pad(self.img_in,wsize=wsize,stride=stride),
-                window_shape=(wsize,wsize),
-                step=stride)
-            mask_dim = X.shape[:2]
-            X=X.reshape(-1,wsize**2)
-
-            kmeans = kmeans.fit(X)
-            mask = kmeans.labels_.reshape(*mask_dim)
-            mask = Image.fromarray(mask)
-            self._clusters = np.array(mask.resize(self.img_in.shape[::-1])).astype(np.uint8)
-            del X
+            self._clusters = cache.cached(
+                'KMeansFilter.clusters',
+                self.clusters,
+                self.img_in,
+                wsize=wsize,
+                n_clusters=n_clusters,
+                stride=stride)
 
             self.update_list()
             self.update_view()
 
+    def clusters(self,img,wsize,n_clusters,stride):
+        """
+        Clusters the windows of img with k-means and returns the label of each pixel.
+        """
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters,random_state=0)
+        X=util.view_as_windows(
+            self.pad(img,wsize=wsize,stride=stride),
+            window_shape=(wsize,wsize),
+            step=stride)
+        mask_dim = X.shape[:2]
+        X=X.reshape(-1,wsize**2)
+
+        kmeans = kmeans.fit(X)
+        mask = kmeans.labels_.reshape(*mask_dim)
+        mask = Image.fromarray(mask)
+        return np.array(mask.resize(img.shape[::-1])).astype(np.uint8)
+
 
 class GMMFilter(ClusterFilter):
     def __init__(self,*args,**kwargs):
@@ -1419,30 +1505,18 @@ class GMMFilter(ClusterFilter):
         n_components = int('0'+self.n_components_edit.text())
 
         if n_components >= 2 and wsize >= 1:
-            gmm = GaussianMixture(
-                n_components=n_components,
-                covariance_type='full',
-                n_init=10
-                )
-            X = util.view_as_blocks(
-                self.pad(self.img_in,wsize=wsize,stride='block'),
-                block_shape=(wsize,wsize)).reshape(-1,wsize**2)
-            gmm.fit(X)
-            del X
-            mod_img=util.view_as_windows(self.pad(self.img_in,wsize=wsize),window_shape=(wsize,wsize))
-
-            clusters = np.zeros(mod_img.shape[0]*mod_img.shape[1])
-            for i in range(mod_img.shape[0]):
-                x = mod_img[i,...].reshape(-1,wsize**2)
-                
-                d = x.shape[0]
-                clusters[i*d:(i+1)*d] = gmm.predict(x)
-
-            self._clusters = clusters.reshape(*self.img_in.shape).astype(np.uint8)
+            self._clusters = self.clusters(self.img_in,wsize=wsize,n_components=n_components)
 
             self.update_list()
             self.update_view()
 
+    def clusters(self,img,wsize,n_components):
+        """
+        Fits a gaussian mixture to a sample of the windows of img and returns the component of each pixel's
+        window (see pipeline.gmm_clusters, which caches the result).
+        """
+        return pipeline.gmm_clusters(img,wsize=wsize,n_components=n_components,seed=0)-1
+
 
 class FilterPattern(Modification):
     def __init__(self,mod_in,img_item,properties={}):
@@ -1510,7 +1584,7 @@ class FilterPattern(Modification):
     def update_properties(self):
         count = self.stackedControl.count()
         if count > 0:
-            self.properties["mask_total"] = self.stackedControl.widget(count-1).mask.tolist()
+            self.properties["mask_total"] = self.stackedControl.widget(count-1).mask.copy()
 
     def image(self):
         if self.wFilterList.count()>0:
@@ -1672,7 +1746,7 @@ class HoughTransform(Modification):
         self.min_dist = 9
         self.line_length = 50
         self.line_gap = 10
-        self.hspace,self.angles,self.distances = transform.hough_line(self.inv_img)
+        self.hspace,self.angles,self.distances = cache.cached('HoughTransform.hough_line',transform.hough_line,self.inv_img)
         self.bgr_img = cv2.cvtColor(self.img_out,cv2.COLOR_GRAY2BGR)
         self.bgr_hough = 255-np.round(self.hspace/np.max(self.hspace)*255).astype(np.uint8)
         self.bgr_hough = cv2.cvtColor(self.bgr_hough,cv2.COLOR_GRAY2BGR)
@@ -2065,7 +2139,7 @@ class Erase(Modification):
     def to_dict(self):
         d = super(Erase,self).to_dict()
         d['eraser_size'] = self.eraser_size
-        d['erased_image'] = self.img_out.tolist()
+        d['erased_image'] = self.img_out
         return d
 
     @classmethod
@@ -2,29 +2,33 @@ from __future__ import division
 
 from collections import OrderedDict
 
+import copy
 import cv2
+import functools
 import json
 import numpy as np
 import numpy.linalg as la
 import os
 import pyqtgraph as pg
 import pyqtgraph.exporters
-from scipy import signal
 import seaborn
 import subprocess
 import sys
+import time
+import zipfile
 from PIL import Image
 from PyQt5 import QtCore
 from PyQt5 import QtGui
 from PyQt5 import QtWidgets
-from skimage import util
 from skimage.draw import circle as skcircle
 from skimage.draw import line
-from sklearn.cluster import MiniBatchKMeans
-from sklearn.mixture import GaussianMixture
 from util.gwidgets import *
 from util.icons import Icon
 from util.io import IO
+from util import cache
+from util import pipeline
+from util import session
+from util.worker import ComputeScheduler
 from util.util import errorCheck, mask_color_img, check_extension, ConfigParams
 
 pg.setConfigOption('background', 'w')
@@ -58,6 +62,18 @@ class Main(QW.QMainWindow):
         exportAction.setIcon(Icon('upload.svg'))
         exportAction.triggered.connect(self.mainWidget.exportTrigger)
 
+        exportPipelineAction = QG.QAction("Export &Pipeline",self)
+        exportPipelineAction.setIcon(Icon('layers.svg'))
+        exportPipelineAction.triggered.connect(self.mainWidget.exportPipeline)
+
+        saveSessionAction = QG.QAction("&Save Session",self)
+        saveSessionAction.setIcon(Icon('save.svg'))
+        saveSessionAction.triggered.connect(self.mainWidget.saveSession)
+
+        loadSessionAction = QG.QAction("&Load Session",self)
+        loadSessionAction.setIcon(Icon('folder.svg'))
+        loadSessionAction.triggered.connect(self.mainWidget.loadSession)
+
         clearAction = QG.QAction("&Clear",self)
         clearAction.setIcon(Icon('trash.svg'))
         clearAction.triggered.connect(self.mainWidget.clear)
@@ -69,6 +85,9 @@ class Main(QW.QMainWindow):
         fileMenu = mainMenu.addMenu('&File')
         fileMenu.addAction(importAction)
         fileMenu.addAction(exportAction)
+        fileMenu.addAction(exportPipelineAction)
+        fileMenu.addAction(saveSessionAction)
+        fileMenu.addAction(loadSessionAction)
         fileMenu.addAction(clearAction)
         if mode == 'local':
             fileMenu.addAction(exitAction)
@@ -81,8 +100,13 @@ class Main(QW.QMainWindow):
         testImageAction.setIcon(Icon('image.svg'))
         testImageAction.triggered.connect(self.importTestImage)
 
+        cacheAction = QG.QAction("Result &Cache",self)
+        cacheAction.setIcon(Icon('database.svg'))
+        cacheAction.triggered.connect(self.showCacheDialog)
+
         helpMenu = mainMenu.addMenu('&Help')
         helpMenu.addAction(testImageAction)
+        helpMenu.addAction(cacheAction)
         helpMenu.addAction(aboutAction)
 
         self.show()
@@ -114,6 +138,25 @@ class Main(QW.QMainWindow):
         about_dialog.setInformativeText(about_text)
         about_dialog.exec()
 
+    def showCacheDialog(self):
+        """
+        Shows the hit / miss counters and size of the result cache (util.cache), with a button to clear it.
+        """
+        result_cache = cache.get_cache()
+        cache_dialog = QW.QMessageBox(self)
+        cache_dialog.setText("Result Cache")
+        cache_dialog.setWindowModality(QC.Qt.WindowModal)
+        if result_cache is None:
+            cache_dialog.setInformativeText("Caching is disabled (GSAIMAGE_CACHE=0).")
+            cache_dialog.exec()
+            return
+        cache_dialog.setInformativeText(result_cache.summary())
+        clearButton = cache_dialog.addButton("Clear Cache",QW.QMessageBox.DestructiveRole)
+        cache_dialog.addButton(QW.QMessageBox.Close)
+        cache_dialog.exec()
+        if cache_dialog.clickedButton() is clearButton:
+            result_cache.clear()
+
     def importTestImage(self):
         path = os.path.join(self.repo_dir,'data','test.tif')
         self.mainWidget.importImage(path)
@@ -124,6 +167,7 @@ class GSAImage(QW.QWidget):
         self.config = ConfigParams(mode=mode)
         self.workingDirectory = os.getcwd()
         self.controlWidth = 275
+        self.scheduler = ComputeScheduler(parent=self)
 
         if self.config.mode == 'nanohub':
             if 'TempGSA' not in os.listdir(self.workingDirectory):
@@ -248,6 +292,103 @@ class GSAImage(QW.QWidget):
     def exportTrigger(self):
         self.io_buttons.requestExportData()
 
+    def pipeline(self):
+        """
+        Returns the layer stack as a headless pipeline.Pipeline (used by the batch command). Every layer after
+        the initial image must be backed by a pipeline operator.
+        """
+        operators = []
+        for index in range(1,self.stackedControl.count()):
+            mod = self.stackedControl[index]
+            if mod.operator is None:
+                raise ValueError("Layer '%s' cannot be exported to a pipeline."%mod.__name__)
+            mod.update_operator()
+            operators.append(copy.deepcopy(mod.operator))
+        return pipeline.Pipeline(operators)
+
+    @errorCheck(error_text='Error exporting pipeline!')
+    def exportPipeline(self):
+        stack = self.pipeline()
+        default_name = "untitled_pipeline.json"
+        if self.config.mode == 'local':
+            name = QW.QFileDialog.getSaveFileName(None,
+                "Export Pipeline",
+                os.path.join(os.getcwd(),default_name),
+                "JSON File (*.json)",
+                "JSON File (*.json)")[0]
+            if name != '' and check_extension(name, [".json"]):
+                stack.save(name)
+        elif self.config.mode == 'nanohub':
+            stack.save(default_name)
+            subprocess.check_output('exportfile %s'%default_name,shell=True)
+
+    def to_dict(self):
+        """
+        Returns the state of every layer (see Modification.to_dict) for saving a session.
+        """
+        d = {}
+        d['@class'] = self.__class__.__name__
+        d['date'] = time.asctime()
+        d['title'] = self.windowTitle()
+        d['layers'] = [self.stackedControl[index].to_dict() for index in range(self.stackedControl.count())]
+        return d
+
+    def restore(self,d):
+        """
+        Rebuilds the layer stack from to_dict(). Saved outputs are used as the layer caches, so nothing is
+        recomputed. Layers that cannot be rebuilt from their parameters are restored as static images.
+        """
+        self.clear()
+        layers = d['layers']
+        if len(layers) == 0:
+            return
+        self.setWindowTitle(d.get('title',''))
+        mod = InitialImage(config=self.config,image=layers[0]['img_out'],width=self.controlWidth,scheduler=self.scheduler)
+        self.addMod(mod)
+        for layer in layers[1:]:
+            cls = globals().get(layer['@class'])
+            inputMod = self.stackedControl[self.stackedControl.count()-1]
+            if layer['operator'] is not None and isinstance(cls,type) and issubclass(cls,Modification):
+                mod = cls(config=self.config,inputMod=inputMod,width=self.controlWidth)
+                mod.restore(operator=pipeline.Operator.from_dict(layer['operator']),img_out=layer['img_out'])
+            else:
+                mod = InitialImage(config=self.config,image=layer['img_out'],width=self.controlWidth,scheduler=self.scheduler)
+                mod.__name__ = layer['name']
+            self.addMod(mod)
+
+    @errorCheck(error_text='Error saving session!')
+    def saveSession(self):
+        if self.stackedControl.count() == 0:
+            raise IOError("No image to save.")
+        default_name = "untitled"+session.EXTENSION
+        if self.config.mode == 'local':
+            name = QW.QFileDialog.getSaveFileName(None,
+                "Save Session",
+                os.path.join(os.getcwd(),default_name),
+                "GSAImage Session (*%s)"%session.EXTENSION,
+                "GSAImage Session (*%s)"%session.EXTENSION)[0]
+            if name != '' and check_extension(name, [session.EXTENSION]):
+                session.save(name,self.to_dict())
+        elif self.config.mode == 'nanohub':
+            session.save(default_name,self.to_dict())
+            subprocess.check_output('exportfile %s'%default_name,shell=True)
+
+    @errorCheck(error_text='Error loading session!')
+    def loadSession(self,filepath=None):
+        if filepath is None:
+            if self.config.mode == 'local':
+                filepath = QW.QFileDialog.getOpenFileName(None,
+                    "Load Session",
+                    os.getcwd(),
+                    "GSAImage Session (*%s)"%session.EXTENSION)[0]
+            elif self.config.mode == 'nanohub':
+                filepath = subprocess.check_output('importfile',shell=True).strip().decode("utf-8")
+        if not filepath:
+            return
+        if not zipfile.is_zipfile(filepath):
+            raise IOError("Cannot read session file %s"%filepath)
+        self.restore(session.load(filepath))
+
     # opens file specified by IO importClicked signal
     @errorCheck()
     def importImage(self,filepath):
@@ -257,7 +398,7 @@ class GSAImage(QW.QWidget):
         except:
             raise IOError("Cannot read file %s"%filepath)
         if isinstance(img,np.ndarray):
-            mod = InitialImage(config=self.config,image=img,width=self.controlWidth)
+            mod = InitialImage(config=self.config,image=img,width=self.controlWidth,scheduler=self.scheduler)
             self.setWindowTitle(os.path.basename(os.path.basename(filepath)))
             self.addMod(mod)
 
@@ -274,10 +415,12 @@ class GSAImage(QW.QWidget):
 
     @errorCheck()
     def clear(self):
+        self.scheduler.cancel()
         self.stackedControl.clear()
 
     def removeMod(self):
         if self.stackedControl.count()>0:
+            self.scheduler.cancel(self.stackedControl[self.stackedControl.count()-1])
             self.stackedControl.removeIndex(self.stackedControl.count()-1)
         if self.stackedControl.count()>0:
             self.stackedControl.setCurrentIndex(self.stackedControl.count()-1)
@@ -292,6 +435,7 @@ class GSAImage(QW.QWidget):
                     width=self.controlWidth)
             else:
                 raise ValueError("You need to import an image before adding layers.")
+            mod.invalidate()
         # Adds modification to stackedControl and display to stackedDisplay
         self.stackedDisplay.addWidget(mod.display())
         self.stackedControl.addWidget(
@@ -329,10 +473,23 @@ class Modification(QW.QScrollArea):
     Abstract class for defining modifications to an image. Modifications form a linked list with each object
     inheriting an input Modification. In this way, images are modified with sequential changes. 
 
+    Each Modification caches its output along with a version number. Changing a parameter only marks that
+    layer dirty (invalidate); the output is recomputed lazily the next time image() is called, which also
+    happens whenever the input Modification's version has changed.
+
+    Outputs are published read-only and shared with downstream layers without copying. Modifications that
+    need to change pixels build a new array (or ask for image(copy=True)) instead of writing in place.
+
+    Modifications backed by a pipeline operator can also be recomputed in the background (schedule), which is
+    used for continuously changing widgets such as sliders. The parameters are read on the GUI thread, the
+    operator runs on the document's ComputeScheduler and only the newest result is shown. While a widget is
+    being dragged, the operator can run as a preview on the level of the input's image pyramid that matches
+    the display resolution, with its kernel sizes rescaled to that level.
 
     config:             (ConfigParams) The config parameters for GSA widgets
     inputMod:           (Modification) The Modification that the current object inherits.
     width:              (int) Minimum widget width.
+    scheduler:          (ComputeScheduler) Runs background updates. Inherited from inputMod if None.
 
     Signals:
     imageChanged:       (np.ndarray) Signal sent when modification image changes. Returns new image.
@@ -342,7 +499,7 @@ class Modification(QW.QScrollArea):
     imageChanged = QC.pyqtSignal(object) # new image
     displayChanged = QC.pyqtSignal(object,object) # new display, old display
     __name__ = 'Modification'
-    def __init__(self,config,inputMod=None,width=None,parent=None):
+    def __init__(self,config,inputMod=None,width=None,scheduler=None,parent=None):
         super(Modification,self).__init__(parent=parent)
         self.config = config
         if isinstance(width,int):
@@ -350,13 +507,22 @@ class Modification(QW.QScrollArea):
         self.setWidgetResizable(True)
         self.setHorizontalScrollBarPolicy(QC.Qt.ScrollBarAlwaysOff)
         self.inputMod = inputMod
-
+        self.operator = None
+        if scheduler is None and isinstance(self.inputMod,Modification):
+            scheduler = self.inputMod.scheduler
+        self.scheduler = scheduler
+
+        self._version = 0
+        self._dirty = False
+        self._pyramid = None
         if isinstance(self.inputMod,Modification):
             self.img_out = self.inputMod.image()
+            self._input_version = self.inputMod.version()
         else:
             self.img_out = None
+            self._input_version = None
 
-        self._display = ImageWidget(self.image(copy=False))
+        self._display = ImageWidget(self.img_out)
         self.imageChanged.connect(self._display.setImage)
 
     def display(self):
@@ -386,6 +552,146 @@ class Modification(QW.QScrollArea):
     def emitImage(self):
         self.imageChanged.emit(self.image())
 
+    def version(self):
+        """
+        Returns the version of the cached output. It increases every time the output is recomputed or set.
+        """
+        return self._version
+
+    def invalidate(self):
+        """
+        Marks the cached output as stale. Downstream Modifications recompute once they see the new version.
+        """
+        self._dirty = True
+
+    def refresh(self):
+        """
+        Recomputes the output (update_image) if this layer is dirty or its input has a new version.
+        """
+        if isinstance(self.inputMod,Modification):
+            self.inputMod.refresh()
+            input_version = self.inputMod.version()
+        else:
+            input_version = None
+        if self._dirty or input_version != self._input_version:
+            self._dirty = False
+            self._input_version = input_version
+            self.update_image()
+            if self.img_out is not None:
+                self.img_out = pipeline.freeze(self.img_out)
+            self._version += 1
+
+    def modified(self,*args):
+        """
+        Slot for parameter widgets. Invalidates the cached output and updates the view.
+        """
+        if self.scheduler is not None:
+            self.scheduler.cancel(self)
+        self.invalidate()
+        self.update_view()
+
+    def pyramid(self,startImage=False):
+        """
+        Returns the image pyramid (pipeline.Pyramid) of image(startImage). Rebuilt when the image changes.
+        """
+        img = self.image(startImage=startImage)
+        if self._pyramid is None or self._pyramid.image is not img:
+            self._pyramid = pipeline.Pyramid(img)
+        return self._pyramid
+
+    def histogram(self):
+        """
+        Returns the 256 bin intensity histogram of the output. Computed once per version and shared with every
+        layer that asks for it (see pipeline.histogram).
+        """
+        return pipeline.histogram(self.image())
+
+    def previewLevel(self):
+        """
+        Returns the pyramid level that matches the on-screen resolution of the display (0 if the display
+        shows the image at full resolution or more).
+        """
+        display = self.display()
+        if not isinstance(display,ImageWidget):
+            return 0
+        pixelSize = min(display.viewBox().viewPixelSize())
+        if not np.isfinite(pixelSize) or pixelSize < 2:
+            return 0
+        return int(np.log2(pixelSize))
+
+    def schedule(self,*args,preview=False):
+        """
+        Slot for continuously changing parameter widgets. Computes the output on a worker thread and updates
+        the view once it is done; requests superseded by newer ones are dropped. If preview==True, only a
+        downsampled output matching the display resolution is computed and shown. Falls back to modified()
+        if there is no scheduler or operator.
+        """
+        if self.scheduler is None or self.operator is None or not isinstance(self.inputMod,Modification):
+            return self.modified()
+        self.update_operator()
+        level = self.previewLevel() if preview else 0
+        if level > 0:
+            pyramid = self.inputMod.pyramid()
+            self.scheduler.submit(
+                self,
+                self.operator.rescaled(pyramid.scale(level)),
+                args=(pyramid.level(level),),
+                callback=functools.partial(self._previewed,pyramid.image.shape))
+            return
+        self.scheduler.submit(
+            self,
+            self.compute,
+            args=(copy.deepcopy(self.operator),self.inputMod.image()),
+            callback=functools.partial(self._scheduled,self.inputMod.version()))
+
+    def _previewed(self,shape,img):
+        self.display().setPreview(img,shape)
+
+    def _scheduled(self,input_version,result):
+        self.setResult(result)
+        if self.img_out is not None:
+            self.img_out = pipeline.freeze(self.img_out)
+        self._dirty = False
+        self._input_version = input_version
+        self._version += 1
+        self.update_view()
+
+    def update_widgets(self):
+        """
+        (Optional) abstract function, the inverse of update_operator: shows self.operator's parameters in the
+        widgets without triggering an update.
+        """
+        pass
+
+    def to_dict(self):
+        """
+        Returns the state of the layer for saving a session: its operator parameters and its output.
+        """
+        if self.operator is not None:
+            self.update_operator()
+        d = {}
+        d['@class'] = self.__class__.__name__
+        d['name'] = self.__name__
+        d['operator'] = self.operator.to_dict() if self.operator is not None else None
+        d['img_out'] = self.image()
+        return d
+
+    def restore(self,operator=None,img_out=None):
+        """
+        Restores a saved layer. The operator (and the widgets showing its parameters) is replaced and
+        img_out is used as the cached output instead of recomputing it.
+        """
+        if operator is not None:
+            self.operator = operator
+            self.update_widgets()
+        if img_out is None:
+            self.invalidate()
+        else:
+            self.img_out = pipeline.freeze(img_out)
+            self._dirty = False
+            self._input_version = self.inputMod.version() if isinstance(self.inputMod,Modification) else None
+            self._version += 1
+
     def icon(self,qsize):
         """
         Returns a QIcon thumbnail of size dictated by QSize.
@@ -404,9 +710,10 @@ class Modification(QW.QScrollArea):
             return icon
         return QG.QIcon()
 
-    def image(self,startImage=False,copy=True):
+    def image(self,startImage=False,copy=False):
         """
         Returns the output image after modifications are applied. Or, if startImage==True, return starting image.
+        The returned array is read-only unless copy==True.
         """
         if startImage:
             if self.inputMod is not None:
@@ -414,6 +721,7 @@ class Modification(QW.QScrollArea):
             else:
                 return self.image(copy=copy)
         else:
+            self.refresh()
             if self.img_out is None:
                 return None
             if copy:
@@ -425,29 +733,52 @@ class Modification(QW.QScrollArea):
         """
         Sets the output image manually. Only necessary for initializing.
         """
-        self.img_out = img.astype(np.uint8)
+        self.img_out = pipeline.freeze(img.astype(np.uint8))
+        self._version += 1
         self.imageChanged.emit(self.img_out)
+    def update_operator(self):
+        """
+        (Optional) abstract function for copying the widget state into self.operator's parameters. Always
+        called on the GUI thread.
+        """
+        pass
+    def compute(self,operator,img):
+        """
+        Applies operator to img and returns the result. May run on a worker thread, so it must not touch
+        any widgets or attributes.
+        """
+        return operator(img)
+    def setResult(self,result):
+        """
+        Stores the result of compute() as the output.
+        """
+        self.img_out = result
     def update_image(self):
         """
         (Optional) abstract function for defining and applying modifications to the input image. This is
         used for running the calculations, etc. (not display functionality). It is useful to separate
-        the image updating from viewing in many cases which is why it is separate.
+        the image updating from viewing in many cases which is why it is separate. Called by refresh();
+        by default self.operator is applied to the input image, or the input image is passed through.
         """
-        pass
+        if isinstance(self.inputMod,Modification):
+            if self.operator is None:
+                self.img_out = self.inputMod.image()
+            else:
+                self.update_operator()
+                self.setResult(self.compute(self.operator,self.inputMod.image()))
     def update_view(self):
         """
         Updates the image display(s) and other widgets. Emits the update signal(s). Must be implemented
         in any subclass.
         """
-        self.update_image()
-        self.imageChanged.emit(self.img_out)
+        self.imageChanged.emit(self.image(copy=False))
 
 class InitialImage(Modification):
     __name__ = 'Initial Image'
     def __init__(self,image,*args,**kwargs):
         super(InitialImage,self).__init__(*args,**kwargs)
         if isinstance(image,np.ndarray):
-            self.img_out = image
+            self.img_out = pipeline.freeze(image)
             self.imageChanged.emit(self.img_out)
 
 class RemoveScale(Modification):
@@ -455,67 +786,27 @@ class RemoveScale(Modification):
     def __init__(self,*args,**kwargs):
         super(RemoveScale,self).__init__(*args,**kwargs)
         self.box = None
-
-    def crop_image(self,img,box):
-        pil_img = Image.fromarray(img)
-        return np.array(pil_img.crop(box))
+        self.operator = pipeline.RemoveScale()
 
     def update_image(self,scale_location='Auto',tol=0.95):
-        img_array = self.inputMod.image()
-        img = Image.fromarray(img_array)
-        width,height = img.size
-        crop_img = None
-        self.box = (0,0,width,height)
-        if scale_location == 'Bottom' or scale_location == 'Auto':
-            for row in range(height):
-                if np.mean(img_array[row,:]==0)>tol:
-                    self.box = (0,0,width,row)
-                    crop_img = img.crop(self.box)
-                    break
-        elif scale_location == 'Top' or scale_location == 'Auto':
-            for row in reversed(range(height)):
-                if np.mean(img_array[row,:]==0)>tol:
-                    self.box = (0,row,width,height)
-                    if scale_location == 'Top':
-                        crop_img = img.crop(self.box)
-                    elif scale_location == 'Auto' and np.multiply(*self.box.size)>np.multiply(*crop_img.size):
-                        crop_img = img.crop(self.box)
-                    break
-        elif scale_location == 'Right' or scale_location == 'Auto':
-            for col in range(width):
-                if np.mean(img_array[:,col]==0)>tol:
-                    self.box = (0,0,col,height)
-                    if scale_location == 'Right':
-                        crop_img = img.crop(self.box)
-                    elif scale_location == 'Auto' and np.multiply(*self.box.size)>np.multiply(*crop_img.size):
-                        crop_img = img.crop(self.box)
-                    break
-        elif scale_location == 'Left' or scale_location == 'Auto':
-            for col in reversed(range(width)):
-                if np.mean(img_array[:,col]==0)>tol:
-                    self.box = (col,0,width,height)
-                    if scale_location == 'Left':
-                        crop_img = img.crop(self.box)
-                    elif scale_location == 'Auto' and np.multiply(*self.box.size)>np.multiply(*crop_img.size):
-                        crop_img = img.crop(self.box)
-                    break
-        if crop_img:
-            self.img_out = np.array(crop_img)
-        else:
-            self.img_out = self.inputMod.image()
+        self.operator.set(scale_location=scale_location,tol=tol)
+        img = self.inputMod.image(copy=False)
+        self.box = self.operator.box(img)
+        self.img_out = pipeline.crop_view(img,self.box)
 
 class ColorMask(Modification):
     __name__ = 'Intensity Mask'
     def __init__(self,*args,**kwargs):
         super(ColorMask,self).__init__(*args,**kwargs)
         self.img_mask = None
-        self.img_hist = self.display().imageItem().getHistogram()
+        self.operator = pipeline.ColorMask()
+        self.img_hist = self.inputMod.histogram()
 
         self.histPlot = None
         self.lrItem = None
 
         self.histPlot = pg.PlotWidget()
-        self.histPlot.plot(*self.img_hist,
+        self.histPlot.plot(np.arange(256),self.img_hist,
             pen=pg.mkPen(color='k',width=5),
             fillLevel=0,
             brush=(0,0,255,150))
@@ -525,8 +816,8 @@ class ColorMask(Modification):
         self.histPlot.hideAxis('left')
 
         self.lrItem = pg.LinearRegionItem((0,255),bounds=(0,255))
-        self.lrItem.sigRegionChanged.connect(self.update_view)
-        self.lrItem.sigRegionChangeFinished.connect(self.update_view)
+        self.lrItem.sigRegionChanged.connect(lambda _: self.schedule(preview=True))
+        self.lrItem.sigRegionChangeFinished.connect(self.modified)
 
         self.histPlot.addItem(self.lrItem)
         self.histPlot.setMouseEnabled(False,False)
@@ -541,12 +832,20 @@ class ColorMask(Modification):
 
         layout.setAlignment(QC.Qt.AlignTop)
 
-    def update_image(self):
+    def update_operator(self):
         minVal, maxVal = self.lrItem.getRegion()
-        img = self.inputMod.image()
-        self.img_mask = np.zeros_like(img)
-        self.img_mask[np.logical_and(img>minVal,img<maxVal)] = 1
-        self.img_out = img*self.img_mask+(1-self.img_mask)*255
+        self.operator.set(min_val=minVal,max_val=maxVal)
+
+    def update_widgets(self):
+        self.lrItem.blockSignals(True)
+        self.lrItem.setRegion((self.operator.params.min_val,self.operator.params.max_val))
+        self.lrItem.blockSignals(False)
+
+    def compute(self,operator,img):
+        return operator.mask(img), operator(img)
+
+    def setResult(self,result):
+        self.img_mask, self.img_out = result
 
     def name(self):
         return 'Color Mask'
@@ -556,9 +855,15 @@ class CannyEdgeDetection(Modification):
     def __init__(self,*args,**kwargs):
         super(CannyEdgeDetection,self).__init__(*args,**kwargs)
 
-        self.low_thresh = int(max(self.inputMod.image().flatten())*.1)
-        self.high_thresh = int(max(self.inputMod.image().flatten())*.4)
         self.gauss_size = 5
+        self.auto = None
+        self.operator = pipeline.CannyEdgeDetection()
+        self.low_thresh, self.high_thresh = self.operator.thresholds(self.inputMod.image())
+
+        self.autoBox = QW.QComboBox()
+        self.autoBox.addItem('Manual',None)
+        self.autoBox.addItem('Otsu','otsu')
+        self.autoBox.addItem('Median','median')
 
         self.gaussEdit = QG.QLineEdit(str(self.gauss_size))
         self.gaussEdit.setValidator(QG.QIntValidator(3,51))
@@ -582,23 +887,32 @@ class CannyEdgeDetection(Modification):
 
         self.gaussEdit.returnPressed.connect(self._update_sliders)
         self.lowSlider.sliderReleased.connect(self._update_texts)
-        self.lowSlider.sliderMoved.connect(self._update_texts)
+        self.lowSlider.sliderMoved.connect(lambda _: self._update_texts(background=True))
         self.lowEdit.returnPressed.connect(self._update_sliders)
         self.highSlider.sliderReleased.connect(self._update_texts)
-        self.highSlider.sliderMoved.connect(self._update_texts)
+        self.highSlider.sliderMoved.connect(lambda _: self._update_texts(background=True))
         self.highEdit.returnPressed.connect(self._update_sliders)
+        self.autoBox.currentIndexChanged.connect(lambda _: self._update_auto())
 
         layout = QG.QGridLayout(self)
         layout.addWidget(QG.QLabel('Gaussian Size'),0,0)
         layout.addWidget(QG.QLabel('Low Threshold'),1,0)
         layout.addWidget(QG.QLabel('High Threshold'),3,0)
+        layout.addWidget(QG.QLabel('Thresholds'),5,0)
         layout.addWidget(self.gaussEdit,0,1)
         layout.addWidget(self.lowEdit,1,1)
         layout.addWidget(self.highEdit,3,1)
         layout.addWidget(self.lowSlider,2,0,1,2)
         layout.addWidget(self.highSlider,4,0,1,2)
+        layout.addWidget(self.autoBox,5,1)
         layout.setAlignment(QC.Qt.AlignTop)
 
+    def _update_auto(self):
+        self.auto = self.autoBox.currentData()
+        self.update_operator()
+        self.update_widgets()
+        self.modified()
+
     def _update_sliders(self):
         self.gauss_size = int('0'+self.gaussEdit.text())
         self.gauss_size = self.gauss_size + 1 if self.gauss_size % 2 == 0 else self.gauss_size
@@ -609,26 +923,49 @@ class CannyEdgeDetection(Modification):
         self.lowSlider.setSliderPosition(self.low_thresh)
         self.highSlider.setSliderPosition(self.high_thresh)
 
-        self.update_view()
+        self.modified()
 
-    def _update_texts(self):
+    def _update_texts(self,background=False):
         self.low_thresh = int(self.lowSlider.value())
         self.high_thresh = int(self.highSlider.value())
 
         self.lowEdit.setText(str(self.low_thresh))
         self.highEdit.setText(str(self.high_thresh))
 
-        self.update_view()
-
-    def update_image(self):
-        self.img_out = cv2.GaussianBlur(self.inputMod.image(),(self.gauss_size,self.gauss_size),0)
-        self.img_out = 255-cv2.Canny(self.img_out,self.low_thresh,self.high_thresh,L2gradient=True)
+        if background:
+            self.schedule(preview=True)
+        else:
+            self.modified()
+
+    def update_operator(self):
+        self.operator.set(
+            gauss_size=self.gauss_size,
+            low_thresh=self.low_thresh,
+            high_thresh=self.high_thresh,
+            auto=self.auto)
+
+    def update_widgets(self):
+        self.gauss_size = self.operator.params.gauss_size
+        self.auto = self.operator.params.auto
+        self.low_thresh, self.high_thresh = self.operator.thresholds(self.inputMod.image())
+        self.gaussEdit.setText(str(self.gauss_size))
+        self.lowEdit.setText(str(self.low_thresh))
+        self.highEdit.setText(str(self.high_thresh))
+        self.lowSlider.setSliderPosition(self.low_thresh)
+        self.highSlider.setSliderPosition(self.high_thresh)
+        self.autoBox.blockSignals(True)
+        self.autoBox.setCurrentIndex(max(self.autoBox.findData(self.auto),0))
+        self.autoBox.blockSignals(False)
+        # Thresholds follow the histogram of the input in the auto modes.
+        for widget in (self.lowEdit,self.highEdit,self.lowSlider,self.highSlider):
+            widget.setEnabled(self.auto is None)
 
 class Dilation(Modification):
     __name__ = "Dilation"
     def __init__(self,*args,**kwargs):
         super(Dilation,self).__init__(*args,**kwargs)
         self.size = 1
+        self.operator = pipeline.Dilation()
         self.sizeEdit = QG.QLineEdit(str(self.size))
         self.sizeEdit.setValidator(QG.QIntValidator(1,20))
         self.sizeEdit.setFixedWidth(60)
@@ -638,6 +975,7 @@ class Dilation(Modification):
         self.sizeSlider.setSliderPosition(int(self.size))
 
         self.sizeSlider.valueChanged.connect(self._update_texts)
+        self.sizeSlider.sliderReleased.connect(lambda: self.schedule())
         self.sizeEdit.returnPressed.connect(self._update_sliders)
 
         layout = QG.QGridLayout(self)
@@ -649,21 +987,29 @@ class Dilation(Modification):
     def _update_sliders(self):
         self.size = int('0'+self.sizeEdit.text())
         self.sizeSlider.setSliderPosition(self.size)
-        self.update_view()
+        self.modified()
 
     def _update_texts(self):
         self.size = int(self.sizeSlider.value())
         self.sizeEdit.setText(str(self.size))
-        self.update_view()
+        self.schedule(preview=self.sizeSlider.isSliderDown())
 
-    def update_image(self):
-        self.img_out = cv2.erode(self.inputMod.image(),np.ones((self.size,self.size),np.uint8),iterations=1)
+    def update_operator(self):
+        self.operator.set(size=self.size)
+
+    def update_widgets(self):
+        self.size = self.operator.params.size
+        self.sizeEdit.setText(str(self.size))
+        self.sizeSlider.blockSignals(True)
+        self.sizeSlider.setSliderPosition(self.size)
+        self.sizeSlider.blockSignals(False)
 
 class Erosion(Modification):
     __name__ = "Erosion"
     def __init__(self,*args,**kwargs):
         super(Erosion,self).__init__(*args,**kwargs)
         self.size = 1
+        self.operator = pipeline.Erosion()
         self.sizeEdit = QG.QLineEdit(str(self.size))
         self.sizeEdit.setValidator(QG.QIntValidator(1,20))
         self.sizeEdit.setFixedWidth(60)
@@ -673,6 +1019,7 @@ class Erosion(Modification):
         self.sizeSlider.setSliderPosition(int(self.size))
 
         self.sizeSlider.valueChanged.connect(self._update_texts)
+        self.sizeSlider.sliderReleased.connect(lambda: self.schedule())
         self.sizeEdit.returnPressed.connect(self._update_sliders)
 
         layout = QG.QGridLayout(self)
@@ -684,30 +1031,35 @@ class Erosion(Modification):
     def _update_sliders(self):
         self.size = int('0'+self.sizeEdit.text())
         self.sizeSlider.setSliderPosition(self.size)
-        self.update_view()
+        self.modified()
 
     def _update_texts(self):
         self.size = int(self.sizeSlider.value())
         self.sizeEdit.setText(str(self.size))
-        self.update_view()
+        self.schedule(preview=self.sizeSlider.isSliderDown())
 
-    def update_image(self):
-        self.img_out = cv2.dilate(self.inputMod.image(),np.ones((self.size,self.size),np.uint8),iterations=1)
+    def update_operator(self):
+        self.operator.set(size=self.size)
+
+    def update_widgets(self):
+        self.size = self.operator.params.size
+        self.sizeEdit.setText(str(self.size))
+        self.sizeSlider.blockSignals(True)
+        self.sizeSlider.setSliderPosition(self.size)
+        self.sizeSlider.blockSignals(False)
 
 class BinaryMask(Modification):
     __name__ = "Binary Mask"
     def __init__(self,*args,**kwargs):
         super(BinaryMask,self).__init__(*args,**kwargs)
-
-    def update_image(self):
-        self.img_out = self.inputMod.image()
-        self.img_out[self.img_out < 255] = 0
+        self.operator = pipeline.BinaryMask()
 
 class Blur(Modification):
     __name__ = "Blur"
     def __init__(self,*args,**kwargs):
         super(Blur,self).__init__(*args,**kwargs)
         self.gauss_size = 5
+        self.operator = pipeline.Blur()
         self.gaussEdit = QG.QLineEdit(str(self.gauss_size))
         self.gaussEdit.setFixedWidth(100)
         self.gaussEdit.setValidator(QG.QIntValidator(3,51))
@@ -717,14 +1069,18 @@ class Blur(Modification):
         layout.addWidget(self.gaussEdit,0,1)
         layout.setAlignment(QC.Qt.AlignTop)
 
-        self.gaussEdit.returnPressed.connect(self.update_view)
-        self.update_view()
+        self.gaussEdit.returnPressed.connect(self.modified)
+        self.modified()
 
-    def update_image(self):
+    def update_operator(self):
         self.gauss_size = int('0'+self.gaussEdit.text())
         self.gauss_size = self.gauss_size + 1 if self.gauss_size % 2 == 0 else self.gauss_size
         self.gaussEdit.setText(str(self.gauss_size))
-        self.img_out = cv2.GaussianBlur(self.inputMod.image(),(self.gauss_size,self.gauss_size),0)
+        self.operator.set(gauss_size=self.gauss_size)
+
+    def update_widgets(self):
+        self.gauss_size = self.operator.params.gauss_size
+        self.gaussEdit.setText(str(self.gauss_size))
 
 class MaskingModification(Modification):
     __name__ = "Filter Modification"
@@ -732,6 +1088,9 @@ class MaskingModification(Modification):
     def __init__(self,*args,maskLogic='or',**kwargs):
         Modification.__init__(self,*args,**kwargs)
         assert self.inputMod is not None and isinstance(self.inputMod.image(copy=False),np.ndarray)
+        self._maskKey = None
+        self._maskOutVersion = 0
+        self._imageKey = None
         self._mask = np.zeros_like(self.inputMod.image(copy=False),dtype=bool)
         self._mask_out = np.zeros_like(self.inputMod.image(copy=False),dtype=bool)
 
@@ -748,19 +1107,57 @@ class MaskingModification(Modification):
         # if isinstance(self.inputMod,MaskingModification):
         #     self.inputMod.maskChanged.connect(lambda _: self.mask(copy=False))
 
+    @property
+    def _mask(self):
+        return self.__mask
+
+    @_mask.setter
+    def _mask(self,mask):
+        self.__mask = mask
+        self.touchMask()
+
+    def touchMask(self):
+        """
+        Marks this layer's own mask as changed. Needed after editing self._mask in place; assigning it does this
+        automatically.
+        """
+        self._maskVersion = getattr(self,'_maskVersion',0)+1
+
+    def maskVersion(self):
+        """
+        Returns the version of the combined output mask (see mask). It increases every time it is recomputed.
+        """
+        self.mask(copy=False)
+        return self._maskOutVersion
+
     def emitMask(self):
         self.maskChanged.emit(self.mask(copy=False))
 
-    def image(self,*args,**kwargs):
+    def maskedImage(self):
+        """
+        Returns the image the output mask is applied to (the start image).
+        """
+        return super(MaskingModification,self).image(startImage=True)
+
+    def refresh(self):
+        """
+        Also applies the output mask to maskedImage, only when the mask or the input changed, or when the
+        output was just recomputed (which replaces the masked image).
+        """
+        version = self._version
+        super(MaskingModification,self).refresh()
         try:
-            self.img_out = super(MaskingModification,self).image(startImage=True)
-            self.img_out[~self.mask(copy=False).astype(bool)] = 255
+            img = self.maskedImage()
+            mask = self.mask(copy=False)
+            key = (self._maskOutVersion,self.inputMod.version())
+            if key != self._imageKey or self._version != version:
+                self.img_out = pipeline.freeze(np.where(mask.astype(bool),img,np.uint8(255)))
+                self._imageKey = key
+                self._version += 1
         except Exception as e:
             # print(e)
             pass
 
-        return super(MaskingModification,self).image(*args,**kwargs)
-
     def updateDisplay(self,mask=None):
         if mask is None:
             mask = self.mask(copy=False)
@@ -769,43 +1166,83 @@ class MaskingModification(Modification):
                 img=self.inputMod.image(startImage=True,copy=False), 
                 mask=mask))
         elif mask.dtype == int:
-            shaded_img = self.image(startImage=True,copy=True)
-            for label in sorted(np.unique(mask)):
-                if label == 0:
-                    continue
-                if label == 1:
-                    color = [0,0,255]
-                else:
-                    color = np.array(self.palette[(label-1)%len(self.palette)])*255
-                shaded_img = mask_color_img(
-                    img = shaded_img, 
-                    mask = mask==label,
-                    color = color)
-            self.display().setImage(shaded_img)
+            # All labels are blended in one palette lookup, whatever their number.
+            self.display().setImage(pipeline.overlay(
+                img=self.image(startImage=True,copy=False),
+                labels=mask,
+                colors=self.colors(int(mask.max()))))
         # elif mask.dtype == float:
         #     self.display().setImage(mask_color_img(
         #         img=self.inputMod.image(copy=False), 
         #         mask=mask,
         #         color=[255,0,0]))
 
+    def colors(self,n):
+        """
+        Returns the overlay colors of labels 1 to n of an integer mask: label 1 (the input mask) is blue, the
+        others cycle through the palette.
+        """
+        return [[0,0,255]]+[np.array(self.palette[(label-1)%len(self.palette)])*255 for label in range(2,n+1)]
+
+    def regionDisplay(self,rows,cols,mask):
+        """
+        Returns the displayed image (see updateDisplay) of the region rows x cols (slices) for a boolean mask of
+        that region.
+        """
+        img = self.inputMod.image(startImage=True,copy=False)[rows,cols]
+        return mask_color_img(img=img,mask=mask)
+
+    def updateMaskRegion(self,rows,cols):
+        """
+        Recombines the output mask (see mask) only inside the region rows x cols (slices) and returns that part.
+        Assumes the rest of the output mask is up to date. Counts as a recombination: the output mask version
+        increases, so the layers reading this one see the change.
+        """
+        if isinstance(self.inputMod,MaskingModification) and self._mask_out is not self._mask:
+            self._mask_out[rows,cols] = self.maskLogic(self.inputMod._mask_out[rows,cols],self._mask[rows,cols])
+        self._maskKey = self.maskKey()
+        self._maskOutVersion += 1
+        return self._mask_out[rows,cols]
+
+    def maskKey(self):
+        """
+        Returns what the output mask depends on: the versions of this layer's mask and of the input's output
+        mask, and maskLogic.
+        """
+        if isinstance(self.inputMod,MaskingModification):
+            return (self._maskVersion,self.inputMod._maskOutVersion,self.maskLogic)
+        return (self._maskVersion,None,self.maskLogic)
+
     def mask(self,copy=True,recursive=False):
+        """
+        Returns the output mask: this layer's mask combined (maskLogic) with the input layer's output mask.
+        The result is memoized and only recombined when this layer's mask, the input's output mask or maskLogic
+        changed (see touchMask / maskVersion), so calling it repeatedly, or on every layer of a stack, is cheap.
+        The input chain is always brought up to date, recursive is kept for compatibility.
+        """
         if isinstance(self.inputMod,MaskingModification):
-            if recursive:
-                mask_in = self.inputMod.mask(copy=False,recursive=True)
-            else:
-                mask_in = self.inputMod._mask_out
-            assert isinstance(mask_in,np.ndarray) and mask_in.shape==self._mask.shape
-            mask = self.maskLogic(mask_in,self._mask)
+            mask_in = self.inputMod.mask(copy=False)
         else:
-            mask = self._mask
+            mask_in = None
 
-        if self._mask.dtype==int:
-            mask = mask.astype(int)
-            idxs = self._mask>0
-            mask[idxs] = self._mask[idxs]+1
+        key = self.maskKey()
+        if key != self._maskKey:
+            if mask_in is not None:
+                assert isinstance(mask_in,np.ndarray) and mask_in.shape==self._mask.shape
+                mask = self.maskLogic(mask_in,self._mask)
+            else:
+                mask = self._mask
+
+            if self._mask.dtype==int:
+                mask = mask.astype(int)
+                idxs = self._mask>0
+                mask[idxs] = self._mask[idxs]+1
+
+            self._mask_out = mask
+            self._maskKey = key
+            self._maskOutVersion += 1
+        mask = self._mask_out
 
-        self._mask_out = mask
-        
         if copy:
             return mask.copy()
         else:
@@ -816,6 +1253,8 @@ class TemplateMatchingWidget(MaskingModification):
     def __init__(self,*args,**kwargs):
         super(TemplateMatchingWidget,self).__init__(maskLogic='or',*args,**kwargs)
         self.invert = False
+        self._response = None
+        self._responseKey = None
 
         self.threshSlider = QG.QSlider(QC.Qt.Horizontal)
         self.threshSlider.setMinimum(0)
@@ -827,6 +1266,11 @@ class TemplateMatchingWidget(MaskingModification):
         self.sizeSlider.setMaximum(30)
         self.sizeSlider.setSliderPosition(15)
 
+        # Number of template orientations matched over 0-60 degrees (hexagonal domains).
+        self.rotationsBox = QW.QSpinBox()
+        self.rotationsBox.setRange(1,12)
+        self.rotationsBox.setValue(1)
+
         self.invertSelection = QW.QPushButton('Invert Selection')
         self.invertSelection.setIcon(Icon('subtract.svg'))
 
@@ -846,49 +1290,116 @@ class TemplateMatchingWidget(MaskingModification):
         layout.addWidget(self.threshSlider,0,1)
         layout.addWidget(QW.QLabel("Template Size:"),1,0)
         layout.addWidget(self.sizeSlider,1,1)
-        layout.addWidget(self.invertSelection,2,0,1,2)
+        layout.addWidget(QW.QLabel("Rotations:"),2,0)
+        layout.addWidget(self.rotationsBox,2,1)
+        layout.addWidget(self.invertSelection,3,0,1,2)
         layout.setAlignment(QC.Qt.AlignTop)
         main_widget.setLayout(layout)
         
         self.setWidget(main_widget)
 
+        self.rotationsBox.valueChanged.connect(lambda _: self.update_view(background=True))
         self.invertSelection.clicked.connect(lambda: self.update_view(invert=True))
         self.sizeSlider.valueChanged.connect(lambda v: self.roi.setSize([2*v,2*v]))
-        self.roi.sigRegionChangeFinished.connect(lambda: self.update_view())
-        self.threshSlider.valueChanged.connect(lambda v: self.update_view(threshold=v))
-
-    def update_image(self,threshold=100,invert=False):
+        self.roi.sigRegionChanged.connect(lambda: self.update_view(background=True,preview=True))
+        self.roi.sigRegionChangeFinished.connect(lambda: self.update_view(background=True))
+        self.threshSlider.valueChanged.connect(lambda v: self.update_view(threshold=v,background=True))
+
+    @staticmethod
+    def matchPreview(img,template,scale,threshold=100,invert=False):
+        size = tuple(max(int(round(s*scale)),1) for s in template.shape[::-1])
+        template = cv2.resize(template,size,interpolation=cv2.INTER_AREA)
+        # Previews bypass the on-disk result cache, every drag step has a new template.
+        res = pipeline.match_template.__wrapped__(img,template)
+        mask = pipeline.template_mask(res,threshold=threshold,invert=invert)
+        return mask_color_img(img=img,mask=mask)
+
+    def template(self):
         img_in = self.image(startImage=True,copy=False)
         region = self.roi.getArrayRegion(img_in,self.display().imageItem()).astype(np.uint8)
-        x,y = region.shape
-        padded_image = cv2.copyMakeBorder(img_in,int(y/2-1),int(y/2),int(x/2-1),int(x/2),cv2.BORDER_REFLECT_101)
-        res = cv2.matchTemplate(padded_image,region,cv2.TM_SQDIFF_NORMED)
+        return img_in, region
 
-        threshold = np.logspace(-3,0,1000)[threshold-1]
-        
-        if invert:
-            self._mask = res >= threshold
-        else:
-            self._mask = res < threshold
+    @staticmethod
+    def respond(img,template,rotations=1):
+        """
+        Returns the response map of template, or the best response over its rotations.
+        """
+        if rotations > 1:
+            return pipeline.match_templates(img,template,rotations=rotations)[0]
+        return pipeline.match_template(img,template)
 
+    def responseKey(self):
+        """
+        Returns the state the response map depends on: the input layer's version, the contents of the template
+        and the number of rotations.
+        """
+        self.inputMod.refresh()
+        return (
+            self.inputMod.version(),
+            cache.digest(self.template()[1]),
+            self.rotationsBox.value())
+
+    def response(self):
+        """
+        Returns the response map of the ROI, recomputed only if responseKey() changed.
+        """
+        key = self.responseKey()
+        if self._responseKey != key:
+            self._response = self.respond(*self.template(),rotations=self.rotationsBox.value())
+            self._responseKey = key
+        return self._response
 
-    def update_view(self,threshold=None,invert=None):
+    def update_image(self,threshold=None,invert=None):
         if threshold is None:
-            threshold=self.threshSlider.value()
+            threshold = self.threshSlider.value()
         if invert is None:
             invert = self.invert
-        else:
-            self.invert = ~self.invert
-            invert = self.invert
+        self._mask = pipeline.template_mask(self.response(),threshold=threshold,invert=invert)
+
+    def update_view(self,threshold=None,invert=None,background=False,preview=False):
+        """
+        Threshold and invert changes only re-threshold the cached response map. ROI changes recompute it, on
+        the scheduler if background==True, or as a downsampled preview if preview==True.
+        """
+        if threshold is None:
+            threshold=self.threshSlider.value()
+        if invert is not None:
+            self.invert = not self.invert
+        invert = self.invert
+        level = self.previewLevel() if preview else 0
+        if level > 0 and self.scheduler is not None:
+            pyramid = self.pyramid(startImage=True)
+            self.scheduler.submit(
+                self,
+                self.matchPreview,
+                args=(pyramid.level(level),self.template()[1],pyramid.scale(level),threshold,invert),
+                callback=functools.partial(self._previewed,pyramid.image.shape))
+            return
+        if self.scheduler is not None:
+            self.scheduler.cancel(self)
+        key = self.responseKey()
+        if background and self.scheduler is not None and self._responseKey != key:
+            self.scheduler.submit(
+                self,
+                self.respond,
+                args=self.template()+(self.rotationsBox.value(),),
+                callback=functools.partial(self._responded,key))
+            return
         self.update_image(threshold=threshold,invert=invert)
         self.imageChanged.emit(self.image(copy=False))
         self.maskChanged.emit(self.mask(copy=False))
 
+    def _responded(self,key,res):
+        self._response = res
+        self._responseKey = key
+        self.update_view()
+
 class CustomFilter(MaskingModification):
     __name__ = "Custom Mask"
     def __init__(self,*args,maskLogic='or',maskVal=True,**kwargs):
         super(CustomFilter,self).__init__(maskLogic=maskLogic,*args,**kwargs)
         self.maskVal = maskVal
+        self._stroke = False
 
         self.sizeSlider = QG.QSlider(QC.Qt.Horizontal)
         self.sizeSlider.setMinimum(2)
@@ -907,31 +1418,62 @@ class CustomFilter(MaskingModification):
 
         self.display().imageItem().setDraw(True)
         self.display().imageItem().cursorUpdateSignal.connect(self.update_view)
-        self.display().imageItem().dragFinishedSignal.connect(lambda: self.imageChanged.emit(self.image(copy=False)))
+        self.display().imageItem().strokeFinishedSignal.connect(self.finishStroke)
         self.display().viewBox().sigResized.connect(lambda v: self.display().imageItem().updateCursor())
         self.display().viewBox().sigTransformChanged.connect(lambda v: self.display().imageItem().updateCursor())
 
+    # Patches drawn over the display during a stroke before it is redrawn in full.
+    MAX_REGIONS = 256
+
     def update_view(self,pos=None,scale=None,update_image=False):
+        """
+        Brush events only recombine the mask and redraw the display inside the brush's bounding box. The full
+        image and mask are updated once the stroke is finished (finishStroke).
+        """
         if self.display().imageItem().cursorRadius() is None:
             self.display().imageItem().updateCursor(self.sizeSlider.value())
         if pos is not None and scale is not None:
             shape = self._mask.shape
             ## Cursor position coordinate system is weird so adjustments are made.
             rr, cc = skcircle(shape[0]-pos[1],pos[0],self.sizeSlider.value()*scale,shape=shape)
+            if len(rr) == 0:
+                return
+            if not self._stroke:
+                # Brings the whole output mask up to date once per stroke.
+                self.mask(copy=False)
+                self._stroke = True
             self._mask[rr,cc] = self.maskVal
+            self.touchMask()
+
+            rows, cols = slice(rr.min(),rr.max()+1), slice(cc.min(),cc.max()+1)
+            mask = self.updateMaskRegion(rows,cols)
+            if self.display().regionCount() < self.MAX_REGIONS:
+                self.display().setRegion(self.regionDisplay(rows,cols,mask),rows.start,cols.start)
+            else:
+                self.emitAll()
 
             if update_image == True:
                 self.imageChanged.emit(self.image(copy=False))
         else:
-            self.imageChanged.emit(self.image(copy=False))
+            self.emitAll()
+
+    def emitAll(self):
+        self.imageChanged.emit(self.image(copy=False))
         self.maskChanged.emit(self.mask(copy=False))
 
+    def finishStroke(self):
+        self._stroke = False
+        self.emitAll()
+
 class EraseFilter(CustomFilter):
     __name__ = "Erase Mask"
     def __init__(self,*args,**kwargs):
         CustomFilter.__init__(self,maskLogic='and',maskVal=False,*args,**kwargs)
         self._mask = np.ones_like(self.inputMod.image(),dtype=bool)
 
+    def regionDisplay(self,rows,cols,mask):
+        return np.where(mask,self.inputMod.image(startImage=True,copy=False)[rows,cols],np.uint8(255))
+
 class ClusterFilter(MaskingModification):
     __name__ = "Abstract Cluster Filter"
     def __init__(self,maskLogic='or',*args,**kwargs):
@@ -943,39 +1485,19 @@ class ClusterFilter(MaskingModification):
         self.wsize_edit = QW.QLineEdit()
         self.wsize_edit.setValidator(QG.QIntValidator(1,50))
         self.wsize_edit.setText("15")
+        self.features_box = QW.QComboBox()
+        self.features_box.addItems(['Windows','Texture'])
         self.run_btn = QW.QPushButton("Run")
 
     def pad(self,img,wsize,stride=1):
-        height,width = img.shape
-        if stride == 'block':
-            adj = 0
-            stride = wsize
-        else:
-            adj = 1
-
-        px = wsize - height % stride - adj
-        if px % 2 == 0:
-            px = int(px/2)
-            px = (px,px)
-        else:
-            px = int((px-1)/2)
-            px = (px,px+1)
-
-        py = wsize - width % stride - adj
-        if py % 2 == 0:
-            py = int(py/2)
-            py = (py,py)
-        else:
-            py = int((py-1)/2)
-            py = (py,py+1)
-
-        return util.pad(img,pad_width=(px,py),mode='symmetric')
+        return pipeline.pad(img,wsize=wsize,stride=stride)
 
     def update_image(self):
-        selected_items = self.cluster_list.selectedItems()
-        self._mask = np.zeros_like(self.inputMod.image(copy=False),dtype=int)
-        for item in selected_items:
-            self._mask[self._clusters==item.data(QC.Qt.UserRole)] = item.data(QC.Qt.UserRole)
+        selected = [item.data(QC.Qt.UserRole) for item in self.cluster_list.selectedItems()]
+        if self._clusters is None:
+            self._mask = np.zeros_like(self.inputMod.image(copy=False),dtype=int)
+        else:
+            self._mask = pipeline.select_labels(self._clusters,selected,keep_labels=True)
 
     def update_view(self):
         self.update_image()
@@ -985,8 +1507,8 @@ class ClusterFilter(MaskingModification):
     def update_list(self):
         self.cluster_list.clear()
         if self._clusters is not None:
-            labels, counts = np.unique(self._clusters,return_counts=True)
-            fractions = np.round(counts/counts.sum(),3)
+            labels, fractions = pipeline.label_fractions(self._clusters)
+            fractions = np.round(fractions,3)
             order = np.argsort(fractions)[::-1]
 
             for label, fraction in zip(labels[order],fractions[order]):
@@ -1013,6 +1535,12 @@ class KMeansFilter(ClusterFilter):
         self.seed_edit.setValidator(QG.QIntValidator(1,1e6))
         self.seed_edit.setText(str(np.random.randint(1e6)))
 
+        # Clusters every number of clusters from 2 to # Clusters in one run.
+        self.sweep_btn = QW.QPushButton("Sweep")
+        self.sweep_list = QW.QListWidget()
+        self.sweep_list.setSelectionMode(QG.QAbstractItemView.SingleSelection)
+        self._sweep = None
+
         main_widget = QW.QWidget()
         layout = QG.QGridLayout(main_widget)
         layout.addWidget(QW.QLabel("Window Size:"),0,0)
@@ -1023,17 +1551,27 @@ class KMeansFilter(ClusterFilter):
         layout.addWidget(self.stride_edit,2,1)
         layout.addWidget(QW.QLabel("Random Seed:"),3,0)
         layout.addWidget(self.seed_edit,3,1)
-        layout.addWidget(self.run_btn,4,0)
-        layout.addWidget(BasicLabel('Clusters by Fractional Area:'),5,0,1,2)
-        layout.addWidget(self.cluster_list,6,0,1,2)
+        layout.addWidget(QW.QLabel("Features:"),4,0)
+        layout.addWidget(self.features_box,4,1)
+        layout.addWidget(self.run_btn,5,0)
+        layout.addWidget(self.sweep_btn,5,1)
+        layout.addWidget(BasicLabel('Clusters by Fractional Area:'),6,0,1,2)
+        layout.addWidget(self.cluster_list,7,0,1,2)
+        layout.addWidget(BasicLabel('Sweep (# Clusters: inertia, silhouette):'),8,0,1,2)
+        layout.addWidget(self.sweep_list,9,0,1,2)
         layout.setAlignment(QC.Qt.AlignTop)
         
         self.setWidget(main_widget)
 
         self.run_btn.clicked.connect(self.filter)
+        self.sweep_btn.clicked.connect(self.sweep)
         self.cluster_list.itemSelectionChanged.connect(self.update_view)
+        self.sweep_list.itemSelectionChanged.connect(self.pick_sweep)
 
-    def filter(self):
+    def parameters(self):
+        """
+        Returns the clustering parameters of the widgets, or None if they are invalid.
+        """
         wsize = int('0'+self.wsize_edit.text())
         if wsize % 2 == 0:
             wsize -= 1
@@ -1044,22 +1582,50 @@ class KMeansFilter(ClusterFilter):
         n_clusters = int('0'+self.n_clusters_edit.text())
 
         if n_clusters >= 2 and wsize >= 1 and stride >= 1:
-            kmeans = MiniBatchKMeans(
+            return dict(
+                wsize=wsize,
                 n_clusters=n_clusters,
-                random_state=int('0'+self.seed_edit.text()))
+                stride=stride,
+                seed=int('0'+self.seed_edit.text()),
+                features=self.features_box.currentText().lower())
+
+    def filter(self):
+        params = self.parameters()
+        if params is not None:
+            img_in = self.image(startImage=True,copy=False)
+            self._clusters = pipeline.kmeans_clusters(img_in,**params)
+
+            self.update_list()
+            self.update_view()
+
+    def sweep(self):
+        """
+        Clusters the input for 2 to # Clusters clusters (see pipeline.kmeans_sweep), lists the scores of every
+        number of clusters and picks the one with the best silhouette.
+        """
+        params = self.parameters()
+        if params is not None:
             img_in = self.image(startImage=True,copy=False)
-            X=util.view_as_windows(
-                self.pad(img_in,wsize=wsize,stride=stride),
-                window_shape=(wsize,wsize),
-                step=stride)
-            mask_dim = X.shape[:2]
-            X=X.reshape(-1,wsize**2)
-
-            kmeans = kmeans.fit(X)
-            mask = kmeans.labels_.reshape(*mask_dim)
-            mask = Image.fromarray(mask)
-            self._clusters = np.array(mask.resize(img_in.shape[::-1])).astype(np.uint8)+1
-            del X
+            params['max_clusters'] = params.pop('n_clusters')
+            self._sweep = pipeline.kmeans_sweep(img_in,**params)
+
+            labels, inertia, silhouette = self._sweep
+            self.sweep_list.clear()
+            for i in range(len(labels)):
+                item = QG.QListWidgetItem("%d: %.4g, %.3f"%(i+2,inertia[i],silhouette[i]))
+                item.setData(QC.Qt.UserRole,i)
+                self.sweep_list.addItem(item)
+            self.sweep_list.setCurrentRow(int(np.argmax(silhouette)))
+
+    def pick_sweep(self):
+        """
+        Shows the clusters of the selected number of clusters of the last sweep, without clustering again.
+        """
+        items = self.sweep_list.selectedItems()
+        if self._sweep is not None and items:
+            i = items[0].data(QC.Qt.UserRole)
+            self._clusters = self._sweep[0][i]
+            self.n_clusters_edit.setText(str(i+2))
 
             self.update_list()
             self.update_view()
@@ -1072,6 +1638,10 @@ class GMMFilter(ClusterFilter):
         self.n_components_edit.setValidator(QG.QIntValidator(2,20))
         self.n_components_edit.setText("2")
 
+        self.stride_edit = QW.QLineEdit()
+        self.stride_edit.setValidator(QG.QIntValidator(1,30))
+        self.stride_edit.setText("3")
+
         main_widget = QW.QWidget()
         layout = QG.QGridLayout(self)
         layout.setAlignment(QC.Qt.AlignTop)
@@ -1079,15 +1649,19 @@ class GMMFilter(ClusterFilter):
         layout.addWidget(self.wsize_edit,0,1)
         layout.addWidget(QW.QLabel("# Components:"),1,0)
         layout.addWidget(self.n_components_edit,1,1)
-        layout.addWidget(self.run_btn,2,0)
-        layout.addWidget(BasicLabel('Clusters by Fractional Area:'),3,0,1,2)
-        layout.addWidget(self.cluster_list,4,0,1,2)
+        layout.addWidget(QW.QLabel("Stride:"),2,0)
+        layout.addWidget(self.stride_edit,2,1)
+        layout.addWidget(QW.QLabel("Features:"),3,0)
+        layout.addWidget(self.features_box,3,1)
+        layout.addWidget(self.run_btn,4,0)
+        layout.addWidget(BasicLabel('Clusters by Fractional Area:'),5,0,1,2)
+        layout.addWidget(self.cluster_list,6,0,1,2)
         main_widget.setLayout(layout)
         
         self.setWidget(main_widget)
 
         self.run_btn.clicked.connect(self.filter)
-        self.cluster_list.itemSelectionChanged.connect(self.update_image)
+        self.cluster_list.itemSelectionChanged.connect(self.update_view)
 
     def filter(self):
         wsize = int('0'+self.wsize_edit.text())
@@ -1097,29 +1671,17 @@ class GMMFilter(ClusterFilter):
 
         n_components = int('0'+self.n_components_edit.text())
 
-        if n_components >= 2 and wsize >= 1:
-            img_in = self.image(startImage=True)
+        stride = int("0"+self.stride_edit.text())
 
-            gmm = GaussianMixture(
+        if n_components >= 2 and wsize >= 1 and stride >= 1:
+            img_in = self.image(startImage=True,copy=False)
+            self._clusters = pipeline.gmm_clusters(
+                img_in,
+                wsize=wsize,
                 n_components=n_components,
-                covariance_type='full',
-                n_init=10
-                )
-            X = util.view_as_blocks(
-                self.pad(img_in,wsize=wsize,stride='block'),
-                block_shape=(wsize,wsize)).reshape(-1,wsize**2)
-            gmm.fit(X)
-            del X
-            mod_img=util.view_as_windows(self.pad(img_in,wsize=wsize),window_shape=(wsize,wsize))
-
-            clusters = np.zeros(mod_img.shape[0]*mod_img.shape[1])
-            for i in range(mod_img.shape[0]):
-                x = mod_img[i,...].reshape(-1,wsize**2)
-                
-                d = x.shape[0]
-                clusters[i*d:(i+1)*d] = gmm.predict(x)
-
-            self._clusters = clusters.reshape(*img_in.shape).astype(np.uint8)+1
+                features=self.features_box.currentText().lower(),
+                stride=stride,
+                seed=0)
 
             self.update_list()
             self.update_view()
@@ -1131,7 +1693,7 @@ class FilterPattern(Modification):
         self.finalMask = {'mask':None}
         self.stackedControl = GStackedWidget(parent=self)
 
-        self.initialImage = InitialImage(config=self.config,image=self.inputMod.image())
+        self.initialImage = InitialImage(config=self.config,image=self.inputMod.image(),scheduler=self.scheduler)
         self.initialImage.imageChanged.connect(self.imageChanged.emit)
 
         self.imageWidgetStack = self.stackedControl.createGStackedWidget()
@@ -1139,7 +1701,7 @@ class FilterPattern(Modification):
 
         self._maskClasses = OrderedDict()
         self._maskClasses['Template Match'] = TemplateMatchingWidget
-        # self._maskClasses['Gaussian Mixture'] = GMMFilter
+        self._maskClasses['Gaussian Mixture'] = GMMFilter
         self._maskClasses['K-Means'] = KMeansFilter
         self._maskClasses['Custom'] = CustomFilter
         self._maskClasses['Erase'] = EraseFilter
@@ -1199,7 +1761,29 @@ class FilterPattern(Modification):
         else:
             return np.ones_like(self.image(),dtype=bool)
 
-    def image(self,startImage=False,copy=True):
+    def lastLayer(self):
+        """
+        Returns the last mask layer, or the initial image if there are none.
+        """
+        if self.stackedControl.count()>0:
+            return self.stackedControl[-1]
+        return self.initialImage
+
+    def version(self):
+        """
+        Returns the version of the output: the last mask layer's version (the initial image's if there are
+        none) along with this layer's own, which increases once a mask layer was added, removed or changed.
+        """
+        return (self._version,self.lastLayer().version())
+
+    def refresh(self):
+        """
+        Also brings the mask layers up to date, so version() is current.
+        """
+        super(FilterPattern,self).refresh()
+        self.lastLayer().refresh()
+
+    def image(self,startImage=False,copy=False):
         if hasattr(self,'stackedControl'): # added this because otherwise initializing the super class messes up.
             if startImage or self.stackedControl.count()==0:
                 return Modification.image(self.inputMod,startImage=startImage,copy=copy)
@@ -1231,9 +1815,13 @@ class FilterPattern(Modification):
                 config = self.config,
                 inputMod=self.initialImage)
 
+        # Invalidated first, so the layers reading this one see the new version when imageChanged is emitted.
+        mod.imageChanged.connect(lambda _: self.invalidate())
+        mod.maskChanged.connect(lambda _: self.invalidate())
         mod.imageChanged.connect(self.imageChanged.emit)
         mod.maskChanged.connect(lambda _: self.finalMask.update({'mask':self.mask()}))
 
+        self.invalidate()
         self.stackedControl.addWidget(mod,name=method)
         self.imageWidgetStack.addWidget(mod.display())
         self.stackedControl.setCurrentWidget(mod)
@@ -1242,6 +1830,7 @@ class FilterPattern(Modification):
     def delete(self):
         if self.stackedControl.count()>0:
             self.stackedControl.removeWidget(self.stackedControl[-1])
+            self.invalidate()
             self.emitImage()
 
     def export(self):
@@ -1271,6 +1860,7 @@ class Crop(Modification):
     __name__ = "Crop"
     def __init__(self,*args,**kwargs):
         super(Crop,self).__init__(*args,**kwargs)
+        self.operator = pipeline.Crop()
 
         self.croppedImage = ImageWidget()
         self.croppedImage.setImage(self.image(),levels=(0,255))
@@ -1288,23 +1878,35 @@ class Crop(Modification):
             maxBounds=self.displayImage.imageItem().boundingRect())
         self.roi.addScaleHandle(pos=(1,1),center=(0,0))
         self.displayImage.viewBox().addItem(self.roi)
-        self.roi.sigRegionChangeFinished.connect(self.update_view)
+        self.roi.sigRegionChangeFinished.connect(self.modified)
 
         layout = QG.QGridLayout(self)
         layout.addWidget(self.croppedImage,0,0)
         layout.setAlignment(QC.Qt.AlignTop)
 
-    def update_image(self):
-        img_item = self.displayImage.imageItem()
-        self.img_out = self.roi.getArrayRegion(img_item.image,img_item)
-        self.img_out = self.img_out.astype(np.uint8)
+    def update_operator(self):
+        # ROI coordinates are in view space where the displayed image is flipped vertically.
+        img = self.inputMod.image(copy=False)
+        x, y = self.roi.pos()
+        width, height = self.roi.size()
+        row = max(int(round(img.shape[0]-y-height)),0)
+        col = max(int(round(x)),0)
+        self.operator.set(row=row,col=col,height=int(round(height)),width=int(round(width)))
+
+    def update_widgets(self):
+        p = self.operator.params
+        img = self.inputMod.image()
+        height = img.shape[0]-p.row if p.height is None else p.height
+        width = img.shape[1]-p.col if p.width is None else p.width
+        self.roi.setPos((p.col,img.shape[0]-p.row-height),finish=False)
+        self.roi.setSize((width,height),finish=False)
 
 class DomainCenters(Modification):
     __name__ = "Domain Center Labeling"
     ## This modification is a container for DomainCentersMask so that DomainCentersMask.image functions properly.
     def __init__(self,*args,**kwargs):
         super(DomainCenters,self).__init__(*args,**kwargs)
-        self.initialImage = InitialImage(config=self.config,image=self.inputMod.image())
+        self.initialImage = InitialImage(config=self.config,image=self.inputMod.image(),scheduler=self.scheduler)
         self.widget = DomainCentersMask(config=self.config,inputMod=self.initialImage)
         self.setDisplay(self.widget.display(),connectSignal=False)
 
@@ -1317,6 +1919,9 @@ class DomainCentersMask(MaskingModification):
         super(DomainCentersMask,self).__init__(*args,**kwargs)
         self._data = {}
         self._data['Domain Center Coordinates'] = []
+        self.centers = pipeline.PointSet()
+        self._selected = None
+        self._mask = np.zeros_like(self.image(copy=False),dtype=int)
 
         self.model = QG.QStandardItemModel()
 
@@ -1332,14 +1937,21 @@ class DomainCentersMask(MaskingModification):
         self.deleteBtn.setIcon(Icon("minus.svg"))
         self.exportBtn = QW.QPushButton("Export")
         self.exportBtn.setIcon(Icon("download.svg"))
+        self.min_distance_edit = QW.QLineEdit()
+        self.min_distance_edit.setValidator(QG.QIntValidator(1,1000))
+        self.min_distance_edit.setText(str(self.RADIUS))
+        self.detectBtn = QW.QPushButton("Detect")
 
         main_widget = QW.QWidget()
 
         layer_layout = QG.QGridLayout(main_widget)
-        layer_layout.addWidget(QW.QLabel("Domain Center Coordinates:"),0,0)
-        layer_layout.addWidget(self.domain_list,1,0)
-        layer_layout.addWidget(self.deleteBtn,2,0)
-        layer_layout.addWidget(self.exportBtn,3,0)
+        layer_layout.addWidget(QW.QLabel("Min. Distance (px):"),0,0)
+        layer_layout.addWidget(self.min_distance_edit,0,1)
+        layer_layout.addWidget(self.detectBtn,1,0,1,2)
+        layer_layout.addWidget(QW.QLabel("Domain Center Coordinates:"),2,0,1,2)
+        layer_layout.addWidget(self.domain_list,3,0,1,2)
+        layer_layout.addWidget(self.deleteBtn,4,0,1,2)
+        layer_layout.addWidget(self.exportBtn,5,0,1,2)
         layer_layout.setAlignment(QC.Qt.AlignTop)
 
         self.setWidget(main_widget)
@@ -1349,11 +1961,13 @@ class DomainCentersMask(MaskingModification):
             lambda current,previous: self.update_view(index=current.row()) if current.isValid() else None)
         self.deleteBtn.clicked.connect(lambda: self.deleteDomain(self.domain_list.selectionModel().currentIndex().row()))
         self.exportBtn.clicked.connect(self.export)
+        self.detectBtn.clicked.connect(self.detect)
         self.display().imageItem().setDraw(True)
         self.display().imageItem().setEnableDrag(False)
         self.display().imageItem().cursorUpdateSignal.connect(self.update_view)
 
     def export(self):
+        self._data['Domain Center Coordinates'] = self.centers.tolist()
         default_name = "untitled.json"
         if self.config.mode == 'local':
             name = QW.QFileDialog.getSaveFileName(None, 
@@ -1373,39 +1987,101 @@ class DomainCentersMask(MaskingModification):
         else:
             return
 
+    # Radius of the domain disks and number of patches drawn over the display before it is redrawn in full.
+    RADIUS = 10
+    MAX_REGIONS = 256
+
     def deleteDomain(self,index=None):
         if index is not None and index>=0:
+            rows, cols = pipeline.disk_box(self.centers[index],self.RADIUS,self._mask.shape)
             self.model.takeRow(index)
-            self.update_view()
+            self.centers.remove(index)
+            if self._selected == index:
+                self._selected = None
+            elif self._selected is not None and self._selected > index:
+                self._selected -= 1
+            self.drawRegion(rows,cols)
+
+    def addItem(self,x,y):
+        row = self.model.rowCount()
+        item = QG.QStandardItem("(%d,%d)"%(x,y))
+        self.model.setItem(row,0,item)
+        item = QG.QStandardItem()
+        item.setData([x,y],QC.Qt.UserRole)
+        self.model.setItem(row,1,item)
+
+    @errorCheck(error_text='Error detecting domain centers!')
+    def detect(self):
+        """
+        Replaces the domains with the centers detected in the kept (non white) pixels of the layer below, see
+        pipeline.domain_centers. The detections can then be edited like hand placed domains.
+        """
+        min_distance = max(int("0"+self.min_distance_edit.text()),1)
+        centers = pipeline.domain_centers(self.image(startImage=True,copy=False)<255,min_distance=min_distance)
+        self.model.removeRows(0,self.model.rowCount())
+        self.centers = pipeline.PointSet(centers)
+        self._selected = None
+        for x, y in centers.tolist():
+            self.addItem(x,y)
+        self.update_view()
 
-    def update_view(self,pos=None,scale=None,index=None):
-        shape = self.image(copy=False).shape
-        if pos is not None:
-            x,y = shape[0]-pos[1],pos[0]
-            row = self.model.rowCount()
-            item = QG.QStandardItem("(%d,%d)"%(x,y))
-            self.model.setItem(row,0,item)
-            item = QG.QStandardItem()
-            item.setData([x,y],QC.Qt.UserRole)
-            self.model.setItem(row,1,item)
+    def drawRegion(self,rows,cols):
+        """
+        Redraws the region rows x cols (slices) of the mask (see stampRegion) and shows it over the display.
+        """
+        self.stampRegion(rows,cols)
+        if self.display().regionCount() < self.MAX_REGIONS:
+            self.display().setRegion(self.regionDisplay(rows,cols,self._mask[rows,cols]),rows.start,cols.start)
+        else:
+            self.updateDisplay(self._mask)
 
-        self._mask = np.zeros_like(self.image(copy=False),dtype=int)
-        for p in range(self.model.rowCount()):
-            x,y = self.model.item(p,1).data(QC.Qt.UserRole)
-            rr, cc = skcircle(x,y,10,shape=shape)
-            if index==p:
-                self._mask[rr,cc] = 2
-            else:
-                self._mask[rr,cc] = 1
+    def stampRegion(self,rows,cols):
+        """
+        Redraws the domains overlapping the region rows x cols (slices) into the mask, found with the centers'
+        KD-tree.
+        """
+        self._mask[rows,cols] = 0
+        center = ((rows.start+rows.stop-1)/2,(cols.start+cols.stop-1)/2)
+        reach = np.hypot(rows.stop-rows.start,cols.stop-cols.start)/2+self.RADIUS
+        # The selected domain is drawn last so it is highlighted whole.
+        for i in sorted(self.centers.near(center,reach),key=lambda i: i == self._selected):
+            footprint = pipeline.disk_mask(self.centers[i],self.RADIUS,rows,cols)
+            self._mask[rows,cols][footprint] = 2 if i == self._selected else 1
+        self.touchMask()
+
+    def regionDisplay(self,rows,cols,mask):
+        return pipeline.overlay(self.image(startImage=True,copy=False)[rows,cols],mask,self.colors(2))
 
-        self.updateDisplay(self._mask)
+    def update_view(self,pos=None,scale=None,index=None):
+        """
+        A click selects the domain under the cursor, found with the centers' KD-tree, or adds a domain there.
+        Adding, selecting or deleting a domain only redraws the bounding boxes of the disks involved.
+        """
+        shape = self._mask.shape
+        if pos is not None:
+            x,y = int(shape[0]-pos[1]),int(pos[0])
+            hit = self.centers.nearest((x,y),max_distance=self.RADIUS)
+            if hit is not None:
+                self.domain_list.setCurrentIndex(self.model.index(hit,0))
+                return
+            self.addItem(x,y)
+            self.centers.add((x,y))
+            self.drawRegion(*pipeline.disk_box((x,y),self.RADIUS,shape))
+        elif index is not None:
+            previous, self._selected = self._selected, index
+            for i in (previous,index):
+                if i is not None and 0 <= i < len(self.centers):
+                    self.drawRegion(*pipeline.disk_box(self.centers[i],self.RADIUS,shape))
+        else:
+            self.stampRegion(slice(0,shape[0]),slice(0,shape[1]))
+            self.updateDisplay(self._mask)
 
 class DrawScale(Modification):
     __name__ = "Draw Scale Bar"
     ## This modification is a container for DrawScaleMask so that DrawScale.image functions properly.
     def __init__(self,*args,**kwargs):
         super(DrawScale,self).__init__(*args,**kwargs)
-        self.initialImage = InitialImage(config=self.config,image=self.inputMod.image())
+        self.initialImage = InitialImage(config=self.config,image=self.inputMod.image(),scheduler=self.scheduler)
         self.widget = DrawScaleMask(config=self.config,inputMod=self.initialImage)
         self.setDisplay(self.widget.display(),connectSignal=False)
 
@@ -1525,18 +2201,12 @@ class Erase(EraseFilter):
                 img=self.inputMod.image(), 
                 mask=mask))
 
-    def update_view(self,pos=None,scale=None,update_image=True):
-        EraseFilter.update_view(self,pos,scale,update_image)
+    def regionDisplay(self,rows,cols,mask):
+        return np.where(mask,self.inputMod.image(copy=False)[rows,cols],np.uint8(255))
 
-    def image(self,*args,**kwargs):
-        try:
-            self.img_out = super(MaskingModification,self).image(startImage=False)
-            self.img_out[~self.mask(copy=False).astype(bool)] = 255
-        except Exception as e:
-            # print(e)
-            pass
-
-        return super(MaskingModification,self).image(*args,**kwargs)
+    def maskedImage(self):
+        # Erases from the input layer's output, not the start image.
+        return self.inputMod.image(copy=False)
 
 class AlignmentPlots(QW.QWidget):
     def __init__(self,*args,**kwargs):
@@ -1579,49 +2249,8 @@ class AlignmentPlots(QW.QWidget):
         self.sobelSizeSlider.valueChanged.connect(lambda _: self.update_view())
 
     def runSobel(self,images):
-        data_list = []
-        for image in images:
-            sobel_size = 2*int(self.sobelSizeSlider.value())+1
-            dx = cv2.Sobel(image,ddepth=cv2.CV_64F,dx=1,dy=0,ksize=sobel_size)
-            dy = cv2.Sobel(image,ddepth=cv2.CV_64F,dx=0,dy=1,ksize=sobel_size)
-
-            theta = np.arctan2(dy,dx)*180/np.pi
-            magnitude = np.sqrt(dx**2+dy**2)
-
-            values, bin_edges = np.histogram(
-                theta.flatten(),
-                weights=magnitude.flatten(),
-                bins=np.linspace(0,180,181),
-                density=True)
-
-            comb = np.zeros(120)
-            comb[0] = 1
-            comb[60] = 1
-            comb[-1] = 1
-            convolution = signal.convolve(values,comb,mode='valid')
-            convolution = convolution/sum(convolution)
-            
-            cos = np.average(np.cos(np.arange(len(convolution))*2*np.pi/60),weights=convolution)
-            sin = np.average(np.sin(np.arange(len(convolution))*2*np.pi/60),weights=convolution)
-            periodic_mean = np.round((np.arctan2(-sin,-cos)+np.pi)*60/2/np.pi).astype(int)
-            
-            convolution = np.roll(convolution,30-periodic_mean)
-            periodic_var = np.average((np.arange(len(convolution))-30)**2,weights=convolution)
-
-            data['Sobel Operator Output'] = {
-                "Sobel Operator Size": sobel_size, 
-                "Gradient Angle Array": theta.tolist(),
-                "Gradient Magnitude Array": magnitude.tolist()}
-            data['Edge Orientation Histogram'] = {"Bin Edges (deg)": bin_edges.tolist(), "Values": values.tolist()}
-            data['Angular Convolution'] = {
-                "Bin Edges (deg)": list(range(0,len(convolution)+1)), 
-                "Values": convolution.tolist(),
-                "Mean Shift": periodic_mean,
-                "Variance": periodic_var}
-
-            data_list.append(data)
-
-        return data_list
+        sobel_size = 2*int(self.sobelSizeSlider.value())+1
+        return [pipeline.alignment_data(image,ksize=sobel_size) for image in images]
 
     def update_view(self,images=None,colors=None):
         if images is not None and colors is not None:
@@ -1719,7 +2348,7 @@ class AlignmentSegmentation(Modification):
     def addSegment(self):
         seg = FilterPattern(
             config=self.config,
-            inputMod=InitialImage(config=self.config,image=self.image()))
+            inputMod=InitialImage(config=self.config,image=self.image(),scheduler=self.scheduler))
 
         seg.maskChanged.connect(lambda _: self.updateDisplay())
         self.imageWidgetStack.addWidget(seg.display())
@@ -1736,6 +2365,7 @@ class Alignment(Modification):
     def __init__(self,*args,**kwargs):
         super(Alignment,self).__init__(*args,**kwargs)
         self._data = {}
+        self.operator = pipeline.Alignment()
 
         self.sobelSizeSlider = QtGui.QSlider(QtCore.Qt.Horizontal)
         self.sobelSizeSlider.setMinimum(1)
@@ -1795,7 +2425,7 @@ class Alignment(Modification):
         layout.addWidget(self.wStd,2,1)
         layout.addWidget(self.exportBtn,4,0,1,2)
 
-        self.sobelSizeSlider.valueChanged.connect(self.update_view)
+        self.sobelSizeSlider.valueChanged.connect(lambda _: self.schedule())
         # self.colors.currentIndexChanged.connect(lambda x: self.update_view())
 
         # self.update_view()
@@ -1815,7 +2445,7 @@ class Alignment(Modification):
             "JSON (*.json)",
             "JSON (*.json)")[0]
         with open(filename,'w') as f:
-            json.dump(self._data,f)
+            json.dump(self._data,f,default=lambda a: a.tolist())
 
 
     @errorCheck(error_text="Error exporting item!")
@@ -1839,48 +2469,26 @@ class Alignment(Modification):
         else:
             return
 
-    def update_image(self):
-        sobel_size = 2*int(self.sobelSizeSlider.value())+1
-        self.dx = cv2.Sobel(self.inputMod.image(),ddepth=cv2.CV_64F,dx=1,dy=0,ksize=sobel_size)
-        self.dy = cv2.Sobel(self.inputMod.image(),ddepth=cv2.CV_64F,dx=0,dy=1,ksize=sobel_size)
+    def update_operator(self):
+        self.operator.set(ksize=2*int(self.sobelSizeSlider.value())+1)
 
+    def update_widgets(self):
+        self.sobelSizeSlider.blockSignals(True)
+        self.sobelSizeSlider.setSliderPosition((self.operator.params.ksize-1)//2)
+        self.sobelSizeSlider.blockSignals(False)
 
-        theta = np.arctan2(self.dy,self.dx)*180/np.pi
-        magnitude = np.sqrt(self.dx**2+self.dy**2)
+    def restore(self,operator=None,img_out=None):
+        # The orientation data is not saved, so it is recomputed.
+        super(Alignment,self).restore(operator=operator)
 
-        values, bin_edges = np.histogram(
-            theta.flatten(),
-            weights=magnitude.flatten(),
-            bins=np.linspace(0,180,181),
-            density=True)
+    def compute(self,operator,img):
+        return img, operator.data(img)
 
-        comb = np.zeros(120)
-        comb[0] = 1
-        comb[60] = 1
-        comb[-1] = 1
-        convolution = signal.convolve(values,comb,mode='valid')
-        convolution = convolution/sum(convolution)
-        
-        cos = np.average(np.cos(np.arange(len(convolution))*2*np.pi/60),weights=convolution)
-        sin = np.average(np.sin(np.arange(len(convolution))*2*np.pi/60),weights=convolution)
-        periodic_mean = np.round((np.arctan2(-sin,-cos)+np.pi)*60/2/np.pi).astype(int)
-        
-        convolution = np.roll(convolution,30-periodic_mean)
-        periodic_var = np.average((np.arange(len(convolution))-30)**2,weights=convolution)
-
-        self._data['Sobel Operator Output'] = {
-            "Sobel Operator Size": sobel_size, 
-            "Gradient Angle Array": theta.tolist(),
-            "Gradient Magnitude Array": magnitude.tolist()}
-        self._data['Edge Orientation Histogram'] = {"Bin Edges (deg)": bin_edges.tolist(), "Values": values.tolist()}
-        self._data['Angular Convolution'] = {
-            "Bin Edges (deg)": list(range(0,len(convolution)+1)), 
-            "Values": convolution.tolist(),
-            "Mean Shift": periodic_mean,
-            "Variance": periodic_var}
+    def setResult(self,result):
+        self.img_out, self._data = result
 
     def update_view(self):
-        self.update_image()
+        self.refresh()
         color = pg.mkColor('b')
         color.setAlpha(150)
 
@@ -1906,7 +2514,7 @@ class Alignment(Modification):
             pen=pg.mkPen(color='k',width=4))
         self.wStd.setNum(np.sqrt(self._data['Angular Convolution']["Variance"]))
 
-        self.imageChanged.emit(np.array(self._data['Sobel Operator Output']["Gradient Magnitude Array"]))
+        self.imageChanged.emit(self._data['Sobel Operator Output']["Gradient Magnitude Array"])
        
 def main():
     nargs = len(sys.argv)
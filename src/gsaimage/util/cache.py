@@ -0,0 +1,297 @@
+"""
+Content-addressed on-disk cache for expensive results (clustering, template matching, Hough transforms).
+
+Entries are keyed by a hash of the input arrays, the name of the computation and its parameters, so the
+same image processed with the same parameters reuses the stored result across sessions, GUI instances and
+batch jobs. Only results that took long enough to compute are stored: reading back a large result that is
+quick to recompute (e.g. a template response while dragging the ROI) costs more than it saves. The cache
+directory has a size cap; the least recently used entries are evicted first.
+
+The default cache is configured with environment variables:
+GSAIMAGE_CACHE:         Set to 0 to disable caching.
+GSAIMAGE_CACHE_DIR:     Cache directory (default ~/.cache/gsaimage).
+GSAIMAGE_CACHE_SIZE:    Size cap in MB (default 1024).
+GSAIMAGE_CACHE_MIN_TIME: Minimum computation time in seconds of a stored result (default 1).
+"""
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'),'.cache','gsaimage')
+DEFAULT_SIZE = 1024 # MB
+DEFAULT_MIN_TIME = 1. # s
+EXTENSIONS = ('.npy','.npz')
+
+# Returned by ResultCache.get when there is no entry.
+MISSING = object()
+
+# Digests of read-only arrays, which cannot change, keyed by id.
+_digests = {}
+
+def digest(array):
+    """
+    Returns the sha1 hex digest of an array's dtype, shape and contents. Memoized for read-only arrays.
+    """
+    entry = _digests.get(id(array))
+    if entry is not None and entry[0]() is array:
+        return entry[1]
+
+    h = hashlib.sha1()
+    h.update(str(array.dtype).encode())
+    h.update(str(array.shape).encode())
+    h.update(np.ascontiguousarray(array).data)
+    value = h.hexdigest()
+
+    if not array.flags.writeable:
+        try:
+            ref = weakref.ref(array,lambda r, i=id(array): _digests.pop(i,None))
+            _digests[id(array)] = (ref,value)
+        except TypeError:
+            pass
+    return value
+
+class ResultCache:
+    """
+    Cache of arrays (or tuples of arrays) stored as .npy / .npz files in a directory.
+
+    directory:          (str) Cache directory. Created if needed.
+    max_bytes:          (int) Size cap of the directory in bytes.
+    min_seconds:        (float) Results computed faster than this are not stored (see put).
+    """
+    def __init__(self,directory=DEFAULT_DIRECTORY,max_bytes=DEFAULT_SIZE*2**20,min_seconds=DEFAULT_MIN_TIME):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_seconds = min_seconds
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory,exist_ok=True)
+
+    def key(self,name,*args,**kwargs):
+        """
+        Returns the key for the computation name applied to args / kwargs. Arrays are hashed by content,
+        everything else by its JSON representation.
+        """
+        h = hashlib.sha1()
+        h.update(name.encode())
+        for value in list(args)+[kwargs[k] for k in sorted(kwargs)]:
+            if isinstance(value,np.ndarray):
+                h.update(digest(value).encode())
+            else:
+                h.update(json.dumps(value,sort_keys=True,default=repr).encode())
+        h.update(json.dumps(sorted(kwargs)).encode())
+        return h.hexdigest()
+
+    def _path(self,key,extension):
+        return os.path.join(self.directory,key+extension)
+
+    def get(self,key):
+        """
+        Returns the value stored under key, or MISSING.
+        """
+        for extension in EXTENSIONS:
+            path = self._path(key,extension)
+            try:
+                if extension == '.npy':
+                    value = np.load(path,allow_pickle=False)
+                else:
+                    with np.load(path,allow_pickle=False) as f:
+                        value = tuple(f['arr_%d'%i] for i in range(len(f.files)))
+                os.utime(path) # marks the entry as recently used
+            except (IOError,OSError,ValueError):
+                continue
+            with self._lock:
+                self.hits += 1
+            logger.debug("Cache hit: %s"%key)
+            return value
+        with self._lock:
+            self.misses += 1
+        logger.debug("Cache miss: %s"%key)
+        return MISSING
+
+    def put(self,key,value,seconds=None):
+        """
+        Stores an array or a tuple of arrays under key. Errors (e.g. a full disk) are logged and ignored.
+
+        seconds:        (float) Time it took to compute value. Values computed in less than min_seconds are
+                        not stored.
+        """
+        if seconds is not None and seconds < self.min_seconds:
+            with self._lock:
+                self.skipped += 1
+            return
+        if isinstance(value,np.ndarray):
+            extension = '.npy'
+        elif isinstance(value,(tuple,list)) and all(isinstance(v,np.ndarray) for v in value):
+            extension = '.npz'
+        else:
+            raise TypeError("Only arrays or tuples of arrays can be cached. Found type '%s'."%type(value))
+
+        path = self._path(key,extension)
+        tmp = '%s.%d.%d.tmp'%(path,os.getpid(),threading.get_ident())
+        try:
+            with open(tmp,'wb') as f:
+                if extension == '.npy':
+                    np.save(f,value,allow_pickle=False)
+                else:
+                    np.savez(f,*value)
+            os.replace(tmp,path)
+            size = os.path.getsize(path)
+        except (IOError,OSError) as e:
+            logger.warning("Could not write cache entry %s (%s)"%(path,e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            total = self.size()
+        if total > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """
+        Returns a list of (path, size, last use time) of every entry.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if os.path.splitext(name)[1] not in EXTENSIONS:
+                continue
+            path = os.path.join(self.directory,name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path,st.st_size,st.st_mtime))
+        return entries
+
+    def size(self):
+        """
+        Returns the total size of the entries in bytes.
+        """
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self.entries())
+        return self._size
+
+    def evict(self,max_bytes=None):
+        """
+        Removes the least recently used entries until the cache is below 90% of max_bytes.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = sorted(self.entries(),key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= 0.9*max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        with self._lock:
+            self._size = total
+
+    def clear(self):
+        self.evict(max_bytes=0)
+
+    def stats(self):
+        """
+        Returns a dictionary with the hit / miss counters of this process, the number of results not stored
+        since they were quick to compute, and the size of the cache.
+        """
+        entries = self.entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'skipped': self.skipped,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries)}
+
+    def summary(self,stats=None):
+        """
+        Returns stats() as text, or the given stats (e.g. with the counters summed over worker processes).
+        """
+        if stats is None:
+            stats = self.stats()
+        return (
+            "%(hits)d hits, %(misses)d misses (%(skipped)d not stored, quick to recompute). "%stats+
+            "%d entries, %.1f of %.0f MB in %s."%(
+                stats['entries'],stats['bytes']/2**20,self.max_bytes/2**20,self.directory))
+
+_cache = None
+
+def get_cache():
+    """
+    Returns the default ResultCache, or None if caching is disabled.
+    """
+    global _cache
+    if os.environ.get('GSAIMAGE_CACHE','1') == '0':
+        return None
+    if _cache is None:
+        try:
+            _cache = ResultCache(
+                directory=os.environ.get('GSAIMAGE_CACHE_DIR',DEFAULT_DIRECTORY),
+                max_bytes=int(float(os.environ.get('GSAIMAGE_CACHE_SIZE',DEFAULT_SIZE))*2**20),
+                min_seconds=float(os.environ.get('GSAIMAGE_CACHE_MIN_TIME',DEFAULT_MIN_TIME)))
+        except OSError as e:
+            logger.warning("Result cache disabled (%s)"%e)
+            os.environ['GSAIMAGE_CACHE'] = '0'
+            return None
+    return _cache
+
+def _call(name,compute,args,kwargs):
+    # compute() is cached under name and the arguments it depends on (args, kwargs).
+    cache = get_cache()
+    if cache is None:
+        return compute()
+    key = cache.key(name,*args,**kwargs)
+    value = cache.get(key)
+    if value is MISSING:
+        tic = time.perf_counter()
+        value = compute()
+        cache.put(key,value,seconds=time.perf_counter()-tic)
+    return value
+
+def cached(name,func,*args,**kwargs):
+    """
+    Returns func(*args,**kwargs), read from the default cache if the same computation (name) was already run
+    on the same arguments. The result is stored if it took at least the cache's min_seconds to compute.
+    """
+    return _call(name,lambda: func(*args,**kwargs),args,kwargs)
+
+def memoize(name=None,unless=None,ignore=()):
+    """
+    Decorator caching a function's results in the default cache.
+
+    name:               (str) Name of the computation in the key. Defaults to the function's qualified name.
+    unless:             (callable) Called with the bound arguments (dict); the cache is bypassed if it returns True.
+    ignore:             (tuple of str) Arguments left out of the key since they do not change the result (e.g.
+                        the number of worker processes).
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        key_name = name or "%s.%s"%(func.__module__.split('.')[-1],func.__qualname__)
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            bound = signature.bind(*args,**kwargs)
+            bound.apply_defaults()
+            if unless is not None and unless(bound.arguments):
+                return func(*args,**kwargs)
+            arguments = {key: value for key, value in bound.arguments.items() if key not in ignore}
+            return _call(key_name,lambda: func(*args,**kwargs),(),arguments)
+        return wrapper
+    return decorator
@@ -0,0 +1,346 @@
+"""
+Memory-bounded clustering of the sliding windows of an image.
+
+Clustering every wsize x wsize window of an image as a dense (windows, wsize**2) matrix needs hundreds of
+MB for a 2k image at stride 3 and tens of GB at stride 1. The functions here never materialize that matrix:
+models are fitted with partial_fit on batches of windows sampled at random positions, and labels are
+predicted over bands of window rows whose size is set by a memory budget.
+
+texture_features is a low-dimensional alternative to raw windows: a few box filtered statistics per pixel
+whose cost does not depend on the window size. Feature arrays (rows, cols, features) are handled like
+window views by the sampling and prediction functions.
+
+The default budget is configured with an environment variable:
+GSAIMAGE_MEMORY:        Memory budget of the clustering work arrays in MB (default 256).
+"""
+from __future__ import division
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from skimage import util
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+from sklearn.mixture import GaussianMixture
+
+DEFAULT_MEMORY = 256 # MB
+BATCH_SIZE = 4096
+MAX_SAMPLES = 2**19
+# Samples the scores of a cluster count sweep are measured on.
+EVALUATION_SAMPLES = 2048
+# Sample size and number of initializations of Gaussian mixture fits.
+MAX_GMM_SAMPLES = 8192
+GMM_INIT = 3
+# Window sizes of the texture features, relative to wsize.
+TEXTURE_SCALES = (0.25,0.5,1)
+
+def memory_budget(memory=None):
+    """
+    Returns the memory budget in bytes: memory (MB), or the GSAIMAGE_MEMORY default.
+    """
+    if memory is None:
+        memory = float(os.environ.get('GSAIMAGE_MEMORY',DEFAULT_MEMORY))
+    return int(memory*2**20)
+
+def windows(padded,wsize,stride=1):
+    """
+    Returns the (rows, cols, wsize, wsize) view of the wsize x wsize windows of padded, every stride pixels.
+    Nothing is copied.
+    """
+    return util.view_as_windows(padded,window_shape=(wsize,wsize),step=stride)
+
+def dense_bytes(shape,wsize,stride=1):
+    """
+    Returns the approximate memory needed to cluster every window of an image of shape at once: the copied
+    window matrix and its float64 conversion by scikit-learn.
+    """
+    n = (-(-shape[0]//stride))*(-(-shape[1]//stride))
+    return n*wsize**2*9
+
+def sample_windows(view,n,random_state):
+    """
+    Returns n samples (n, features) drawn uniformly from a window view, or any (rows, cols, ...) feature
+    array (float32).
+    """
+    rows = random_state.randint(view.shape[0],size=n)
+    cols = random_state.randint(view.shape[1],size=n)
+    return view[rows,cols].reshape(n,-1).astype(np.float32)
+
+def stratified_sample(view,n,random_state,strata=8):
+    """
+    Returns about n samples (float32) of a window view (or feature array), spread evenly over a strata x
+    strata grid of cells and drawn at random within each cell, so every part of the image is represented.
+    """
+    strata = max(min(strata,view.shape[0],view.shape[1]),1)
+    per_cell = -(-n//strata**2)
+    row_edges = np.linspace(0,view.shape[0],strata+1).astype(int)
+    col_edges = np.linspace(0,view.shape[1],strata+1).astype(int)
+    i = np.repeat(np.arange(strata),strata*per_cell)
+    j = np.tile(np.repeat(np.arange(strata),per_cell),strata)
+    rows = row_edges[i]+(random_state.random_sample(len(i))*(row_edges[i+1]-row_edges[i])).astype(int)
+    cols = col_edges[j]+(random_state.random_sample(len(j))*(col_edges[j+1]-col_edges[j])).astype(int)
+    return view[rows,cols].reshape(len(rows),-1).astype(np.float32)
+
+def band_rows(view,memory=None):
+    """
+    Returns the number of rows of a window view (or feature array) whose samples fit in the memory budget (at
+    least one).
+    """
+    features = int(np.prod(view.shape[2:]))
+    # Copy of the band, its float32 conversion and the working copies made by scikit-learn.
+    row_bytes = view.shape[1]*features*(view.itemsize+4+4)
+    return max(int(memory_budget(memory)//max(row_bytes,1)),1)
+
+def bands(view,memory=None):
+    """
+    Yields (start, stop, X) for bands of rows of a window view (or feature array), with X the (samples,
+    features) float32 matrix of the band. Bands are as large as the memory budget allows (at least one row).
+    """
+    features = int(np.prod(view.shape[2:]))
+    step = band_rows(view,memory=memory)
+    for start in range(0,view.shape[0],step):
+        stop = min(start+step,view.shape[0])
+        X = view[start:stop].reshape(-1,features).astype(np.float32)
+        yield start, stop, X
+
+def partial_fit(model,view,random_state,max_samples=MAX_SAMPLES,batch_size=BATCH_SIZE):
+    """
+    Fits model with partial_fit on random batches of samples of a window view (or feature array), seeing at
+    most max_samples samples (or as many as there are). Returns model.
+    """
+    total = min(max_samples,view.shape[0]*view.shape[1])
+    seen = 0
+    while seen < total:
+        n = min(batch_size,total-seen)
+        if seen == 0:
+            # The first batch initializes the centers, it must hold enough windows per cluster.
+            n = min(max(n,3*getattr(model,'n_clusters',1)),view.shape[0]*view.shape[1])
+        model.partial_fit(sample_windows(view,n,random_state))
+        seen += n
+    return model
+
+def predict(model,view,memory=None):
+    """
+    Returns the (rows, cols) label map of every window of a window view (or feature array), predicted band by
+    band.
+    """
+    labels = np.empty(view.shape[:2],dtype=np.int64)
+    for start, stop, X in bands(view,memory=memory):
+        labels[start:stop] = model.predict(X).reshape(stop-start,-1)
+    return labels
+
+# Estimated in-process prediction time (s) below which bands are not handed to worker processes, and the time
+# it takes to start them the first time.
+PARALLEL_MIN_SECONDS = 0.5
+POOL_STARTUP_SECONDS = 3.
+
+# (workers, executor) of the prediction worker processes, started on first use and reused by every call.
+_pool = None
+
+def pool(workers):
+    """
+    Returns the ProcessPoolExecutor of workers prediction processes, reusing the running one if it has as many
+    workers.
+    """
+    global _pool
+    if _pool is None or _pool[0] != workers:
+        if _pool is not None:
+            _pool[1].shutdown(wait=False)
+        # Worker processes are spawned, forking a process running Qt / BLAS threads is not safe.
+        context = multiprocessing.get_context('spawn')
+        _pool = (workers,ProcessPoolExecutor(max_workers=workers,mp_context=context))
+    return _pool[1]
+
+def _predict_rows(model,source,wsize,stride,memory):
+    view = windows(source,wsize,stride=stride) if wsize is not None else source
+    return predict(model,view,memory=memory)
+
+def parallel_predict(model,source,wsize=None,stride=1,memory=None,workers=None):
+    """
+    Returns the (rows, cols) label map of every window of source predicted by model, with the rows split
+    across a pool of worker processes (see pool). Each worker is sent the model and only the source rows its
+    windows cover.
+
+    A first band is predicted in this process and timed. The rest is predicted here as well if it is estimated
+    to take less than PARALLEL_MIN_SECONDS (plus POOL_STARTUP_SECONDS while the pool is not running), or if
+    there is a single worker.
+
+    source:             (np.ndarray) Padded image whose wsize x wsize windows (every stride pixels) are
+                        predicted, or a (rows, cols, features) feature array if wsize is None.
+    memory:             (float) Memory budget in MB (see memory_budget), shared by the workers.
+    workers:            (int) Number of processes. Defaults to the number of CPUs.
+    """
+    view = windows(source,wsize,stride=stride) if wsize is not None else source
+    rows = view.shape[0]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(min(workers,rows),1)
+
+    probe = max(min(band_rows(view,memory=memory),rows//16),1)
+    tic = time.perf_counter()
+    labels = [predict(model,view[:probe],memory=memory)]
+    estimate = (time.perf_counter()-tic)*(rows-probe)/probe
+    threshold = PARALLEL_MIN_SECONDS
+    if _pool is None or _pool[0] != workers:
+        threshold += POOL_STARTUP_SECONDS
+    if rows == probe:
+        return labels[0]
+    if workers == 1 or estimate < threshold:
+        labels.append(predict(model,view[probe:],memory=memory))
+        return np.concatenate(labels,axis=0)
+
+    step = -(-(rows-probe)//workers)
+    futures = []
+    for start in range(probe,rows,step):
+        stop = min(start+step,rows)
+        if wsize is not None:
+            part = source[start*stride:(stop-1)*stride+wsize]
+        else:
+            part = source[start:stop]
+        futures.append(pool(workers).submit(
+            _predict_rows,model,part,wsize,stride,memory_budget(memory)/workers/2**20))
+    labels += [future.result() for future in futures]
+    return np.concatenate(labels,axis=0)
+
+def streaming_kmeans(padded,wsize,n_clusters,stride=1,seed=None,memory=None,
+                     max_samples=MAX_SAMPLES,batch_size=BATCH_SIZE):
+    """
+    Clusters the wsize x wsize windows of padded (every stride pixels) with MiniBatchKMeans within a memory
+    budget. Returns the (rows, cols) label map of the windows (labels start at 0).
+
+    padded:             (np.ndarray) 2D image, padded so its windows cover the original image.
+    memory:             (float) Memory budget in MB of the prediction bands (see memory_budget).
+    max_samples:        (int) Number of sampled windows the model is fitted on.
+    batch_size:         (int) Windows per partial_fit call.
+    """
+    view = windows(padded,wsize,stride=stride)
+    return kmeans(view,n_clusters,seed=seed,memory=memory,max_samples=max_samples,batch_size=batch_size)[0]
+
+def texture_kmeans(img,wsize,n_clusters,stride=1,seed=None,memory=None,
+                   max_samples=MAX_SAMPLES,batch_size=BATCH_SIZE):
+    """
+    Clusters the texture features (see texture_features) of every stride-th pixel of img with MiniBatchKMeans.
+    Returns the (rows, cols) label map of those pixels (labels start at 0). See streaming_kmeans for the other
+    arguments.
+    """
+    view = texture_features(img,wsize)[::stride,::stride]
+    return kmeans(view,n_clusters,seed=seed,memory=memory,max_samples=max_samples,batch_size=batch_size)[0]
+
+def kmeans(view,n_clusters,seed=None,memory=None,init=None,dense=False,
+           max_samples=MAX_SAMPLES,batch_size=BATCH_SIZE):
+    """
+    Clusters a window view (or feature array) with MiniBatchKMeans and returns (labels, model), labels being
+    the (rows, cols) label map.
+
+    init:               (np.ndarray) Initial centers (n_clusters, features), e.g. from warm_init. Defaults to
+                        k-means++.
+    dense:              (bool) Fits on every sample at once (view must be contiguous), instead of streaming
+                        sampled batches (see partial_fit).
+    """
+    kwargs = {} if init is None else {'init': init, 'n_init': 1}
+    if dense:
+        X = view.reshape(-1,int(np.prod(view.shape[2:])))
+        model = MiniBatchKMeans(n_clusters=n_clusters,random_state=seed,**kwargs).fit(X)
+        return model.labels_.reshape(view.shape[:2]), model
+
+    model = MiniBatchKMeans(
+        n_clusters=n_clusters,
+        batch_size=batch_size,
+        random_state=seed,
+        **kwargs)
+    partial_fit(model,view,np.random.RandomState(seed),max_samples=max_samples,batch_size=batch_size)
+    return predict(model,view,memory=memory), model
+
+def warm_init(centers,X,n_clusters,random_state):
+    """
+    Returns n_clusters initial centers reusing previous centers: the n_clusters most spread out of them
+    (farthest point order), completed if needed by k-means++ draws from the samples X (far from the centers
+    chosen so far, with probability proportional to the squared distance).
+    """
+    centers = np.asarray(centers,dtype=np.float64)
+    X = np.asarray(X,dtype=np.float64)
+    chosen = [centers[0]]
+    d = ((centers-chosen[0])**2).sum(axis=1)
+    while len(chosen) < min(n_clusters,len(centers)):
+        i = int(np.argmax(d))
+        chosen.append(centers[i])
+        d = np.minimum(d,((centers-centers[i])**2).sum(axis=1))
+
+    d = np.min([((X-c)**2).sum(axis=1) for c in chosen],axis=0)
+    while len(chosen) < n_clusters:
+        total = d.sum()
+        i = random_state.choice(len(X),p=d/total) if total > 0 else random_state.randint(len(X))
+        chosen.append(X[i])
+        d = np.minimum(d,((X-X[i])**2).sum(axis=1))
+    return np.array(chosen)
+
+def sweep_kmeans(view,cluster_range,seed=None,memory=None,dense=False,samples=EVALUATION_SAMPLES):
+    """
+    Clusters a window view (or feature array) for every number of clusters in cluster_range (increasing), each
+    fit warm started from the centers of the previous one. Returns (labels, inertia, silhouette): the list of
+    label maps, and for every number of clusters the mean squared distance of the samples to their center
+    and the silhouette score, both measured on the same stratified sample of the view.
+    """
+    random_state = np.random.RandomState(seed)
+    X = stratified_sample(view,samples,random_state)
+    labels = []
+    inertia = []
+    silhouette = []
+    centers = None
+    for n_clusters in cluster_range:
+        init = None if centers is None else warm_init(centers,X,n_clusters,random_state)
+        label_map, model = kmeans(view,n_clusters,seed=seed,memory=memory,init=init,dense=dense)
+        centers = model.cluster_centers_
+        # Dense fits keep the samples' float64 conversion.
+        Xm = X.astype(centers.dtype,copy=False)
+        y = model.predict(Xm)
+        labels.append(label_map)
+        inertia.append(-model.score(Xm)/len(X))
+        silhouette.append(silhouette_score(X,y,random_state=seed) if len(np.unique(y)) > 1 else -1.)
+    return labels, np.array(inertia), np.array(silhouette)
+
+def texture_features(img,wsize,scales=TEXTURE_SCALES):
+    """
+    Returns (height, width, 4*len(scales)) float32 texture features of every pixel of a 2D image: the local
+    mean, standard deviation, gradient energy and orientation coherence (of the structure tensor) over windows
+    of size wsize*scale. Every feature is a box filter of a per-pixel quantity, so the cost per pixel does not
+    depend on the window size. Features are standardized to zero mean and unit variance.
+    """
+    img = img.astype(np.float32)
+    dx = cv2.Sobel(img,cv2.CV_32F,1,0,ksize=3,borderType=cv2.BORDER_REFLECT)
+    dy = cv2.Sobel(img,cv2.CV_32F,0,1,ksize=3,borderType=cv2.BORDER_REFLECT)
+    sources = [img,img*img,dx*dx,dy*dy,dx*dy]
+
+    features = []
+    for scale in scales:
+        size = max(int(wsize*scale)//2*2+1,3)
+        mean, sq, xx, yy, xy = [
+            cv2.boxFilter(src,-1,(size,size),normalize=True,borderType=cv2.BORDER_REFLECT) for src in sources]
+        std = np.sqrt(np.maximum(sq-mean*mean,0))
+        energy = xx+yy
+        coherence = np.sqrt((xx-yy)**2+4*xy*xy)/(energy+1e-6)
+        features += [mean,std,np.sqrt(energy),coherence]
+
+    features = np.dstack(features)
+    mu = features.reshape(-1,features.shape[2]).mean(axis=0)
+    sigma = features.reshape(-1,features.shape[2]).std(axis=0)
+    features -= mu
+    features /= np.where(sigma > 0,sigma,1)
+    return features
+
+def fit_gmm(view,n_components,seed=None,max_samples=MAX_GMM_SAMPLES,n_init=GMM_INIT):
+    """
+    Returns a full covariance GaussianMixture fitted on a stratified sample (see stratified_sample) of at most
+    max_samples windows of a window view (or feature array), with n_init initializations.
+    """
+    gmm = GaussianMixture(
+        n_components=n_components,
+        covariance_type='full',
+        n_init=n_init,
+        random_state=seed)
+    n = min(max_samples,view.shape[0]*view.shape[1])
+    return gmm.fit(stratified_sample(view,n,np.random.RandomState(seed)))
@@ -327,6 +327,8 @@ class ImageWidget(pg.GraphicsLayoutWidget):
         if image is None:
              image = 255*np.ones((764,764))
 
+        self._smart = smart
+        self._regions = []
         if smart:
             self._img_item = SmartImageItem(image)
         else:
@@ -345,8 +347,48 @@ class ImageWidget(pg.GraphicsLayoutWidget):
     def setImage(self,*args,**kwargs):
         if 'levels' not in kwargs.keys():
             kwargs['levels']=(0,255)
+        self.clearRegions()
+        self._img_item.resetTransform()
         self._img_item.setImage(*args,**kwargs)
 
+    def setRegion(self,image,top,left,**kwargs):
+        """
+        Draws image over the displayed image with its upper left corner at (top, left) in array coordinates,
+        without re-rendering the whole frame. Used for incremental updates such as brush strokes. The patches
+        are dropped by the next setImage.
+        """
+        if 'levels' not in kwargs.keys():
+            kwargs['levels']=(0,255)
+        height, width = image.shape[:2]
+        # Flipped like the displayed image: vertically by SmartImageItem, horizontally by ImageItem.
+        if self._smart:
+            image = image[::-1]
+            top = self._img_item.image.shape[0]-top-height
+        else:
+            image = image[:,::-1]
+            left = self._img_item.image.shape[1]-left-width
+        item = pg.ImageItem(image,**kwargs)
+        item.setParentItem(self._img_item)
+        item.setRect(QtCore.QRectF(left,top,width,height))
+        self._regions.append(item)
+
+    def regionCount(self):
+        return len(self._regions)
+
+    def clearRegions(self):
+        for item in self._regions:
+            if item.scene() is not None:
+                item.scene().removeItem(item)
+        self._regions = []
+
+    def setPreview(self,image,shape,**kwargs):
+        """
+        Shows a downsampled image stretched over the area of a full resolution image with the given shape.
+        The next call to setImage restores the normal scale.
+        """
+        self.setImage(image,**kwargs)
+        self._img_item.setRect(QtCore.QRectF(0,0,shape[1],shape[0]))
+
 class ControlImageWidget(QtWidgets.QWidget):
     def __init__(self,imageWidget,*args,**kwargs):
         super(ControlImageWidget,self).__init__(*args,**kwargs)
@@ -463,6 +505,7 @@ class DisplayWidgetFactory:
 class SmartImageItem(pg.ImageItem):
     cursorUpdateSignal = QC.pyqtSignal(object,float)
     dragFinishedSignal = QC.pyqtSignal()
+    strokeFinishedSignal = QC.pyqtSignal() # end of a drawing drag or a drawing click
     def __init__(self,*args,**kwargs):
         super(SmartImageItem,self).__init__(*args,**kwargs)
         self.base_cursor = self.cursor()
@@ -538,6 +581,7 @@ class SmartImageItem(pg.ImageItem):
             self.cursorUpdateSignal.emit(pos,self.scale)
             if ev.isFinish():
                 self.dragFinishedSignal.emit()
+                self.strokeFinishedSignal.emit()
 
     def mouseClickEvent(self, ev):
         if ev.button() == QC.Qt.RightButton:
@@ -547,6 +591,7 @@ class SmartImageItem(pg.ImageItem):
             pos = ev.pos()
             pos = [int(pos.x()),int(pos.y())]
             self.cursorUpdateSignal.emit(pos,self.scale)
+            self.strokeFinishedSignal.emit()
 
     def setEnableDrag(self,flag):
         assert isinstance(flag,bool)
@@ -0,0 +1,236 @@
+"""
+Template matching engine for many templates against one image.
+
+Computes the same TM_SQDIFF_NORMED response as cv2.matchTemplate (padded so the response has the shape of
+the image, see pipeline.match_template), either directly with OpenCV or by FFT correlation. The FFT path
+splits the image into overlapping blocks whose spectra are computed once per image, so every additional
+template (another ROI, rotation or scale) only costs one small template FFT and the inverse transforms.
+The local image energy needed for the normalization comes from an integral image, also computed once.
+"""
+from __future__ import division
+
+import weakref
+
+import cv2
+import numpy as np
+from scipy import fft
+
+# Rough costs in ns per output pixel, measured on 4000x4000 images; only used to pick a method. The FFT
+# costs are per log2(FFT size) and scaled by the block overlap: FFT_COST per template, SETUP_COST once per
+# image (block spectra and integral image).
+FFT_COST = 0.8
+SETUP_COST = 0.75
+DIRECT_COST = 30.
+
+def angles(rotations,max_angle=360):
+    """
+    Returns rotations angles (degrees) evenly spaced in [0, max_angle).
+    """
+    return [i*max_angle/rotations for i in range(max(rotations,1))]
+
+def rotated(template,angle):
+    """
+    Returns template rotated by angle (degrees, counterclockwise) about its center, with reflected borders.
+    """
+    if angle % 360 == 0:
+        return template
+    h, w = template.shape
+    M = cv2.getRotationMatrix2D(((w-1)/2,(h-1)/2),angle,1)
+    return cv2.warpAffine(template,M,(w,h),flags=cv2.INTER_LINEAR,borderMode=cv2.BORDER_REFLECT_101)
+
+def scaled(template,scale):
+    """
+    Returns template resized by scale (at least 1x1 pixel).
+    """
+    if scale == 1:
+        return template
+    size = tuple(max(int(round(s*scale)),1) for s in template.shape[::-1])
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    return cv2.resize(template,size,interpolation=interpolation)
+
+def template_set(templates,angles=(0,),scales=(1,)):
+    """
+    Returns every template (a 2D array or a list of them) at every rotation angle and scale.
+    """
+    if isinstance(templates,np.ndarray):
+        templates = [templates]
+    return [rotated(scaled(t,s),a) for t in templates for s in scales for a in angles]
+
+class TemplateMatcher:
+    """
+    TM_SQDIFF_NORMED matching of templates against one image, with the image side work (border padding,
+    integral image, block spectra) done once and reused for every template.
+
+    img:                (np.ndarray) 2D uint8 image.
+    max_size:           (int) Largest template side supported by the FFT path. Larger templates are matched
+                        directly.
+    block:              (int) Size of the output blocks of the FFT path.
+    """
+    def __init__(self,img,max_size=64,block=1024):
+        # Only the padded copy is kept: a reference to img would keep it alive in the matcher() cache.
+        self.shape = img.shape
+        self.max_size = max_size
+        self.border = max_size//2
+        self.padded = cv2.copyMakeBorder(img,*(self.border,)*4,cv2.BORDER_REFLECT_101)
+        # Blocks evenly split the image so the last one is not mostly zero padding.
+        n = max(self.padded.shape)
+        self.block = -(-n//-(-n//block))
+        self.fft_size = fft.next_fast_len(self.block+max_size-1,real=True)
+        self._sqsum = None
+        self._spectra = None
+        self._norms = {}
+
+    def sqsum(self):
+        """
+        Returns the integral image of the squared padded image (float64).
+        """
+        if self._sqsum is None:
+            self._sqsum = cv2.integral2(self.padded,sdepth=cv2.CV_64F,sqdepth=cv2.CV_64F)[1]
+        return self._sqsum
+
+    def spectra(self):
+        """
+        Returns {(row, col): spectrum} of the padded image blocks of size fft_size starting every block
+        pixels. Computed once.
+        """
+        if self._spectra is None:
+            L = self.fft_size
+            padded = self.padded.astype(np.float32)
+            self._spectra = {}
+            for row in range(0,padded.shape[0],self.block):
+                for col in range(0,padded.shape[1],self.block):
+                    self._spectra[(row,col)] = fft.rfft2(padded[row:row+L,col:col+L],s=(L,L),workers=-1)
+        return self._spectra
+
+    def norms(self,shape):
+        """
+        Returns the square root of the energy (sum of squares) of every image window of shape (height, width)
+        (float32), as used by the normalization. Cached per window shape.
+        """
+        if shape not in self._norms:
+            h, w = shape
+            H, W = self.shape
+            top, left = self._window(shape)
+            sq = self.sqsum()
+            energy = (
+                sq[top+h:top+h+H,left+w:left+w+W]-sq[top:top+H,left+w:left+w+W]
+                -sq[top+h:top+h+H,left:left+W]+sq[top:top+H,left:left+W])
+            self._norms[shape] = np.sqrt(np.maximum(energy,0)).astype(np.float32)
+        return self._norms[shape]
+
+    def method(self,template,count=1):
+        """
+        Returns 'fft' or 'direct', whichever is estimated to be faster for matching count templates of the
+        shape of template. The FFT setup is only paid once, so it wins for batches and once set up.
+        """
+        h, w = template.shape
+        if max(h,w) > self.max_size:
+            return 'direct'
+        scale = np.log2(self.fft_size**2)*(self.fft_size/self.block)**2
+        fft_cost = FFT_COST*scale
+        if self._spectra is None:
+            fft_cost += SETUP_COST*scale/count
+        return 'fft' if fft_cost < DIRECT_COST else 'direct'
+
+    def _window(self,shape):
+        # Offset of the response in the padded image, matching pipeline.match_template's border.
+        h, w = shape
+        return self.border-(h-1)//2, self.border-(w-1)//2
+
+    def image(self):
+        """
+        Returns the image (a view of the padded image).
+        """
+        H, W = self.shape
+        return self.padded[self.border:self.border+H,self.border:self.border+W]
+
+    def _direct(self,template):
+        h, w = template.shape
+        if max(h,w) > self.max_size:
+            padded = cv2.copyMakeBorder(self.image(),(h-1)//2,h//2,(w-1)//2,w//2,cv2.BORDER_REFLECT_101)
+        else:
+            top, left = self._window(template.shape)
+            H, W = self.shape
+            padded = self.padded[top:top+H+h-1,left:left+W+w-1]
+        return cv2.matchTemplate(padded,template,cv2.TM_SQDIFF_NORMED)
+
+    def _fft(self,template):
+        h, w = template.shape
+        H, W = self.shape
+        top, left = self._window(template.shape)
+        L, B = self.fft_size, self.block
+        t = template.astype(np.float32)
+        tnorm = float(np.sum(t.astype(np.float64)**2))
+        if tnorm == 0:
+            return np.ones((H,W),np.float32)
+
+        # Cross correlation of the padded image with the template, block by block.
+        conj = np.conj(fft.rfft2(t,s=(L,L),workers=-1))
+        rows, cols = top+H, left+W
+        corr = np.empty((rows,cols),np.float32)
+        for (row, col), spectrum in self.spectra().items():
+            if row >= rows or col >= cols:
+                continue
+            c = fft.irfft2(spectrum*conj,s=(L,L),workers=-1)
+            corr[row:row+B,col:col+B] = c[:min(B,rows-row),:min(B,cols-col)]
+        corr = corr[top:,left:]
+
+        # sum((t-i)^2)/sqrt(sum(t^2)*sum(i^2)), clipped to 1 like OpenCV (flat black windows give 1).
+        norms = self.norms(template.shape)
+        num = cv2.addWeighted(corr,-2.,cv2.multiply(norms,norms),1.,tnorm)
+        den = norms*np.float32(np.sqrt(tnorm))
+        with np.errstate(divide='ignore',invalid='ignore'):
+            res = np.divide(num,den,out=num)
+        return np.minimum(res,1,out=res)
+
+    def response(self,template,method='auto',count=1):
+        """
+        Returns the TM_SQDIFF_NORMED response of template, with the shape of the image.
+
+        method:         (str) 'fft', 'direct' or 'auto' (see method()).
+        count:          (int) Number of templates matched in the batch, for method=='auto'.
+        """
+        template = np.asarray(template,dtype=np.uint8)
+        if method == 'auto':
+            method = self.method(template,count=count)
+        if method == 'fft' and max(template.shape) <= self.max_size:
+            return self._fft(template)
+        return self._direct(template)
+
+    def best(self,templates,method='auto'):
+        """
+        Matches every template and returns (response, index): the pixelwise minimum response and the index
+        of the template reaching it.
+        """
+        best = None
+        index = None
+        for i, template in enumerate(templates):
+            res = self.response(template,method=method,count=len(templates)-i)
+            if best is None:
+                best = res
+                index = np.zeros(res.shape,np.uint16)
+            else:
+                index[res < best] = i
+                np.minimum(best,res,out=best)
+        return best, index
+
+# Matchers of read-only images, which cannot change, keyed by id.
+_matchers = {}
+
+def matcher(img,max_size=64):
+    """
+    Returns the TemplateMatcher for img. Memoized for read-only arrays so the block spectra are computed once
+    per input.
+    """
+    entry = _matchers.get(id(img))
+    if entry is not None and entry[0]() is img and entry[1].max_size >= max_size:
+        return entry[1]
+
+    m = TemplateMatcher(img,max_size=max_size)
+    if not img.flags.writeable:
+        try:
+            ref = weakref.ref(img,lambda r, i=id(img): _matchers.pop(i,None))
+            _matchers[id(img)] = (ref,m)
+        except TypeError:
+            pass
+    return m
@@ -0,0 +1,1030 @@
+"""
+Qt-free image operators used by the GSAImage Modification widgets.
+
+Every operator holds a parameter dataclass and applies its math to a plain NumPy array. The GUI
+widgets in gsaimage2.py only bind their sliders / line edits to these parameters, so the same code
+can be run headless (no QApplication) through a Pipeline.
+"""
+from __future__ import division
+
+import functools
+import json
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, field, replace
+
+import cv2
+import numpy as np
+from scipy import signal
+from scipy.spatial import cKDTree
+
+from . import cluster, matching
+from .cache import digest, memoize
+
+# Template matching threshold ticks (slider value -> TM_SQDIFF_NORMED cutoff)
+MATCH_THRESHOLDS = np.logspace(-3,0,1000)
+
+def freeze(img):
+    """
+    Marks img read-only and returns it. Used for outputs that are shared between stages without copying.
+    """
+    img.setflags(write=False)
+    return img
+
+def crop_view(img,box):
+    """
+    Returns the (left, upper, right, lower) box of img as a view.
+    """
+    left,upper,right,lower = box
+    return img[upper:lower,left:right]
+
+def scale_boxes(imgs,scale_location='Auto',tol=0.95):
+    """
+    Returns the (left, upper, right, lower) crop box that removes the scale bar of each image in a stack
+    (n, height, width). The scale bar is separated from the image by a line (row or column) with more than a
+    fraction tol of black pixels:
+        Bottom:     keeps the rows above the first black row.
+        Top:        keeps the rows from the last black row on.
+        Right:      keeps the columns left of the first black column.
+        Left:       keeps the columns from the last black column on.
+        Auto:       the box with the largest area among the sides where a line was found.
+    The black fractions of every row and column are computed once for all images and sides.
+    """
+    n, height, width = imgs.shape
+    # 255 where black. The OpenCV compare / reduce pair is several times faster than numpy here.
+    dark = cv2.compare(np.ascontiguousarray(imgs,dtype=np.uint8).reshape(n*height,width),0,cv2.CMP_EQ)
+    rows = cv2.reduce(dark,1,cv2.REDUCE_SUM,dtype=cv2.CV_32S).reshape(n,height) > tol*width*255
+    cols = np.stack([
+        cv2.reduce(dark[i*height:(i+1)*height],0,cv2.REDUCE_SUM,dtype=cv2.CV_32S).ravel()
+        for i in range(n)]) > tol*height*255
+    any_rows = rows.any(axis=1)
+    any_cols = cols.any(axis=1)
+    first_rows = rows.argmax(axis=1)
+    last_rows = height-1-rows[:,::-1].argmax(axis=1)
+    first_cols = cols.argmax(axis=1)
+    last_cols = width-1-cols[:,::-1].argmax(axis=1)
+
+    boxes = []
+    for i in range(n):
+        candidates = OrderedDict()
+        if any_rows[i]:
+            candidates['Bottom'] = (0,0,width,int(first_rows[i]))
+            candidates['Top'] = (0,int(last_rows[i]),width,height)
+        if any_cols[i]:
+            candidates['Right'] = (0,0,int(first_cols[i]),height)
+            candidates['Left'] = (int(last_cols[i]),0,width,height)
+
+        if scale_location == 'Auto' and candidates:
+            box = max(candidates.values(),key=lambda b: (b[2]-b[0])*(b[3]-b[1]))
+        else:
+            box = candidates.get(scale_location,(0,0,width,height))
+        boxes.append(box)
+    return boxes
+
+def _memoized(table,img,key,compute):
+    """
+    Returns compute(), memoized in table for img under key if img is read-only (and so cannot change).
+    Entries are keyed by id(img) and dropped with the image; only the latest key is kept per image.
+    """
+    if img.flags.writeable:
+        return compute()
+    entry = table.get(id(img))
+    if entry is not None and entry[0]() is img and entry[1] == key:
+        return entry[2]
+
+    value = compute()
+    try:
+        ref = weakref.ref(img,lambda r, i=id(img): table.pop(i,None))
+        table[id(img)] = (ref,key,value)
+    except TypeError:
+        pass
+    return value
+
+_histograms = {}
+
+def histogram(img):
+    """
+    Returns the 256 bin intensity histogram (np.int64) of a uint8 image. Memoized for read-only arrays, so
+    every layer and operator looking at the same (frozen) output shares one computation.
+    """
+    def compute():
+        hist = cv2.calcHist([img],[0],None,[256],[0,256]).ravel().astype(np.int64)
+        if not img.flags.writeable:
+            hist.setflags(write=False)
+        return hist
+    return _memoized(_histograms,img,None,compute)
+
+def otsu_threshold(hist):
+    """
+    Returns the Otsu threshold of a 256 bin histogram, i.e. the intensity maximizing the between class
+    variance.
+    """
+    p = hist/max(hist.sum(),1)
+    omega = np.cumsum(p)
+    mu = np.cumsum(p*np.arange(len(p)))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        sigma_b = (mu[-1]*omega-mu)**2/(omega*(1-omega))
+    return int(np.argmax(np.nan_to_num(sigma_b)))
+
+def median_intensity(hist):
+    """
+    Returns the median intensity of a 256 bin histogram.
+    """
+    return int(np.searchsorted(np.cumsum(hist),hist.sum()/2))
+
+def label_fractions(labels):
+    """
+    Returns (labels, fractions) of the labels present in a non-negative integer label image and the fraction
+    of pixels they cover, counted in one np.bincount pass.
+    """
+    counts = np.bincount(labels.ravel())
+    present = np.flatnonzero(counts)
+    return present, counts[present]/max(labels.size,1)
+
+def select_labels(labels,selected,keep_labels=False):
+    """
+    Returns the mask of the pixels of a non-negative integer label image whose label is in selected, with a
+    single lookup in a table indexed by label: boolean, or if keep_labels==True, the label itself (int) on
+    selected pixels and 0 elsewhere.
+    """
+    selected = np.asarray(list(selected),dtype=np.int64)
+    size = 256 if labels.dtype == np.uint8 else int(labels.max())+1
+    size = max(size,int(selected.max())+1 if selected.size else 0)
+    if keep_labels:
+        lut = np.zeros(size,dtype=int)
+        lut[selected] = selected
+    else:
+        lut = np.zeros(size,dtype=bool)
+        lut[selected] = True
+    return lut.take(labels)
+
+@functools.lru_cache(maxsize=32)
+def _overlay_lut(colors,alpha):
+    n = len(colors)+1
+    ramp = np.repeat(np.arange(256,dtype=np.uint8)[np.newaxis,:,np.newaxis],3,axis=2)
+    base = np.repeat(ramp,n,axis=0)
+    layer = base.copy()
+    layer[1:] = np.array(colors,dtype=np.uint8)[:,np.newaxis,:]
+    blended = cv2.addWeighted(layer,alpha,base,1-alpha,0)
+    packed = np.full((n*256,4),255,dtype=np.uint8)
+    packed[:,:3] = blended.reshape(n*256,3)
+    return freeze(packed.view(np.uint32).ravel())
+
+def overlay_lut(colors,alpha=0.3):
+    """
+    Returns the overlay palette of colors (list of RGB triplets) as a flat table of packed RGBA pixels
+    (np.uint32, read-only) indexed by label*256+intensity: label 0 is the plain gray image, label l the blend
+    of colors[l-1] with weight alpha (as cv2.addWeighted). Cached per palette.
+    """
+    # Colors are truncated to uint8 like an assignment to the image would.
+    colors = tuple(tuple(int(c) for c in np.asarray(color,dtype=np.float64).astype(np.uint8)) for color in colors)
+    return _overlay_lut(colors,float(alpha))
+
+def overlay(img,labels,colors,alpha=0.3):
+    """
+    Returns the RGB image of a 2D uint8 image with every labelled pixel blended with its label's color, in a
+    single table lookup whatever the number of labels.
+
+    img:                (np.ndarray) 2D uint8 image.
+    labels:             (np.ndarray) Boolean or integer array of the shape of img; 0 is not shaded, label l is
+                        shaded with colors[l-1].
+    colors:             (list) RGB triplets.
+    alpha:              (float) Weight of the colors.
+    """
+    lut = overlay_lut(colors,alpha=alpha)
+    dtype = np.uint16 if len(colors) < 256 else np.uint32
+    index = labels.astype(dtype)
+    index <<= 8
+    index |= img
+    out = lut.take(index)
+    return out.view(np.uint8).reshape(img.shape+(4,))[...,:3]
+
+class Pyramid:
+    """
+    Image pyramid built lazily with cv2.pyrDown. Level 0 is the image itself and every following level
+    halves both dimensions. Levels are read-only and cached once computed.
+
+    image:              (np.ndarray) Full resolution image.
+    """
+    def __init__(self,image):
+        self.image = image
+        self._levels = [image]
+
+    def level(self,n):
+        """
+        Returns level n, or the smallest level available if the image cannot be halved n times.
+        """
+        while len(self._levels) <= n and min(self._levels[-1].shape[:2]) >= 2:
+            self._levels.append(freeze(cv2.pyrDown(self._levels[-1])))
+        return self._levels[min(n,len(self._levels)-1)]
+
+    def scale(self,n):
+        """
+        Returns the size of level n relative to the full resolution image.
+        """
+        return self.level(n).shape[0]/self.image.shape[0]
+
+def pad(img,wsize,stride=1):
+    """
+    Symmetrically pads an image so that windows of size wsize (taken every stride pixels, or as
+    non-overlapping blocks if stride=='block') tile the whole image.
+    """
+    height,width = img.shape
+    if stride == 'block':
+        adj = 0
+        stride = wsize
+    else:
+        adj = 1
+
+    px = wsize - height % stride - adj
+    if px % 2 == 0:
+        px = int(px/2)
+        px = (px,px)
+    else:
+        px = int((px-1)/2)
+        px = (px,px+1)
+
+    py = wsize - width % stride - adj
+    if py % 2 == 0:
+        py = int(py/2)
+        py = (py,py)
+    else:
+        py = int((py-1)/2)
+        py = (py,py+1)
+
+    return np.pad(img,pad_width=(px,py),mode='symmetric')
+
+_cluster_views = {}
+
+def cluster_view(img,wsize,stride=1,features='windows',memory=None):
+    """
+    Returns (view, dense): the (rows, cols, ...) array of the samples clustered for the wsize x wsize windows of
+    img taken every stride pixels, and whether it fits in the memory budget (MB, see cluster.memory_budget)
+    to be clustered at once. The samples are the window pixels (a contiguous copy if dense, else a view) or
+    their texture features (cluster.texture_features) if features=='texture'. Memoized for read-only images,
+    so clustering the same input again with other numbers of clusters or seeds skips the extraction.
+    """
+    def compute():
+        if features == 'texture':
+            return freeze(cluster.texture_features(img,wsize)[::stride,::stride]), False
+        view = cluster.windows(pad(img,wsize=wsize,stride=stride),wsize,stride=stride)
+        if cluster.dense_bytes(img.shape,wsize,stride) > cluster.memory_budget(memory):
+            return view, False
+        return freeze(np.ascontiguousarray(view)), True
+    return _memoized(_cluster_views,img,(wsize,stride,features,memory),compute)
+
+@memoize(unless=lambda args: args['seed'] is None)
+def kmeans_clusters(img,wsize,n_clusters,stride=1,seed=None,memory=None,features='windows'):
+    """
+    Clusters the wsize x wsize windows of an image with MiniBatchKMeans. Returns a uint8 label image
+    the same shape as img with labels starting at 1. If the window matrix would not fit in the memory budget
+    (MB, see cluster.memory_budget), the windows are clustered in streaming mode (cluster.kmeans).
+    If features=='texture', the texture features of the windows are clustered instead of their pixels
+    (cluster.texture_features), whose cost does not depend on wsize.
+    """
+    view, dense = cluster_view(img,wsize,stride=stride,features=features,memory=memory)
+    labels = cluster.kmeans(view,n_clusters,seed=seed,memory=memory,dense=dense)[0].astype(np.uint8)
+    return cv2.resize(labels,img.shape[::-1],interpolation=cv2.INTER_NEAREST)+1
+
+@memoize(unless=lambda args: args['seed'] is None)
+def kmeans_sweep(img,wsize,max_clusters,stride=1,seed=None,memory=None,features='windows'):
+    """
+    Clusters the windows of an image (see kmeans_clusters) for every number of clusters from 2 to max_clusters,
+    each fit warm started from the previous centers (cluster.sweep_kmeans). Returns (labels, inertia,
+    silhouette): the (max_clusters-1, height, width) uint8 stack of label images (labels starting at 1), and
+    the inertia (mean squared distance to the centers) and silhouette score of every number of clusters.
+    """
+    view, dense = cluster_view(img,wsize,stride=stride,features=features,memory=memory)
+    labels, inertia, silhouette = cluster.sweep_kmeans(
+        view,range(2,max_clusters+1),seed=seed,memory=memory,dense=dense)
+    labels = np.stack([
+        cv2.resize(l.astype(np.uint8),img.shape[::-1],interpolation=cv2.INTER_NEAREST)+1 for l in labels])
+    return labels, inertia, silhouette
+
+@memoize(unless=lambda args: args['seed'] is None,ignore=('memory','workers'))
+def gmm_clusters(img,wsize,n_components,features='windows',stride=1,seed=None,memory=None,workers=None):
+    """
+    Fits a GaussianMixture on a stratified sample of the wsize x wsize windows of an image and predicts a
+    label for every stride-th pixel's window, over memory-bounded bands spread across worker processes when the
+    image is large enough (see cluster.fit_gmm and cluster.parallel_predict). Returns a uint8 label image the same shape as img with
+    labels starting at 1. If features=='texture', the texture features (cluster.texture_features) of the
+    windows are used instead of their pixels.
+    """
+    if features == 'texture':
+        source = cluster.texture_features(img,wsize)[::stride,::stride]
+        view, wsize = source, None
+    else:
+        source = pad(img,wsize=wsize,stride=stride)
+        view = cluster.windows(source,wsize,stride=stride)
+    gmm = cluster.fit_gmm(view,n_components,seed=seed)
+    labels = cluster.parallel_predict(
+        gmm,source,wsize=wsize,stride=stride,memory=memory,workers=workers).astype(np.uint8)
+    return cv2.resize(labels,img.shape[::-1],interpolation=cv2.INTER_NEAREST)+1
+
+@memoize()
+def match_template(img,template):
+    """
+    Returns the TM_SQDIFF_NORMED response of template over img, padded so the response has the
+    same shape as img.
+    """
+    h,w = template.shape
+    padded_image = cv2.copyMakeBorder(img,(h-1)//2,h//2,(w-1)//2,w//2,cv2.BORDER_REFLECT_101)
+    return cv2.matchTemplate(padded_image,template,cv2.TM_SQDIFF_NORMED)
+
+@memoize()
+def match_templates(img,template,rotations=1,max_angle=60,scales=(1,)):
+    """
+    Matches template rotated rotations times over [0, max_angle) degrees and resized by every scale (see
+    util.matching) in one pass sharing the image's FFT. Returns (response, index): the lowest TM_SQDIFF_NORMED
+    response of every pixel and the index of the template variant reaching it.
+    """
+    templates = matching.template_set(template,angles=matching.angles(rotations,max_angle),scales=scales)
+    size = max(max(t.shape) for t in templates)
+    return matching.matcher(img,max_size=max(64,size)).best(templates)
+
+def template_mask(res,threshold=100,invert=False):
+    """
+    Thresholds a match_template response. threshold is the slider tick indexing MATCH_THRESHOLDS.
+    """
+    threshold = MATCH_THRESHOLDS[threshold-1]
+    if invert:
+        return res >= threshold
+    else:
+        return res < threshold
+
+def disk_box(center,radius,shape):
+    """
+    Returns the (rows, cols) slices of the bounding box of the disk of radius around center (row, col),
+    clipped to an image of shape.
+    """
+    row, col = center
+    rows = slice(max(int(row)-radius+1,0),min(int(row)+radius,shape[0]))
+    cols = slice(max(int(col)-radius+1,0),min(int(col)+radius,shape[1]))
+    return rows, cols
+
+def disk_mask(center,radius,rows,cols):
+    """
+    Returns the boolean footprint, inside the box rows x cols (slices), of the pixels closer than radius to
+    center (row, col), the same pixels as skimage.draw.disk.
+    """
+    rr, cc = np.ogrid[rows,cols]
+    return (rr-center[0])**2+(cc-center[1])**2 < radius**2
+
+class PointSet:
+    """
+    Growable list of 2D points stored as an (n, 2) array, with a KD-tree (scipy.spatial.cKDTree) for nearest
+    point and range queries. The tree is rebuilt lazily after edits.
+
+    points:             (list) Initial points.
+    """
+    def __init__(self,points=()):
+        self.points = np.array(points,dtype=np.int64).reshape(-1,2)
+        self._tree = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self,index):
+        return tuple(int(v) for v in self.points[index])
+
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+    def add(self,point):
+        """
+        Appends point and returns its index.
+        """
+        self.points = np.vstack((self.points,np.array(point,dtype=np.int64).reshape(1,2)))
+        self._tree = None
+        return len(self.points)-1
+
+    def remove(self,index):
+        self.points = np.delete(self.points,index,axis=0)
+        self._tree = None
+
+    def nearest(self,point,max_distance=np.inf):
+        """
+        Returns the index of the point closest to point within max_distance, or None.
+        """
+        if len(self.points) == 0:
+            return None
+        distance, index = self.tree().query(point,distance_upper_bound=max_distance)
+        return int(index) if np.isfinite(distance) else None
+
+    def near(self,point,distance):
+        """
+        Returns the sorted indices of the points within distance of point.
+        """
+        if len(self.points) == 0:
+            return []
+        return sorted(self.tree().query_ball_point(point,distance))
+
+    def tolist(self):
+        return self.points.tolist()
+
+def domain_centers(mask,min_distance=10,min_radius=3,tile=1024):
+    """
+    Returns the (n, 2) int array of (row, col) domain centers detected in a boolean foreground mask, ordered
+    by decreasing domain radius (then by position). Centers are the local maxima of the Euclidean distance
+    transform of the mask (the points deepest inside the domains):
+        - pixels equal to the maximum of the distance map over a (2*min_distance+1) square, and at least
+          min_radius from the background, are peaks. The maximum filter runs over tiles of size tile (with a
+          min_distance margin) to bound the memory used on large images;
+        - each connected plateau of peak pixels gives one candidate, at its centroid;
+        - non-maximum suppression keeps the deepest candidates at least min_distance apart (KD-tree).
+    """
+    mask = np.ascontiguousarray(mask,dtype=np.uint8)
+    dist = cv2.distanceTransform(mask,cv2.DIST_L2,cv2.DIST_MASK_PRECISE)
+    # The precise transform gives exact distances to integer offsets, but their float32 rounding varies between
+    # calls. The squared distances are integers (exact in float32 up to 4096 px), so rounding them makes
+    # plateaus and ties exact.
+    dist = np.rint(cv2.multiply(dist,dist))
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(2*min_distance+1,2*min_distance+1))
+    peaks = np.zeros(mask.shape,dtype=np.uint8)
+    height, width = mask.shape
+    for row in range(0,height,tile):
+        for col in range(0,width,tile):
+            top, left = max(row-min_distance,0), max(col-min_distance,0)
+            bottom, right = min(row+tile+min_distance,height), min(col+tile+min_distance,width)
+            d = dist[top:bottom,left:right]
+            local = (d == cv2.dilate(d,kernel)) & (d >= max(min_radius**2,1))
+            peaks[row:row+tile,col:col+tile] = local[row-top:row-top+tile,col-left:col-left+tile]
+
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(peaks,connectivity=8)
+    if n <= 1:
+        return np.empty((0,2),dtype=np.int64)
+    # centroids are (x, y) = (col, row); rounded onto the plateau's nearest pixel grid point.
+    centers = np.round(centroids[1:,::-1]).astype(np.int64)
+    centers[:,0] = np.clip(centers[:,0],0,height-1)
+    centers[:,1] = np.clip(centers[:,1],0,width-1)
+    # Every pixel of a plateau has the same depth; the centroid may lie off a non convex plateau.
+    depth = np.zeros(n,dtype=np.float32)
+    index = np.flatnonzero(labels)
+    depth[labels.flat[index]] = dist.flat[index]
+    depth = depth[1:]
+    order = np.lexsort((centers[:,1],centers[:,0],-depth))
+    centers = centers[order]
+
+    tree = cKDTree(centers)
+    keep = np.ones(len(centers),dtype=bool)
+    for i, neighbors in enumerate(tree.query_ball_point(centers,min_distance-1e-9)):
+        if keep[i]:
+            for j in neighbors:
+                if j > i:
+                    keep[j] = False
+    return centers[keep]
+
+def alignment_data(img,ksize=5):
+    """
+    Computes the Sobel edge orientation histogram of img and its convolution with a 60 degree comb
+    function. Returns the data dictionary displayed / exported by the Alignment widget.
+    """
+    dx = cv2.Sobel(img,ddepth=cv2.CV_64F,dx=1,dy=0,ksize=ksize)
+    dy = cv2.Sobel(img,ddepth=cv2.CV_64F,dx=0,dy=1,ksize=ksize)
+
+    theta = np.arctan2(dy,dx)*180/np.pi
+    magnitude = np.sqrt(dx**2+dy**2)
+
+    values, bin_edges = np.histogram(
+        theta.flatten(),
+        weights=magnitude.flatten(),
+        bins=np.linspace(0,180,181),
+        density=True)
+
+    comb = np.zeros(120)
+    comb[0] = 1
+    comb[60] = 1
+    comb[-1] = 1
+    convolution = signal.convolve(values,comb,mode='valid')
+    convolution = convolution/sum(convolution)
+
+    cos = np.average(np.cos(np.arange(len(convolution))*2*np.pi/60),weights=convolution)
+    sin = np.average(np.sin(np.arange(len(convolution))*2*np.pi/60),weights=convolution)
+    periodic_mean = np.round((np.arctan2(-sin,-cos)+np.pi)*60/2/np.pi).astype(int)
+
+    convolution = np.roll(convolution,30-periodic_mean)
+    periodic_var = np.average((np.arange(len(convolution))-30)**2,weights=convolution)
+
+    data = {}
+    data['Sobel Operator Output'] = {
+        "Sobel Operator Size": ksize,
+        "Gradient Angle Array": theta,
+        "Gradient Magnitude Array": magnitude}
+    data['Edge Orientation Histogram'] = {"Bin Edges (deg)": bin_edges.tolist(), "Values": values.tolist()}
+    data['Angular Convolution'] = {
+        "Bin Edges (deg)": list(range(0,len(convolution)+1)),
+        "Values": convolution.tolist(),
+        "Mean Shift": int(periodic_mean),
+        "Variance": float(periodic_var)}
+
+    return data
+
+@dataclass(frozen=True)
+class RemoveScaleParams:
+    scale_location: str = 'Auto'
+    tol: float = 0.95
+
+@dataclass(frozen=True)
+class ColorMaskParams:
+    min_val: float = 0
+    max_val: float = 255
+
+@dataclass(frozen=True)
+class CannyParams:
+    gauss_size: int = 5
+    low_thresh: int = None
+    high_thresh: int = None
+    auto: str = None
+
+@dataclass(frozen=True)
+class MorphologyParams:
+    size: int = 1
+
+@dataclass(frozen=True)
+class BinaryMaskParams:
+    pass
+
+@dataclass(frozen=True)
+class BlurParams:
+    gauss_size: int = 5
+
+@dataclass(frozen=True)
+class CropParams:
+    row: int = 0
+    col: int = 0
+    height: int = None
+    width: int = None
+
+@dataclass(frozen=True)
+class TemplateMatchParams:
+    row: int = 0
+    col: int = 0
+    size: int = 30
+    threshold: int = 100
+    invert: bool = False
+    rotations: int = 1
+    max_angle: float = 60 # hexagonal domains repeat every 60 degrees
+    scales: list = field(default_factory=lambda: [1])
+
+@dataclass(frozen=True)
+class KMeansParams:
+    wsize: int = 15
+    n_clusters: int = 2
+    stride: int = 3
+    seed: int = None
+    memory: float = None
+    features: str = 'windows'
+    selected: list = field(default_factory=list)
+
+@dataclass(frozen=True)
+class AlignmentParams:
+    ksize: int = 5
+
+@dataclass(frozen=True)
+class DomainCentersParams:
+    min_distance: int = 10
+    min_radius: float = 3
+
+class Operator:
+    """
+    Abstract class for a headless image operator. Subclasses define a parameter dataclass (Params)
+    and apply(), which maps a 2D uint8 array to a new 2D uint8 array.
+
+    params:             (Params) Parameters for the operator. If None, built from kwargs.
+
+    The parameters are immutable, they can only be changed through set(), which replaces them and increases
+    the operator's version. That is how a Pipeline knows which cached stages are stale.
+    """
+    Params = None
+    scaled = () # parameters measured in pixels (kernel sizes, coordinates)
+    def __init__(self,params=None,**kwargs):
+        if params is None:
+            params = self.Params(**kwargs)
+        elif not isinstance(params,self.Params):
+            raise TypeError("Parameter 'params' must be of type '%s'."%self.Params.__name__)
+        self.params = params
+        self.version = 0
+
+    def __call__(self,img):
+        return self.apply(img)
+
+    def __repr__(self):
+        return "%s(%s)"%(self.__class__.__name__,self.params)
+
+    def set(self,**kwargs):
+        """
+        Updates parameters by keyword.
+        """
+        changes = {}
+        for key, value in kwargs.items():
+            if not hasattr(self.params,key):
+                raise KeyError("'%s' is not a parameter of %s."%(key,self.__class__.__name__))
+            if getattr(self.params,key) != value:
+                changes[key] = value
+        if changes:
+            self.params = replace(self.params,**changes)
+            self.version += 1
+
+    def rescaled(self,scale):
+        """
+        Returns a copy of the operator for an image resized by scale, i.e. with the pixel measured parameters
+        multiplied by scale. Used to preview an operator on a pyramid level.
+        """
+        changes = {}
+        for name in self.scaled:
+            value = getattr(self.params,name)
+            if value is not None:
+                changes[name] = max(int(round(value*scale)),min(value,1))
+        return self.__class__(replace(self.params,**changes))
+
+    def apply(self,img):
+        raise NotImplementedError
+
+    def to_dict(self):
+        return {'@class': self.__class__.__name__, 'params': asdict(self.params)}
+
+    @classmethod
+    def from_dict(cls,d):
+        op_cls = OPERATORS[d['@class']]
+        return op_cls(op_cls.Params(**d['params']))
+
+class RemoveScale(Operator):
+    Params = RemoveScaleParams
+    def box(self,img):
+        """
+        Returns the (left, upper, right, lower) crop box that removes the scale bar.
+        """
+        return scale_boxes(img[np.newaxis],self.params.scale_location,self.params.tol)[0]
+
+    def apply(self,img):
+        """
+        Returns the cropped image as a view of img (no copy).
+        """
+        return crop_view(img,self.box(img))
+
+    def apply_batch(self,imgs):
+        """
+        Returns the cropped views of a stack of images (n, height, width).
+        """
+        imgs = np.asarray(imgs)
+        boxes = scale_boxes(imgs,self.params.scale_location,self.params.tol)
+        return [crop_view(img,box) for img, box in zip(imgs,boxes)]
+
+class ColorMask(Operator):
+    Params = ColorMaskParams
+    def __init__(self,*args,**kwargs):
+        super(ColorMask,self).__init__(*args,**kwargs)
+        self._luts = (None,None)
+
+    def luts(self):
+        """
+        Returns the 256 entry lookup tables (mask, output): mask maps intensities strictly between min_val
+        and max_val to 1 and the rest to 0, output maps them to themselves and the rest to 255.
+        """
+        bounds = (self.params.min_val,self.params.max_val)
+        if self._luts[0] != bounds:
+            values = np.arange(256,dtype=np.uint8)
+            keep = np.logical_and(values>bounds[0],values<bounds[1])
+            self._luts = (bounds,(keep.astype(np.uint8),np.where(keep,values,np.uint8(255))))
+        return self._luts[1]
+
+    def mask(self,img,out=None):
+        """
+        Returns the boolean mask of the kept pixels. If given, out (uint8, same shape as img) is filled
+        instead of allocating a new array.
+        """
+        return cv2.LUT(img,self.luts()[0],dst=out).view(bool)
+
+    def apply(self,img,out=None):
+        """
+        Single cv2.LUT pass. If given, out (uint8, same shape as img) is filled instead of allocating a new
+        array.
+        """
+        return cv2.LUT(img,self.luts()[1],dst=out)
+
+_gradients = {}
+
+class CannyEdgeDetection(Operator):
+    """
+    Canny edge detection on the gaussian blurred image. The Sobel gradients of the blurred image are cached
+    per input image and gauss_size, so changing the thresholds only reruns the hysteresis.
+
+    Thresholds left to None default to 10% / 40% of the maximum intensity. If auto is set, both are derived
+    from the intensity histogram instead:
+        'otsu':     high is the Otsu threshold, low half of it.
+        'median':   low / high are 0.67 / 1.33 times the median intensity.
+    """
+    Params = CannyParams
+    scaled = ('gauss_size',)
+    AUTO = ('otsu','median')
+    def thresholds(self,img):
+        hist = histogram(img)
+        if self.params.auto == 'otsu':
+            high = otsu_threshold(hist)
+            return high//2, high
+        elif self.params.auto == 'median':
+            median = median_intensity(hist)
+            return int(max(0,0.67*median)), int(min(255,1.33*median))
+        elif self.params.auto is not None:
+            raise ValueError("Unknown auto threshold mode '%s'."%self.params.auto)
+
+        low, high = self.params.low_thresh, self.params.high_thresh
+        if low is None or high is None:
+            maximum = int(np.flatnonzero(hist)[-1]) if hist.any() else 0
+            if low is None:
+                low = int(maximum*.1)
+            if high is None:
+                high = int(maximum*.4)
+        return low, high
+
+    def gauss_size(self):
+        gauss_size = self.params.gauss_size
+        return gauss_size + 1 if gauss_size % 2 == 0 else gauss_size
+
+    def gradients(self,img):
+        """
+        Returns the Sobel gradients (dx, dy) (np.int16) of the blurred image.
+        """
+        gauss_size = self.gauss_size()
+        def compute():
+            blurred = cv2.GaussianBlur(img,(gauss_size,gauss_size),0)
+            dx = freeze(cv2.Sobel(blurred,cv2.CV_16S,1,0,ksize=3,borderType=cv2.BORDER_REPLICATE))
+            dy = freeze(cv2.Sobel(blurred,cv2.CV_16S,0,1,ksize=3,borderType=cv2.BORDER_REPLICATE))
+            return dx, dy
+        return _memoized(_gradients,img,gauss_size,compute)
+
+    def magnitude(self,img):
+        """
+        Returns the (L2) gradient magnitude of the blurred image.
+        """
+        dx, dy = self.gradients(img)
+        return cv2.magnitude(dx.astype(np.float32),dy.astype(np.float32))
+
+    def apply(self,img):
+        low, high = self.thresholds(img)
+        dx, dy = self.gradients(img)
+        return 255-cv2.Canny(dx,dy,low,high,L2gradient=True)
+
+_distances = {}
+
+def binary_values(img):
+    """
+    Returns the (low, high) values of a two valued image (e.g. the output of BinaryMask or Canny), or None.
+    """
+    values = np.flatnonzero(histogram(img))
+    return (int(values[0]),int(values[-1])) if len(values) == 2 else None
+
+def _distance_maps(img,value,mode):
+    # Chessboard distances (saturated to uint8) to the nearest pixel equal to value, in img and in img
+    # filtered with a 2x2 kernel. A square kernel of odd size 2r+1 covers offsets [-r,r], which is the
+    # first map thresholded at r. An even size 2m covers [-m,m-1], i.e. [-(m-1),m-1] plus the 2x2 kernel's
+    # [-1,0], which is the second map thresholded at m-1. Saturation keeps thresholds below 255 exact, i.e.
+    # sizes up to 510.
+    maps = []
+    for src in (img,rank_filter(img,2,mode,binary=False)):
+        d = cv2.distanceTransform(cv2.compare(src,value,cv2.CMP_NE),cv2.DIST_C,3)
+        maps.append(freeze(cv2.convertScaleAbs(d)))
+    return tuple(maps)
+
+def rank_filter(img,size,mode,binary=True):
+    """
+    Minimum (mode=='min', cv2.erode) or maximum (mode=='max', cv2.dilate) filter with a size x size square
+    kernel.
+
+    Two valued images (if binary==True) are filtered by thresholding the distance transform of the pixels
+    holding the min / max value. The transform is cached per read-only input, so for a slider scrubbing
+    through sizes every size costs a single compare. Other images are filtered with OpenCV's separable
+    rectangular morphology.
+    """
+    values = binary_values(img) if binary and size < 511 else None
+    if values is None:
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(size,size))
+        return cv2.erode(img,kernel) if mode == 'min' else cv2.dilate(img,kernel)
+
+    low, high = values
+    near, far = (low,high) if mode == 'min' else (high,low)
+    odd, even = _memoized(_distances,img,mode,lambda: _distance_maps(img,near,mode))
+    if size % 2 == 1:
+        out = cv2.compare(odd,size//2,cv2.CMP_GT)
+    else:
+        out = cv2.compare(even,size//2-1,cv2.CMP_GT)
+    if (near,far) != (0,255):
+        lut = np.full(256,near,np.uint8)
+        lut[255] = far
+        out = cv2.LUT(out,lut)
+    return out
+
+class Dilation(Operator):
+    """
+    Dilates the dark (foreground) features of the image, i.e. a minimum filter.
+    """
+    Params = MorphologyParams
+    scaled = ('size',)
+    def apply(self,img):
+        return rank_filter(img,self.params.size,'min')
+
+class Erosion(Operator):
+    """
+    Erodes the dark (foreground) features of the image, i.e. a maximum filter.
+    """
+    Params = MorphologyParams
+    scaled = ('size',)
+    def apply(self,img):
+        return rank_filter(img,self.params.size,'max')
+
+class BinaryMask(Operator):
+    Params = BinaryMaskParams
+    def apply(self,img):
+        return np.where(img<255,0,255).astype(np.uint8)
+
+class Blur(Operator):
+    Params = BlurParams
+    scaled = ('gauss_size',)
+    def apply(self,img):
+        gauss_size = self.params.gauss_size
+        gauss_size = gauss_size + 1 if gauss_size % 2 == 0 else gauss_size
+        return cv2.GaussianBlur(img,(gauss_size,gauss_size),0)
+
+class Crop(Operator):
+    Params = CropParams
+    scaled = ('row','col','height','width')
+    def apply(self,img):
+        p = self.params
+        height = img.shape[0]-p.row if p.height is None else p.height
+        width = img.shape[1]-p.col if p.width is None else p.width
+        return img[p.row:p.row+height,p.col:p.col+width].copy()
+
+class TemplateMatch(Operator):
+    """
+    Keeps the pixels that match the size x size template whose upper left corner is at (row, col).
+    """
+    Params = TemplateMatchParams
+    scaled = ('row','col','size')
+    def mask(self,img):
+        p = self.params
+        template = img[p.row:p.row+p.size,p.col:p.col+p.size]
+        if p.rotations > 1 or list(p.scales) != [1]:
+            res = match_templates(img,template,rotations=p.rotations,max_angle=p.max_angle,scales=tuple(p.scales))[0]
+        else:
+            res = match_template(img,template)
+        return template_mask(res,threshold=p.threshold,invert=p.invert)
+
+    def apply(self,img):
+        return np.where(self.mask(img),img,255).astype(np.uint8)
+
+class KMeansFilter(Operator):
+    """
+    Keeps the pixels belonging to the selected K-Means clusters (labels start at 1).
+    """
+    Params = KMeansParams
+    scaled = ('wsize','stride')
+    def clusters(self,img):
+        p = self.params
+        return kmeans_clusters(
+            img,wsize=p.wsize,n_clusters=p.n_clusters,stride=p.stride,seed=p.seed,memory=p.memory,
+            features=p.features)
+
+    def mask(self,img):
+        return select_labels(self.clusters(img),self.params.selected)
+
+    def apply(self,img):
+        return np.where(self.mask(img),img,255).astype(np.uint8)
+
+class Alignment(Operator):
+    """
+    Measures the orientation of the edges of its input, see alignment_data. Like the Alignment layer, the
+    image passes through unchanged; use data() for the statistics and the Sobel gradient magnitude.
+    """
+    Params = AlignmentParams
+    def data(self,img):
+        return alignment_data(img,ksize=self.params.ksize)
+
+    def apply(self,img):
+        return img
+
+class DomainCenterDetection(Operator):
+    """
+    Detects domain centers in the kept (non white) pixels of its input, see domain_centers. The image passes
+    through unchanged; use centers() for the coordinates.
+    """
+    Params = DomainCentersParams
+    scaled = ('min_distance','min_radius')
+    def centers(self,img):
+        p = self.params
+        return domain_centers(img<255,min_distance=p.min_distance,min_radius=p.min_radius)
+
+    def apply(self,img):
+        return img
+
+OPERATORS = OrderedDict((op.__name__,op) for op in [
+    RemoveScale,
+    ColorMask,
+    CannyEdgeDetection,
+    Dilation,
+    Erosion,
+    BinaryMask,
+    Blur,
+    Crop,
+    TemplateMatch,
+    KMeansFilter,
+    Alignment,
+    DomainCenterDetection
+    ])
+
+class Pipeline:
+    """
+    An ordered stack of Operators applied one after another to an image. Runs without Qt.
+
+    The output of every stage is cached along with the operator version it was computed with. When
+    run() is called again on the same input (the same read-only array, or a writeable array with the same
+    contents), only the stages from the first changed operator onwards are recomputed (once each).
+
+    Stage outputs are read-only since they are shared with the cache.
+
+    operators:          (list of Operator) Operators in the order they are applied.
+    """
+    def __init__(self,operators=None):
+        self.operators = []
+        self._input = None
+        self._cache = [] # (operator version, output) for each computed stage
+        for op in operators or []:
+            self.append(op)
+
+    def __len__(self):
+        return len(self.operators)
+
+    def __getitem__(self,index):
+        return self.operators[index]
+
+    def __iter__(self):
+        return iter(self.operators)
+
+    def append(self,operator):
+        if not isinstance(operator,Operator):
+            raise TypeError("Pipeline items must be of type 'Operator'. Found type '%s'."%type(operator))
+        self.operators.append(operator)
+        return len(self.operators)-1
+
+    def set(self,index,**kwargs):
+        """
+        Updates the parameters of the operator at index. Stages after it are recomputed on the next run.
+        """
+        self.operators[index].set(**kwargs)
+
+    def invalidate(self,index=0):
+        """
+        Drops the cached outputs of the stage at index and every stage after it.
+        """
+        del self._cache[index:]
+
+    def run(self,img,stages=False):
+        """
+        Applies every operator to img. If stages==True, returns the list of outputs of each
+        operator instead of only the final image.
+        """
+        img = np.asarray(img,dtype=np.uint8)
+        # A read-only input is recognized by identity. A writeable one can be edited in place between runs, so
+        # it is recognized by its contents.
+        if img.flags.writeable:
+            key = digest(img)
+            new = not isinstance(self._input,str) or key != self._input
+        else:
+            key = img
+            new = key is not self._input
+        if new:
+            self._input = key
+            self._cache = []
+
+        outputs = []
+        for i, op in enumerate(self.operators):
+            if i < len(self._cache) and self._cache[i][0] == op.version:
+                img = self._cache[i][1]
+            else:
+                self.invalidate(i)
+                # A view is frozen, so an operator returning its input does not make the caller's array
+                # read-only.
+                img = freeze(op(img).view())
+                self._cache.append((op.version,img))
+            outputs.append(img)
+        del self._cache[len(self.operators):]
+        if stages:
+            return outputs
+        return img
+
+    def to_dict(self):
+        return {'operators': [op.to_dict() for op in self.operators]}
+
+    @classmethod
+    def from_dict(cls,d):
+        return cls([Operator.from_dict(op) for op in d['operators']])
+
+    def save(self,path):
+        with open(path,'w') as f:
+            json.dump(self.to_dict(),f,indent=2)
+
+    @classmethod
+    def load(cls,path):
+        with open(path,'r') as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,172 @@
+"""
+Binary session files for saving and restoring a GSAImage layer stack.
+
+A session is a zip archive holding a JSON manifest (manifest.json) and one .npy blob per array found in
+the saved state. Arrays are replaced in the manifest by {'@array': <member name>}. Images are stored
+uncompressed so they can be memory-mapped straight out of the archive on load; boolean masks are
+deflated since they compress well and are small once loaded.
+"""
+import io
+import json
+import os
+import struct
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+FORMAT = 'gsaimage-session'
+VERSION = 1
+EXTENSION = '.gsa'
+MANIFEST = 'manifest.json'
+
+def is_array_ref(obj):
+    return isinstance(obj,dict) and set(obj.keys()) == {'@array'}
+
+class SessionWriter:
+    """
+    Collects the arrays of a state dictionary and writes them with the manifest to a session file.
+
+    compress:           (bool) Deflate every array, not only boolean masks. Disables memory-mapping.
+    """
+    def __init__(self,compress=False):
+        self.compress = compress
+        self.arrays = OrderedDict()
+
+    def add(self,array,compress=None):
+        """
+        Adds an array and returns the reference stored in the manifest in its place.
+        """
+        if compress is None:
+            compress = self.compress or array.dtype == bool
+        name = 'arrays/%d.npy'%len(self.arrays)
+        # np.ascontiguousarray would turn 0-d arrays into 1-d ones.
+        if not array.flags.c_contiguous:
+            array = np.ascontiguousarray(array)
+        self.arrays[name] = (array,compress)
+        return {'@array': name}
+
+    def extract(self,obj):
+        """
+        Returns a copy of obj (nested dicts / lists) with every np.ndarray replaced by a reference.
+        """
+        if isinstance(obj,np.ndarray):
+            return self.add(obj)
+        elif isinstance(obj,dict):
+            return {key: self.extract(value) for key, value in obj.items()}
+        elif isinstance(obj,(list,tuple)):
+            return [self.extract(value) for value in obj]
+        elif isinstance(obj,np.generic):
+            return obj.item()
+        return obj
+
+    def save(self,path,state):
+        """
+        Writes state (a dictionary, e.g. from Modification.to_dict) to path.
+
+        The archive is written to a temporary file in the same directory and then moved over path, so saving
+        over an opened session never truncates the file its memory-mapped arrays are read from.
+        """
+        manifest = {'format': FORMAT, 'version': VERSION, 'state': self.extract(state)}
+        directory, name = os.path.split(os.path.abspath(path))
+        tmp = os.path.join(directory,'.'+name)
+        try:
+            with zipfile.ZipFile(tmp,'w') as zf:
+                zf.writestr(MANIFEST,json.dumps(manifest))
+                for name, (array, compress) in self.arrays.items():
+                    buf = io.BytesIO()
+                    np.save(buf,array,allow_pickle=False)
+                    zf.writestr(
+                        name,
+                        buf.getvalue(),
+                        compress_type=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+            os.replace(tmp,path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+class Session:
+    """
+    An opened session file. Arrays are only read when requested; uncompressed arrays are memory-mapped
+    (read-only) from the archive.
+
+    path:               (str) Path of the session file.
+    """
+    def __init__(self,path):
+        self.path = path
+        with zipfile.ZipFile(path,'r') as zf:
+            manifest = json.loads(zf.read(MANIFEST).decode('utf-8'))
+            self._members = {info.filename: info for info in zf.infolist()}
+        if manifest.get('format') != FORMAT:
+            raise ValueError("%s is not a GSAImage session file."%path)
+        if manifest.get('version',0) > VERSION:
+            raise ValueError("Session file version %s is not supported."%manifest['version'])
+        self.manifest = manifest
+        self._arrays = {}
+
+    def state(self,resolve=True):
+        """
+        Returns the saved state. If resolve==True, every array reference is replaced by its array.
+        """
+        if resolve:
+            return self.resolve(self.manifest['state'])
+        return self.manifest['state']
+
+    def resolve(self,obj):
+        """
+        Returns a copy of obj with every array reference replaced by its (memory-mapped) array.
+        """
+        if is_array_ref(obj):
+            return self.array(obj)
+        elif isinstance(obj,dict):
+            return {key: self.resolve(value) for key, value in obj.items()}
+        elif isinstance(obj,list):
+            return [self.resolve(value) for value in obj]
+        return obj
+
+    def array(self,ref):
+        """
+        Returns the array for a reference ({'@array': name} or the member name).
+        """
+        name = ref['@array'] if isinstance(ref,dict) else ref
+        if name not in self._arrays:
+            self._arrays[name] = self._read(self._members[name])
+        return self._arrays[name]
+
+    def _read(self,info):
+        if info.compress_type == zipfile.ZIP_STORED:
+            with open(self.path,'rb') as f:
+                # Skip the zip local file header to get to the stored .npy data.
+                f.seek(info.header_offset)
+                header = f.read(30)
+                name_length, extra_length = struct.unpack('<HH',header[26:30])
+                f.seek(info.header_offset+30+name_length+extra_length)
+                version = np.lib.format.read_magic(f)
+                if version == (1,0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                offset = f.tell()
+            # np.memmap reads shape () as "whole file", so 0-d arrays are loaded instead.
+            if len(shape) > 0 and int(np.prod(shape)) > 0 and not dtype.hasobject:
+                return np.memmap(
+                    self.path,
+                    dtype=dtype,
+                    mode='r',
+                    offset=offset,
+                    shape=shape,
+                    order='F' if fortran_order else 'C')
+        with zipfile.ZipFile(self.path,'r') as zf:
+            array = np.load(io.BytesIO(zf.read(info.filename)),allow_pickle=False)
+        array.setflags(write=False)
+        return array
+
+def save(path,state,compress=False):
+    SessionWriter(compress=compress).save(path,state)
+
+def load(path,resolve=True):
+    """
+    Opens the session at path and returns its state (see Session.state).
+    """
+    return Session(path).state(resolve=resolve)
@@ -15,6 +15,8 @@ from sqlalchemy import String, Integer, Float, Date
 from collections.abc import Sequence
 import pyqtgraph as pg
 
+from .pipeline import overlay
+
 logger = logging.getLogger(__name__)
 
 sql_validator = {
@@ -279,6 +281,8 @@ class ItemsetsTableModel(QtCore.QAbstractTableModel):
 
 
 def mask_color_img(img, mask, color=[0, 0, 255], alpha=0.3):
+    if len(img.shape) < 3 and img.dtype == np.uint8 and mask.dtype == bool:
+        return overlay(img, mask, [color], alpha=alpha)
     if len(img.shape) < 3:
         img = np.dstack((img, img, img))
     img_layer = img.copy()
@@ -0,0 +1,120 @@
+import functools
+import logging
+
+from PyQt5 import QtCore
+
+logger = logging.getLogger(__name__)
+
+class ComputeThread(QtCore.QThread):
+    """
+    Threading class for running a single compute job off the GUI thread.
+
+    func:                   Callable run on the thread. Must not touch any widgets.
+    args:                   Tuple of arguments passed to func.
+    request_id:             ID used to identify the request the job belongs to.
+    """
+
+    computeFinished = QtCore.pyqtSignal(object, int, object) # result, request id, error
+
+    def __init__(self, func, args=(), request_id=0):
+        super(ComputeThread, self).__init__()
+        self.func = func
+        self.args = args
+        self.request_id = request_id
+        self.result = None
+        self.error = None
+
+        self.finished.connect(self.signal)
+
+    def __del__(self):
+        try:
+            self.wait()
+        except RuntimeError:
+            # Already deleted (deleteLater) once finished.
+            pass
+
+    def signal(self):
+        self.computeFinished.emit(self.result, self.request_id, self.error)
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+
+class ComputeScheduler(QtCore.QObject):
+    """
+    Schedules compute jobs for a document (one GSAImage) on worker threads. Jobs are grouped by key (usually
+    the Modification that submitted them). At most one job runs per key; while it runs, only the newest
+    submitted job is kept and every older one is dropped. Results of superseded requests are discarded, so
+    the callback only ever receives the result of the latest request for its key. Callbacks run on the GUI
+    thread.
+
+    Signals:
+    failed:                 (key, Exception) Sent when the latest job for a key raises an error.
+    """
+    failed = QtCore.pyqtSignal(object, object)
+    def __init__(self, parent=None):
+        super(ComputeScheduler, self).__init__(parent=parent)
+        self._count = 0
+        self._latest = {}
+        self._running = {}
+        self._pending = {}
+        self._threads = {} # request id: thread, kept until Qt deleted it
+
+        self.failed.connect(lambda key, e: logger.error("Compute job for %s failed: %s"%(key, e)))
+
+    def isBusy(self, key):
+        return key in self._running or key in self._pending
+
+    def submit(self, key, func, args=(), callback=None):
+        """
+        Runs func(*args) on a worker thread and passes the result to callback on the GUI thread, unless a
+        newer job is submitted for the same key in the meantime. Returns the request id.
+        """
+        self._count += 1
+        request_id = self._count
+        self._latest[key] = request_id
+
+        job = (func, args, callback, request_id)
+        if key in self._running:
+            self._pending[key] = job
+        else:
+            self._start(key, job)
+
+        return request_id
+
+    def cancel(self, key=None):
+        """
+        Drops the queued job and ignores the running job for key (all keys if None). A running thread is
+        not terminated, its result is just never delivered.
+        """
+        keys = list(self._latest) if key is None else [key]
+        for k in keys:
+            self._latest.pop(k, None)
+            self._pending.pop(k, None)
+
+    def _start(self, key, job):
+        func, args, callback, request_id = job
+        thread = ComputeThread(func, args, request_id)
+        thread.computeFinished.connect(functools.partial(self._finish, key, callback))
+        # The thread is still delivering finished when _finish runs, so it is only released once Qt deleted
+        # it after every finished slot ran.
+        thread.finished.connect(thread.deleteLater)
+        thread.destroyed.connect(lambda _=None, i=request_id: self._threads.pop(i, None))
+        self._threads[request_id] = thread
+        self._running[key] = thread
+        thread.start()
+
+    def _finish(self, key, callback, result, request_id, error):
+        self._running.pop(key, None)
+        if key in self._pending:
+            self._start(key, self._pending.pop(key))
+
+        if request_id != self._latest.get(key):
+            return
+        del self._latest[key]
+        if error is not None:
+            self.failed.emit(key, error)
+        elif callable(callback):
+            callback(result)
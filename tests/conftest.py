@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'src'))
+
+# Results memoized by the pipeline go to a throwaway cache, never the user's.
+os.environ['GSAIMAGE_CACHE_DIR'] = tempfile.mkdtemp(prefix='gsaimage-cache-')
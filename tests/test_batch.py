@@ -0,0 +1,79 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+from gsaimage import batch
+from gsaimage.util import cache, pipeline
+
+def write_images(directory,count=3):
+    os.makedirs(directory)
+    for i in range(count):
+        img = np.full((120,150),255,np.uint8)
+        cv2.circle(img,(40+20*i,60),15,60,-1)
+        cv2.imwrite(os.path.join(directory,'img%d.png'%i),img)
+
+def test_batch_run_and_resume(tmp_path,capsys):
+    input_dir, output_dir = str(tmp_path/'in'), str(tmp_path/'out')
+    write_images(input_dir)
+    stack = pipeline.Pipeline([pipeline.Dilation(size=3),pipeline.DomainCenterDetection(min_distance=5)])
+    stack_path = str(tmp_path/'stack.json')
+    stack.save(stack_path)
+
+    assert batch.run(stack_path,input_dir,output_dir,workers=1) == []
+    names = sorted(os.listdir(output_dir))
+    assert names == sorted('img%d%s'%(i,s) for i in range(3) for s in ('.png','_mask.png','_centers.json'))
+
+    img = cv2.imread(os.path.join(input_dir,'img1.png'),cv2.IMREAD_GRAYSCALE)
+    out = cv2.imread(os.path.join(output_dir,'img1.png'),cv2.IMREAD_GRAYSCALE)
+    mask = cv2.imread(os.path.join(output_dir,'img1_mask.png'),cv2.IMREAD_GRAYSCALE)
+    assert np.array_equal(out,stack.run(img))
+    assert np.array_equal(mask,np.where(out<255,255,0))
+    with open(os.path.join(output_dir,'img1_centers.json')) as f:
+        assert json.load(f)['Domain Center Coordinates'] == [[60,60]]
+
+    # A second run only processes images without outputs.
+    os.remove(os.path.join(output_dir,'img2_mask.png'))
+    mtime = os.path.getmtime(os.path.join(output_dir,'img0.png'))
+    capsys.readouterr()
+    assert batch.run(stack_path,input_dir,output_dir,workers=1) == []
+    assert "3 images found, 2 already processed." in capsys.readouterr().out
+    assert os.path.isfile(os.path.join(output_dir,'img2_mask.png'))
+    assert os.path.getmtime(os.path.join(output_dir,'img0.png')) == mtime
+
+    # Including images whose centers are missing.
+    os.remove(os.path.join(output_dir,'img1_centers.json'))
+    assert batch.run(stack_path,input_dir,output_dir,workers=1) == []
+    assert "3 images found, 2 already processed." in capsys.readouterr().out
+    assert os.path.isfile(os.path.join(output_dir,'img1_centers.json'))
+
+    assert batch.run(stack_path,input_dir,output_dir,workers=1) == []
+    out = capsys.readouterr().out
+    assert "0 images" not in out
+    assert "3 images found, 3 already processed." in out
+
+def test_batch_reports_failures(tmp_path):
+    input_dir, output_dir = str(tmp_path/'in'), str(tmp_path/'out')
+    write_images(input_dir,count=1)
+    with open(os.path.join(input_dir,'broken.png'),'w') as f:
+        f.write('not an image')
+    stack_path = str(tmp_path/'stack.json')
+    pipeline.Pipeline([pipeline.BinaryMask()]).save(stack_path)
+    failed = batch.run(stack_path,input_dir,output_dir,workers=1)
+    assert [os.path.basename(path) for path, error in failed] == ['broken.png']
+    assert os.path.isfile(os.path.join(output_dir,'img0_mask.png'))
+
+def test_batch_cache_summary(tmp_path,capsys,monkeypatch):
+    # The workers start with a fresh cache that stores every result.
+    monkeypatch.setattr(cache,'_cache',None)
+    monkeypatch.setenv('GSAIMAGE_CACHE_MIN_TIME','0')
+    input_dir, output_dir = str(tmp_path/'in'), str(tmp_path/'out')
+    write_images(input_dir)
+    stack_path = str(tmp_path/'stack.json')
+    pipeline.Pipeline([pipeline.TemplateMatch(row=40,col=40,size=20)]).save(stack_path)
+
+    batch.run(stack_path,input_dir,output_dir,workers=1)
+    assert "Result cache: 0 hits, 3 misses" in capsys.readouterr().out
+    batch.run(stack_path,input_dir,output_dir,workers=1,overwrite=True)
+    assert "Result cache: 3 hits, 0 misses" in capsys.readouterr().out
@@ -0,0 +1,95 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from gsaimage.util import cache
+
+def test_digest():
+    a = np.arange(12,dtype=np.uint8).reshape(3,4)
+    assert cache.digest(a) == cache.digest(a.copy())
+    assert cache.digest(a) != cache.digest(a.reshape(4,3))
+    assert cache.digest(a) != cache.digest(a.astype(np.int16))
+    b = a.copy()
+    b[0,0] = 1
+    assert cache.digest(a) != cache.digest(b)
+
+def test_key():
+    c = cache.ResultCache(directory='.',max_bytes=0)
+    a = np.ones((4,4))
+    assert c.key('f',a,wsize=3) == c.key('f',a.copy(),wsize=3)
+    assert c.key('f',a,wsize=3) != c.key('f',a,wsize=5)
+    assert c.key('f',a,wsize=3) != c.key('g',a,wsize=3)
+
+def test_put_get(tmp_path):
+    c = cache.ResultCache(directory=str(tmp_path),min_seconds=0)
+    a = np.arange(10)
+    assert c.get('a') is cache.MISSING
+    c.put('a',a)
+    c.put('b',(a,a*2))
+    assert np.array_equal(c.get('a'),a)
+    b = c.get('b')
+    assert isinstance(b,tuple) and np.array_equal(b[1],a*2)
+    assert (c.hits, c.misses) == (2,1)
+    with pytest.raises(TypeError):
+        c.put('c',{'a': a})
+
+def test_put_skips_fast_results(tmp_path):
+    c = cache.ResultCache(directory=str(tmp_path),min_seconds=1)
+    c.put('fast',np.zeros(10),seconds=0.01)
+    c.put('slow',np.zeros(10),seconds=2)
+    assert c.get('fast') is cache.MISSING
+    assert c.get('slow') is not cache.MISSING
+    assert c.stats()['skipped'] == 1
+    assert c.stats()['entries'] == 1
+
+def test_eviction(tmp_path):
+    entry = np.zeros(1000,dtype=np.uint8) # about 1.1 kB on disk
+    c = cache.ResultCache(directory=str(tmp_path),max_bytes=5000,min_seconds=0)
+    for i in range(4):
+        c.put('k%d'%i,entry)
+        os.utime(os.path.join(str(tmp_path),'k%d.npy'%i),(i,i))
+    c.get('k0') # k0 is now the most recently used
+    c.put('k4',entry)
+    assert c.size() <= 0.9*c.max_bytes
+    assert c.get('k0') is not cache.MISSING
+    assert c.get('k1') is cache.MISSING
+    assert c.get('k4') is not cache.MISSING
+
+def test_clear(tmp_path):
+    c = cache.ResultCache(directory=str(tmp_path),min_seconds=0)
+    c.put('a',np.zeros(10))
+    c.clear()
+    assert c.stats()['entries'] == 0
+    assert c.size() == 0
+
+def test_memoize(tmp_path,monkeypatch):
+    monkeypatch.setattr(cache,'_cache',cache.ResultCache(directory=str(tmp_path),min_seconds=0.05))
+    calls = []
+    @cache.memoize(unless=lambda args: args['seed'] is None)
+    def slow(img,seed=None):
+        calls.append(seed)
+        time.sleep(0.06)
+        return img*2
+
+    img = np.ones(5)
+    assert np.array_equal(slow(img,seed=1),img*2)
+    assert np.array_equal(slow(img.copy(),seed=1),img*2)
+    slow(img)
+    slow(img)
+    assert calls == [1,None,None]
+    assert 'hits' in cache.get_cache().summary()
+
+def test_memoize_ignore(tmp_path,monkeypatch):
+    monkeypatch.setattr(cache,'_cache',cache.ResultCache(directory=str(tmp_path),min_seconds=0))
+    calls = []
+    @cache.memoize(ignore=('workers',))
+    def double(img,workers=None):
+        calls.append(workers)
+        return img*2
+
+    img = np.ones(5)
+    double(img,workers=1)
+    assert np.array_equal(double(img,workers=4),img*2)
+    assert calls == [1]
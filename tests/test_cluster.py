@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+import pytest
+
+from gsaimage.util import cache, cluster, pipeline
+
+def two_textures(shape=(160,200),seed=0):
+    rng = np.random.RandomState(seed)
+    img = cv2.GaussianBlur((rng.rand(*shape)*255).astype(np.uint8),(0,0),1.5)
+    img[:,shape[1]//2:] //= 2
+    return img
+
+def test_bands_cover_view():
+    padded = pipeline.pad(two_textures(),wsize=7,stride=2)
+    view = cluster.windows(padded,7,stride=2)
+    rows = [(start,stop) for start, stop, X in cluster.bands(view,memory=0.05)]
+    assert rows[0][0] == 0 and rows[-1][1] == view.shape[0]
+    assert all(a[1] == b[0] for a, b in zip(rows,rows[1:]))
+    assert len(rows) > 1
+
+@pytest.mark.parametrize('features',['windows','texture'])
+def test_kmeans_separates_textures(features):
+    img = two_textures()
+    labels = pipeline.kmeans_clusters(img,wsize=7,n_clusters=2,stride=2,seed=0,features=features)
+    assert labels.shape == img.shape
+    left, right = labels[:,:80], labels[:,120:]
+    assert np.bincount(left.ravel()).argmax() != np.bincount(right.ravel()).argmax()
+
+def test_streaming_kmeans():
+    padded = pipeline.pad(two_textures(),wsize=7,stride=2)
+    view = cluster.windows(padded,7,stride=2)
+    labels = cluster.streaming_kmeans(padded,7,2,stride=2,seed=0,memory=0.05)
+    assert labels.shape == view.shape[:2]
+    assert set(np.unique(labels)) == {0,1}
+
+def test_texture_kmeans():
+    img = two_textures()
+    labels = cluster.texture_kmeans(img,7,2,stride=2,seed=0)
+    assert labels.shape == img[::2,::2].shape
+    assert labels[:,:40].mean() != labels[:,60:].mean()
+
+def test_kmeans_sweep():
+    img = two_textures()
+    labels, inertia, silhouette = pipeline.kmeans_sweep(img,wsize=7,max_clusters=4,stride=2,seed=0)
+    assert labels.shape == (3,)+img.shape
+    assert len(inertia) == len(silhouette) == 3
+    assert inertia[0] > inertia[-1]
+    assert [l.max() for l in labels] == [2,3,4]
+
+def test_predict_in_process_matches_serial():
+    padded = pipeline.pad(two_textures(),wsize=5,stride=2)
+    view = cluster.windows(padded,5,stride=2)
+    gmm = cluster.fit_gmm(view,2,seed=0)
+    expected = cluster.predict(gmm,view)
+    assert np.array_equal(cluster.parallel_predict(gmm,padded,wsize=5,stride=2,workers=4),expected)
+    assert cluster._pool is None
+
+def test_parallel_predict_pool(monkeypatch):
+    monkeypatch.setattr(cluster,'PARALLEL_MIN_SECONDS',0)
+    monkeypatch.setattr(cluster,'POOL_STARTUP_SECONDS',0)
+    img = two_textures((200,240))
+    padded = pipeline.pad(img,wsize=5,stride=3)
+    view = cluster.windows(padded,5,stride=3)
+    gmm = cluster.fit_gmm(view,2,seed=0)
+    features = cluster.texture_features(img,5)
+    gmm_features = cluster.fit_gmm(features,2,seed=0)
+    try:
+        assert np.array_equal(cluster.parallel_predict(gmm,padded,wsize=5,stride=3,workers=2),cluster.predict(gmm,view))
+        executor = cluster._pool[1]
+        assert np.array_equal(
+            cluster.parallel_predict(gmm_features,features,workers=2),cluster.predict(gmm_features,features))
+        assert cluster._pool[1] is executor
+    finally:
+        if cluster._pool is not None:
+            cluster._pool[1].shutdown()
+            cluster._pool = None
+
+def test_label_helpers():
+    labels = np.array([[1,1,2],[3,3,3]],dtype=np.uint8)
+    assert np.allclose(pipeline.label_fractions(labels)[1:4],[2/6,1/6,3/6])
+    assert np.array_equal(pipeline.select_labels(labels,[1,3]),labels != 2)
+
+def test_gmm_clusters_cache_key(tmp_path,monkeypatch):
+    monkeypatch.setattr(cache,'_cache',cache.ResultCache(directory=str(tmp_path),min_seconds=0))
+    img = two_textures()
+    labels = pipeline.gmm_clusters(img,wsize=5,n_components=2,stride=2,seed=0,workers=1)
+    # The number of workers and the memory budget do not change the labels.
+    again = pipeline.gmm_clusters(img,wsize=5,n_components=2,stride=2,seed=0,workers=2,memory=64)
+    assert np.array_equal(again,labels)
+    assert cache.get_cache().hits == 1
+    # Unseeded fits are not reproducible, so they are not stored.
+    pipeline.gmm_clusters(img,wsize=5,n_components=2,stride=2)
+    assert cache.get_cache().stats()['entries'] == 1
@@ -0,0 +1,46 @@
+import gc
+import weakref
+
+import cv2
+import numpy as np
+import pytest
+
+from gsaimage.util import matching, pipeline
+
+def reference(img,template):
+    h, w = template.shape
+    padded = cv2.copyMakeBorder(img,(h-1)//2,h//2,(w-1)//2,w//2,cv2.BORDER_REFLECT_101)
+    return cv2.matchTemplate(padded,template,cv2.TM_SQDIFF_NORMED)
+
+@pytest.fixture
+def img():
+    rng = np.random.RandomState(0)
+    return cv2.GaussianBlur(rng.randint(0,256,(300,350)).astype(np.uint8),(0,0),1)
+
+@pytest.mark.parametrize('shape',[(20,30),(21,16),(64,64),(90,80)])
+@pytest.mark.parametrize('method',['fft','direct'])
+def test_response_matches_opencv(img,shape,method):
+    template = img[50:50+shape[0],60:60+shape[1]].copy()
+    m = matching.TemplateMatcher(img,max_size=64,block=128)
+    assert np.allclose(m.response(template,method=method),reference(img,template),atol=1e-4)
+
+def test_best(img):
+    templates = matching.template_set(img[100:120,100:120].copy(),angles=matching.angles(3,60))
+    best, index = matching.TemplateMatcher(img).best(templates)
+    responses = np.stack([reference(img,t) for t in templates])
+    assert np.allclose(best,responses.min(axis=0),atol=1e-4)
+    assert index.max() < len(templates)
+
+def test_match_template_operator(img):
+    template = img[10:40,10:40]
+    assert np.allclose(pipeline.match_template(img,template),reference(img,template),atol=1e-4)
+
+def test_matcher_cache_releases_images(img):
+    for _ in range(3):
+        frozen = pipeline.freeze(img.copy())
+        ref = weakref.ref(frozen)
+        assert matching.matcher(frozen) is matching.matcher(frozen)
+        del frozen
+        gc.collect()
+        assert ref() is None
+    assert len(matching._matchers) == 0
@@ -0,0 +1,225 @@
+import dataclasses
+
+import cv2
+import numpy as np
+import pytest
+
+from gsaimage.util import pipeline
+
+def random_image(shape=(120,160),seed=0):
+    rng = np.random.RandomState(seed)
+    return cv2.GaussianBlur(rng.randint(0,256,shape).astype(np.uint8),(0,0),2)
+
+def binary_image(shape=(120,160),seed=0,low=0,high=255):
+    rng = np.random.RandomState(seed)
+    img = np.full(shape,high,np.uint8)
+    img[rng.rand(*shape) < 0.01] = low
+    return img
+
+def reference_rank_filter(img,size,mode):
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(size,size))
+    return cv2.erode(img,kernel) if mode == 'min' else cv2.dilate(img,kernel)
+
+def test_color_mask():
+    img = random_image()
+    op = pipeline.ColorMask(min_val=50,max_val=180)
+    keep = (img > 50) & (img < 180)
+    assert np.array_equal(op(img),np.where(keep,img,255))
+    assert np.array_equal(op.mask(img),keep)
+
+def test_binary_mask():
+    img = random_image()
+    img[::7] = 255
+    assert np.array_equal(pipeline.BinaryMask()(img),np.where(img<255,0,255))
+
+@pytest.mark.parametrize('gauss_size',[3,4,9])
+def test_blur(gauss_size):
+    img = random_image()
+    size = gauss_size+1 if gauss_size % 2 == 0 else gauss_size
+    assert np.array_equal(pipeline.Blur(gauss_size=gauss_size)(img),cv2.GaussianBlur(img,(size,size),0))
+
+def test_crop():
+    img = random_image()
+    out = pipeline.Crop(row=10,col=20,height=30,width=40)(img)
+    assert np.array_equal(out,img[10:40,20:60])
+    assert np.array_equal(pipeline.Crop(row=5)(img),img[5:])
+
+@pytest.mark.parametrize('size',[1,2,3,4,7,8,15])
+@pytest.mark.parametrize('op',[pipeline.Dilation,pipeline.Erosion])
+def test_rank_filter_grayscale(op,size):
+    img = random_image()
+    mode = 'min' if op is pipeline.Dilation else 'max'
+    assert np.array_equal(op(size=size)(img),reference_rank_filter(img,size,mode))
+
+@pytest.mark.parametrize('values',[(0,255),(40,200)])
+@pytest.mark.parametrize('size',[1,2,3,4,7,8,15,16])
+@pytest.mark.parametrize('mode',['min','max'])
+def test_rank_filter_binary(mode,size,values):
+    img = pipeline.freeze(binary_image(low=values[0],high=values[1]))
+    assert pipeline.binary_values(img) == values
+    assert np.array_equal(pipeline.rank_filter(img,size,mode),reference_rank_filter(img,size,mode))
+    # Second call reads the memoized distance maps.
+    assert np.array_equal(pipeline.rank_filter(img,size,mode),reference_rank_filter(img,size,mode))
+
+@pytest.mark.parametrize('size',[509,510,511,512])
+def test_rank_filter_binary_large(size):
+    # Distances past 255 saturate in the fast path.
+    img = np.full((700,700),255,np.uint8)
+    img[350,350] = 0
+    img[20,600] = 0
+    img = pipeline.freeze(img)
+    for mode in ('min','max'):
+        src = img if mode == 'min' else pipeline.freeze(255-img)
+        assert np.array_equal(pipeline.rank_filter(src,size,mode),reference_rank_filter(src,size,mode))
+
+def test_canny_thresholds():
+    img = random_image()
+    op = pipeline.CannyEdgeDetection(gauss_size=5,low_thresh=20,high_thresh=60)
+    blurred = cv2.GaussianBlur(img,(5,5),0)
+    expected = 255-cv2.Canny(blurred,20,60,L2gradient=True)
+    assert np.array_equal(op(img),expected)
+
+def scale_bar_image(height=100,width=120,row=None,col=None):
+    img = np.full((height,width),128,np.uint8)
+    if row is not None:
+        img[row] = 0
+    if col is not None:
+        img[:,col] = 0
+    return img
+
+def test_scale_boxes_rows():
+    imgs = scale_bar_image(row=80)[np.newaxis]
+    assert pipeline.scale_boxes(imgs,'Bottom') == [(0,0,120,80)]
+    assert pipeline.scale_boxes(imgs,'Top') == [(0,80,120,100)]
+    assert pipeline.scale_boxes(imgs,'Auto') == [(0,0,120,80)]
+    # No black column: the image is kept whole.
+    assert pipeline.scale_boxes(imgs,'Right') == [(0,0,120,100)]
+
+def test_scale_boxes_columns_and_stack():
+    imgs = np.stack([scale_bar_image(col=30),scale_bar_image(),scale_bar_image(row=10)])
+    assert pipeline.scale_boxes(imgs,'Auto') == [(30,0,120,100),(0,0,120,100),(0,10,120,100)]
+    assert pipeline.scale_boxes(imgs,'Left')[0] == (30,0,120,100)
+    assert pipeline.scale_boxes(imgs,'Right')[0] == (0,0,30,100)
+
+def test_scale_boxes_tolerance():
+    img = scale_bar_image(row=80)
+    img[80,:20] = 128 # 83% black
+    assert pipeline.scale_boxes(img[np.newaxis],'Bottom',tol=0.95) == [(0,0,120,100)]
+    assert pipeline.scale_boxes(img[np.newaxis],'Bottom',tol=0.8) == [(0,0,120,80)]
+
+def test_remove_scale_matches_boxes():
+    img = scale_bar_image(row=80)
+    out = pipeline.RemoveScale()(img)
+    assert np.array_equal(out,img[:80])
+    assert [o.shape for o in pipeline.RemoveScale().apply_batch(img[np.newaxis])] == [(80,120)]
+
+def test_alignment_passes_image_through():
+    img = random_image()
+    op = pipeline.Alignment(ksize=3)
+    assert op(img) is img
+    assert op.data(img)['Sobel Operator Output']['Gradient Magnitude Array'].shape == img.shape
+
+def test_operator_round_trip():
+    op = pipeline.DomainCenterDetection(min_distance=7)
+    op.set(min_radius=2)
+    assert op.version == 1
+    copy = pipeline.Operator.from_dict(op.to_dict())
+    assert type(copy) is pipeline.DomainCenterDetection
+    assert copy.params == op.params
+    with pytest.raises(KeyError):
+        op.set(size=3)
+
+def test_pipeline_run_caches_stages():
+    img = random_image()
+    stack = pipeline.Pipeline([pipeline.Blur(gauss_size=3),pipeline.ColorMask(min_val=60,max_val=200)])
+    first = stack.run(img,stages=True)
+    assert np.array_equal(first[-1],pipeline.ColorMask(min_val=60,max_val=200)(cv2.GaussianBlur(img,(3,3),0)))
+    second = stack.run(img,stages=True)
+    assert all(a is b for a, b in zip(first,second))
+
+    stack.set(1,max_val=150)
+    third = stack.run(img,stages=True)
+    assert third[0] is first[0]
+    assert third[1] is not first[1]
+    assert not third[1].flags.writeable
+
+def test_pipeline_run_keeps_input_writeable():
+    img = random_image()
+    out = pipeline.Pipeline([pipeline.DomainCenterDetection()]).run(img)
+    assert img.flags.writeable
+    assert not out.flags.writeable
+    assert np.array_equal(out,img)
+
+def test_pipeline_run_input_edited_in_place():
+    img = random_image()
+    stack = pipeline.Pipeline([pipeline.Blur(gauss_size=3)])
+    first = stack.run(img)
+    assert stack.run(img.copy()) is first
+    img[:20] = 0
+    assert np.array_equal(stack.run(img),cv2.GaussianBlur(img,(3,3),0))
+
+def test_operator_params_frozen():
+    op = pipeline.Dilation(size=3)
+    params = op.params
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        params.size = 5
+    op.set(size=5)
+    assert (params.size, op.params.size, op.version) == (3,5,1)
+
+def test_pyramid():
+    img = random_image((120,161))
+    pyramid = pipeline.Pyramid(img)
+    assert pyramid.level(0) is img
+    assert np.array_equal(pyramid.level(1),cv2.pyrDown(img))
+    assert pyramid.level(2) is pyramid.level(2)
+    assert pyramid.scale(1) == 0.5
+    assert pyramid.level(100).shape == (1,2)
+
+def test_operator_rescaled():
+    op = pipeline.Crop(row=10,col=22,height=40)
+    half = op.rescaled(0.5)
+    assert (half.params.row, half.params.col, half.params.height, half.params.width) == (5,11,20,None)
+    assert op.params.row == 10
+    assert pipeline.Dilation(size=1).rescaled(0.25).params.size == 1
+
+def test_pipeline_save_load(tmp_path):
+    stack = pipeline.Pipeline([pipeline.RemoveScale(),pipeline.Dilation(size=3),pipeline.BinaryMask()])
+    path = str(tmp_path/'stack.json')
+    stack.save(path)
+    loaded = pipeline.Pipeline.load(path)
+    img = scale_bar_image(row=80)
+    img[20:30,20:30] = 40
+    assert np.array_equal(loaded.run(img),stack.run(img))
+
+def disks(centers,radius,shape=(400,400)):
+    mask = np.zeros(shape,np.uint8)
+    for row, col in centers:
+        cv2.circle(mask,(col,row),radius,1,-1)
+    return mask.astype(bool)
+
+def test_domain_centers():
+    centers = [(50,60),(200,200),(330,90),(120,330)]
+    found = pipeline.domain_centers(disks(centers,20),min_distance=10)
+    assert sorted(map(tuple,found.tolist())) == sorted(centers)
+
+def test_domain_centers_tiles_and_suppression():
+    rng = np.random.RandomState(1)
+    centers = [(int(r),int(c)) for r, c in rng.randint(30,770,(60,2))]
+    mask = disks(centers,12,shape=(800,800))
+    full = pipeline.domain_centers(mask,min_distance=8,tile=1024)
+    tiled = pipeline.domain_centers(mask,min_distance=8,tile=100)
+    assert np.array_equal(full,tiled)
+    distances = np.hypot(*(full[:,None]-full[None]).transpose(2,0,1))
+    assert distances[np.triu_indices(len(full),1)].min() >= 8
+
+def test_domain_centers_empty():
+    assert pipeline.domain_centers(np.zeros((50,50),bool)).shape == (0,2)
+
+def test_point_set():
+    points = pipeline.PointSet([(10,10),(50,50)])
+    assert points.nearest((12,11),max_distance=5) == 0
+    assert points.nearest((30,30),max_distance=5) is None
+    assert points.add((90,90)) == 2
+    points.remove(0)
+    assert points.tolist() == [[50,50],[90,90]]
+    assert sorted(points.near((70,70),30)) == [0,1]
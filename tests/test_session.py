@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+
+from gsaimage.util import session
+
+def state():
+    rng = np.random.RandomState(0)
+    return {
+        '@class': 'GSAImage',
+        'title': 'test',
+        'layers': [
+            {'img_out': rng.randint(0,256,(300,400)).astype(np.uint8), 'operator': None},
+            {'img_out': rng.rand(20,30).astype(np.float32), 'mask': rng.rand(300,400) > 0.5,
+             'scale': np.float64(2.5), 'zero_d': np.array(7), 'fortran': np.asfortranarray(np.eye(5))},
+        ]}
+
+def assert_same(loaded,expected):
+    if isinstance(expected,np.ndarray):
+        assert loaded.shape == expected.shape
+        assert loaded.dtype == expected.dtype
+        assert np.array_equal(loaded,expected)
+    elif isinstance(expected,dict):
+        assert set(loaded) == set(expected)
+        for key in expected:
+            assert_same(loaded[key],expected[key])
+    elif isinstance(expected,(list,tuple)):
+        assert len(loaded) == len(expected)
+        for a, b in zip(loaded,expected):
+            assert_same(a,b)
+    else:
+        assert loaded == expected
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path/('a'+session.EXTENSION))
+    expected = state()
+    session.save(path,expected)
+    loaded = session.load(path)
+    assert_same(loaded,expected)
+    img = loaded['layers'][0]['img_out']
+    assert isinstance(img,np.memmap)
+    assert not img.flags.writeable
+
+def test_compressed_round_trip(tmp_path):
+    path = str(tmp_path/('a'+session.EXTENSION))
+    expected = state()
+    session.save(path,expected,compress=True)
+    assert_same(session.load(path),expected)
+
+def test_save_over_loaded_session(tmp_path):
+    path = str(tmp_path/('a'+session.EXTENSION))
+    expected = state()
+    session.save(path,expected)
+    loaded = session.load(path)
+    # The loaded arrays are memory-mapped from the file being overwritten.
+    session.save(path,loaded)
+    assert_same(session.load(path),expected)
+    assert sorted(os.listdir(str(tmp_path))) == ['a'+session.EXTENSION]
+
+def test_lazy_arrays(tmp_path):
+    path = str(tmp_path/('a'+session.EXTENSION))
+    session.save(path,state())
+    refs = session.load(path,resolve=False)
+    ref = refs['layers'][1]['mask']
+    assert session.is_array_ref(ref)
+    assert session.Session(path).array(ref).dtype == bool
+
+def test_not_a_session(tmp_path):
+    import zipfile
+    path = str(tmp_path/'other.zip')
+    with zipfile.ZipFile(path,'w') as zf:
+        zf.writestr(session.MANIFEST,'{"format": "other"}')
+    with pytest.raises(ValueError):
+        session.load(path)